@@ -0,0 +1,141 @@
+import abc
+import asyncio
+import functools
+from concurrent.futures import Executor
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy.util import await_only
+
+from allocation import config
+
+# (stream, message id, fields)
+StreamMessage = Tuple[str, str, Dict[str, str]]
+
+
+class AbstractBroker(abc.ABC):
+    @abc.abstractmethod
+    def publish(self, stream: str, messages: Iterable[Dict[str, str]]):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def create_group(self, stream: str, group: str):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def read_group(
+        self,
+        streams: List[str],
+        group: str,
+        consumer: str,
+        count: int,
+        block_ms: int,
+    ) -> List[StreamMessage]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def claim_stale(
+        self,
+        streams: List[str],
+        group: str,
+        consumer: str,
+        min_idle_ms: int,
+        count: int,
+    ) -> List[Tuple[StreamMessage, int]]:
+        # messages read but not acked for min_idle_ms, by any consumer in the
+        # group, with the number of times each has now been delivered
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def ack(self, stream: str, group: str, ids: List[str]):
+        raise NotImplementedError
+
+
+class RedisBroker(AbstractBroker):
+    def __init__(self, client=None, maxlen: int = 100_000):
+        if client is None:
+            import redis  # only needed when a broker is configured
+
+            client = redis.Redis(
+                **config.get_redis_host_and_port(), decode_responses=True
+            )
+        self.client = client
+        self.maxlen = maxlen
+
+    def publish(self, stream, messages):
+        # one round trip for the whole batch
+        pipeline = self.client.pipeline(transaction=False)
+        for fields in messages:
+            pipeline.xadd(stream, fields, maxlen=self.maxlen, approximate=True)
+        pipeline.execute()
+
+    def create_group(self, stream, group):
+        import redis
+
+        try:
+            self.client.xgroup_create(stream, group, id="0", mkstream=True)
+        except redis.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    def read_group(self, streams, group, consumer, count, block_ms):
+        response = self.client.xreadgroup(
+            group, consumer, {stream: ">" for stream in streams}, count, block_ms
+        )
+        return [
+            (stream, id, fields)
+            for stream, entries in response or []
+            for id, fields in entries
+        ]
+
+    def claim_stale(self, streams, group, consumer, min_idle_ms, count):
+        claimed = []
+        for stream in streams:
+            pending = self.client.xpending_range(
+                stream, group, min="-", max="+", count=count, idle=min_idle_ms
+            )
+            if not pending:
+                continue
+            deliveries = {p["message_id"]: p["times_delivered"] for p in pending}
+            for id, fields in self.client.xclaim(
+                stream, group, consumer, min_idle_ms, list(deliveries)
+            ):
+                # trimmed from the stream since it was read
+                if fields:
+                    claimed.append(((stream, id, fields), deliveries[id] + 1))
+        return claimed
+
+    def ack(self, stream, group, ids):
+        if ids:
+            self.client.xack(stream, group, *ids)
+
+
+class ExecutorBroker(AbstractBroker):
+    # for handlers run by an AsyncMessageBus: a blocking publish would hold up
+    # every request on the event loop, so it runs on the executor's threads
+    # while the handler's greenlet waits
+    def __init__(self, broker: AbstractBroker, executor: Executor = None):
+        self.broker = broker
+        self.executor = executor  # the loop's default when None
+
+    def publish(self, stream, messages):
+        publish = functools.partial(self.broker.publish, stream, list(messages))
+        loop = asyncio.get_running_loop()
+        await_only(loop.run_in_executor(self.executor, publish))
+
+    def create_group(self, stream, group):
+        self.broker.create_group(stream, group)
+
+    def read_group(self, streams, group, consumer, count, block_ms):
+        return self.broker.read_group(streams, group, consumer, count, block_ms)
+
+    def claim_stale(self, streams, group, consumer, min_idle_ms, count):
+        return self.broker.claim_stale(streams, group, consumer, min_idle_ms, count)
+
+    def ack(self, stream, group, ids):
+        self.broker.ack(stream, group, ids)
+
+
+def get_broker() -> Optional[AbstractBroker]:
+    if config.get_event_broker() == "redis":
+        return RedisBroker()
+    return None
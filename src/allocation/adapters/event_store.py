@@ -0,0 +1,226 @@
+import json
+import sys
+from collections import defaultdict
+from datetime import date
+from typing import Dict, List, Tuple
+
+from sqlalchemy import func, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import instrumentation
+from sqlalchemy.orm.exc import StaleDataError
+
+from allocation.adapters import orm, serialization
+from allocation.adapters.repository import UPSERT_INSERTS, AbstractRepository
+from allocation.domain import events, model
+
+# the events that change a product; the rest are rebuilt by replaying these
+STORED_EVENTS = (
+    events.BatchCreated,
+    events.Allocated,
+    events.Deallocated,
+    events.BatchQuantityChanged,
+)
+
+
+def snapshot(product: model.Product) -> str:
+    return json.dumps(
+        dict(
+            version_number=product.version_number,
+            batches=[
+                [
+                    b.reference,
+                    b._purchased_quantity,
+                    b.eta.isoformat() if b.eta else None,
+                    [[line.orderid, line.qty] for line in b._allocations],
+                ]
+                for b in product.batches
+            ],
+        ),
+        separators=(",", ":"),
+    )
+
+
+def from_snapshot(sku: str, state: str) -> model.Product:
+    data = json.loads(state)
+    sku = sys.intern(sku)
+    batches = []
+    for ref, qty, eta, lines in data["batches"]:
+        allocations = model.AllocationSet(
+            _build(model.OrderLine, orderid=orderid, sku=sku, qty=line_qty)
+            for orderid, line_qty in lines
+        )
+        batches.append(
+            _build(
+                model.Batch,
+                reference=ref,
+                sku=sku,
+                eta=date.fromisoformat(eta) if eta else None,
+                _purchased_quantity=qty,
+                _allocations=allocations,
+                _allocated_quantity=sum(line_qty for _, line_qty in lines),
+            )
+        )
+    return model.Product(sku, batches, data["version_number"])
+
+
+def _build(cls, **attributes):
+    # mapped classes record every attribute set through __init__; these objects
+    # never join a session, so their state is written directly, as in
+    # orm.intern_sku, which is several times faster for a product's lines
+    manager = instrumentation.manager_of_class(cls)
+    obj = manager.new_instance() if manager else cls.__new__(cls)
+    obj.__dict__.update(attributes)
+    return obj
+
+
+def replay(product: model.Product, history: List[events.Event]):
+    batches = {b.reference: b for b in product.batches}
+    for event in history:
+        if isinstance(event, events.BatchCreated):
+            batch = model.Batch(event.ref, event.sku, event.qty, event.eta)
+            product.add_batch(batch)
+            batches[batch.reference] = batch
+        elif isinstance(event, events.Allocated):
+            line = model.OrderLine(event.orderid, event.sku, event.qty)
+            batches[event.batchref]._allocations.add(line)
+            batches[event.batchref]._allocated_quantity = None
+        elif isinstance(event, events.Deallocated):
+            line = model.OrderLine(event.orderid, event.sku, event.qty)
+            batches[event.batchref].deallocate(line)
+        elif isinstance(event, events.BatchQuantityChanged):
+            batches[event.ref]._purchased_quantity = event.qty
+    # what happened before, not new changes to publish
+    product.events = []
+    product._allocatable_from = 0
+
+
+class EventSourcedRepository(AbstractRepository):
+    def __init__(self, session, snapshot_every: int = 100):
+        super().__init__()
+        self.session = session
+        self.snapshot_every = snapshot_every
+        # sku -> (last position, position of the latest snapshot)
+        self._positions = {}  # type: Dict[str, Tuple[int, int]]
+        # product -> (its events list, how many of them are stored)
+        self._stored = {}  # type: Dict[model.Product, Tuple[list, int]]
+
+    def _add(self, product):
+        self._positions.setdefault(product.sku, (0, 0))
+
+    def _get(self, sku):
+        events_ = orm.product_events.c
+        row = self.session.execute(
+            select(
+                orm.product_snapshots.c.position, orm.product_snapshots.c.state
+            ).where(orm.product_snapshots.c.sku == sku)
+        ).first()
+        snapshot_position = row.position if row else 0
+        tail = self.session.execute(
+            select(events_.position, events_.version, events_.type, events_.payload)
+            .where(events_.sku == sku, events_.position > snapshot_position)
+            .order_by(events_.position)
+        ).all()
+        if row is None and not tail:
+            return None
+
+        product = from_snapshot(sku, row.state) if row else model.Product(sku, [])
+        replay(
+            product,
+            [
+                serialization.loads(serialization.event_type(type_name), payload)
+                for _, _, type_name, payload in tail
+            ],
+        )
+        if tail:
+            product.version_number = tail[-1].version
+        position = tail[-1].position if tail else snapshot_position
+        self._positions[sku] = (position, snapshot_position)
+        return product
+
+    def _get_by_batchref(self, batchref):
+        sku = self.session.execute(
+            select(orm.product_events.c.sku).where(
+                orm.product_events.c.batchref == batchref
+            )
+        ).scalar()
+        return self._get(sku) if sku is not None else None
+
+    def _add_batches(self, batches):
+        by_sku = defaultdict(list)  # type: Dict[str, List[events.BatchCreated]]
+        for batch in batches:
+            by_sku[batch.sku].append(batch)
+
+        events_ = orm.product_events.c
+        heads = {
+            sku: (position, version)
+            for sku, position, version in self.session.execute(
+                select(
+                    events_.sku, func.max(events_.position), func.max(events_.version)
+                )
+                .where(events_.sku.in_(by_sku))
+                .group_by(events_.sku)
+            )
+        }
+        rows = []
+        for sku, created in sorted(by_sku.items()):
+            position, version = heads.get(sku, (0, 0))
+            rows.extend(self._rows(sku, position, version + 1, created))
+        self._append(rows)
+
+    def flush(self):
+        for product in self.seen:
+            new_events = self._unstored_events(product)
+            if not new_events:
+                continue
+
+            position, snapshot_position = self._positions.get(product.sku, (0, 0))
+            self._append(
+                self._rows(product.sku, position, product.version_number, new_events)
+            )
+            position += len(new_events)
+            if position - snapshot_position >= self.snapshot_every:
+                self._save_snapshot(product, position)
+                snapshot_position = position
+            self._positions[product.sku] = (position, snapshot_position)
+
+    def _unstored_events(self, product) -> List[events.Event]:
+        events_list, stored = self._stored.get(product, (None, 0))
+        if events_list is not product.events or stored > len(product.events):
+            # collected or cleared since, so none of these are stored yet
+            stored = 0
+        self._stored[product] = (product.events, len(product.events))
+        return [e for e in product.events[stored:] if isinstance(e, STORED_EVENTS)]
+
+    @staticmethod
+    def _rows(sku, position, version, new_events):
+        return [
+            dict(
+                sku=sku,
+                position=position + offset,
+                version=version,
+                type=type(event).__name__,
+                payload=serialization.dumps(event),
+                batchref=(
+                    event.ref if isinstance(event, events.BatchCreated) else None
+                ),
+            )
+            for offset, event in enumerate(new_events, start=1)
+        ]
+
+    def _append(self, rows):
+        try:
+            self.session.execute(orm.product_events.insert(), rows)
+        except IntegrityError as e:
+            # someone else appended to the product since it was loaded
+            raise StaleDataError(str(e)) from e
+
+    def _save_snapshot(self, product: model.Product, position: int):
+        insert = UPSERT_INSERTS[self.session.get_bind().dialect.name]
+        state = snapshot(product)
+        self.session.execute(
+            insert(orm.product_snapshots)
+            .values(sku=product.sku, position=position, state=state)
+            .on_conflict_do_update(
+                index_elements=["sku"], set_=dict(position=position, state=state)
+            )
+        )
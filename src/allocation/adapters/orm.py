@@ -1,6 +1,8 @@
+import sys
+
 from sqlalchemy import (
-    Table, MetaData, Column, Integer, String, Date, ForeignKey,
-    event,
+    Table, MetaData, Column, Integer, String, Date, DateTime, ForeignKey, Index,
+    Text, UniqueConstraint, event, func,
 )
 from sqlalchemy.orm import mapper, relationship
 
@@ -15,6 +17,7 @@ order_lines = Table(
     Column('sku', String(255)),
     Column('qty', Integer, nullable=False),
     Column('orderid', String(255)),
+    Index('ix_order_lines_orderid_sku', 'orderid', 'sku'),
 )
 
 products = Table(
@@ -26,8 +29,8 @@ products = Table(
 batches = Table(
     'batches', metadata,
     Column('id', Integer, primary_key=True, autoincrement=True),
-    Column('reference', String(255)),
-    Column('sku', ForeignKey('products.sku')),
+    Column('reference', String(255), index=True, unique=True),
+    Column('sku', ForeignKey('products.sku'), index=True),
     Column('_purchased_quantity', Integer, nullable=False),
     Column('eta', Date, nullable=True),
 )
@@ -36,9 +39,67 @@ allocations = Table(
     'allocations', metadata,
     Column('id', Integer, primary_key=True, autoincrement=True),
     Column('orderline_id', ForeignKey('order_lines.id')),
-    Column('batch_id', ForeignKey('batches.id')),
+    Column('batch_id', ForeignKey('batches.id'), index=True),
+    Index(
+        'ix_allocations_orderline_id_batch_id', 'orderline_id', 'batch_id',
+        unique=True,
+    ),
+)
+
+allocations_view = Table(
+    'allocations_view', metadata,
+    Column('id', Integer, primary_key=True, autoincrement=True),
+    Column('orderid', String(255)),
+    Column('sku', String(255)),
+    Column('batchref', String(255)),
+    # a line is in one batch at a time; the handlers upsert and delete by it
+    Index('ux_allocations_view_orderid_sku', 'orderid', 'sku', unique=True),
+)
+
+outbox = Table(
+    'outbox', metadata,
+    Column('id', Integer, primary_key=True, autoincrement=True),
+    Column('type', String(255), nullable=False),
+    Column('payload', Text, nullable=False),
+    Column('created_at', DateTime, nullable=False, server_default=func.now()),
+    Column('processed_at', DateTime, nullable=True),
+    # publishers poll for the oldest unprocessed rows
+    Index('ix_outbox_processed_at_id', 'processed_at', 'id'),
 )
 
+# the alternative to the tables above: every change to a product, in order
+product_events = Table(
+    'product_events', metadata,
+    Column('id', Integer, primary_key=True, autoincrement=True),
+    Column('sku', String(255), nullable=False),
+    Column('position', Integer, nullable=False),
+    Column('version', Integer, nullable=False),
+    Column('type', String(255), nullable=False),
+    Column('payload', Text, nullable=False),
+    # set on BatchCreated rows only, to find a batch's product
+    Column('batchref', String(255), nullable=True, index=True),
+    Column('created_at', DateTime, nullable=False, server_default=func.now()),
+    # a second writer appending at the same position loses, like a stale version
+    UniqueConstraint('sku', 'position', name='uq_product_events_sku_position'),
+)
+
+# the latest compacted state of a product, to replay only the events after it
+product_snapshots = Table(
+    'product_snapshots', metadata,
+    Column('sku', String(255), primary_key=True),
+    Column('position', Integer, nullable=False),
+    Column('state', Text, nullable=False),
+)
+
+
+def upgrade_schema(engine):
+    # create_all() skips tables that already exist, so indexes added to an
+    # existing table are created one by one
+    metadata.create_all(engine)
+    for table in metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+
 
 def start_mappers():
     lines_mapper = mapper(model.OrderLine, order_lines)
@@ -46,14 +107,52 @@ def start_mappers():
         '_allocations': relationship(
             lines_mapper,
             secondary=allocations,
-            collection_class=set,
+            collection_class=model.AllocationSet,
+            # in the order they were allocated, for last_allocated_first
+            order_by=allocations.c.id,
         )
     })
-    mapper(model.Product, products, properties={
-        'batches': relationship(batches_mapper)
-    })
+    mapper(
+        model.Product, products,
+        properties={
+            'batches': relationship(
+                batches_mapper,
+                order_by=[batches.c.eta.nullsfirst(), batches.c.id],
+            )
+        },
+        # the domain bumps version_number itself; the ORM only checks it
+        version_id_col=products.c.version_number,
+        version_id_generator=False,
+    )
+
 
 @event.listens_for(model.Product, 'load')
 def receive_load(product, _):
     product.events = []
+    product._allocatable_from = 0
+
+
+@event.listens_for(model.Product, 'refresh')
+def receive_refresh(product, *_):
+    product._allocatable_from = 0
+
+
+@event.listens_for(model.Batch, 'load')
+@event.listens_for(model.Batch, 'refresh')
+def receive_batch_load(batch, *_):
+    batch._allocated_quantity = None
+    intern_sku(batch)
+
+
+@event.listens_for(model.OrderLine, 'load')
+def receive_line_load(line, _):
+    intern_sku(line)
+
+
+def intern_sku(obj):
+    # every row comes back with its own copy of the sku; share a single one.
+    # writing __dict__ directly keeps the object out of the session's dirty set
+    sku = obj.__dict__.get('sku')
+    if sku is not None:
+        obj.__dict__['sku'] = sys.intern(sku)
 
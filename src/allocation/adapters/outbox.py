@@ -0,0 +1,59 @@
+import abc
+from datetime import datetime
+from typing import Iterable, List, Tuple
+
+from sqlalchemy import select
+
+from allocation.adapters import orm, serialization
+from allocation.domain import events
+
+
+class AbstractOutbox(abc.ABC):
+    @abc.abstractmethod
+    def add(self, new_events: Iterable[events.Event]):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def claim(self, limit: int) -> List[Tuple[int, events.Event]]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def mark_processed(self, ids: List[int]):
+        raise NotImplementedError
+
+
+class SqlAlchemyOutbox(AbstractOutbox):
+    def __init__(self, session):
+        self.session = session
+
+    def add(self, new_events):
+        rows = [
+            dict(type=type(e).__name__, payload=serialization.dumps(e))
+            for e in new_events
+        ]
+        if rows:
+            self.session.execute(orm.outbox.insert(), rows)
+
+    def claim(self, limit):
+        # rows stay locked until the claiming transaction ends; other publishers
+        # skip them instead of waiting
+        outbox = orm.outbox.c
+        rows = self.session.execute(
+            select(outbox.id, outbox.type, outbox.payload)
+            .where(outbox.processed_at.is_(None))
+            .order_by(outbox.id)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+        )
+        return [
+            (id, serialization.loads(serialization.event_type(type_name), payload))
+            for id, type_name, payload in rows
+        ]
+
+    def mark_processed(self, ids):
+        if ids:
+            self.session.execute(
+                orm.outbox.update()
+                .where(orm.outbox.c.id.in_(ids))
+                .values(processed_at=datetime.utcnow())
+            )
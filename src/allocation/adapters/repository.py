@@ -1,13 +1,28 @@
 import abc
-from typing import Set
-from allocation.domain import model
+import threading
+from collections import OrderedDict, defaultdict
+from typing import Dict, List, Optional, Set, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import contains_eager, joinedload, selectinload
+
+from allocation import config
+from allocation.domain import events, model
 
 from allocation.adapters import orm
 
+LOADING_STRATEGIES = ("lazy", "selectin", "joined", "single_query")
+
+# INSERT ... ON CONFLICT DO NOTHING, by dialect
+UPSERT_INSERTS = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}
+
 
 class AbstractRepository(abc.ABC):
     def __init__(self):
         self.seen = set()  # type: Set[model.Product]
+        # raised by bulk writes, which bypass the aggregates
+        self.events = []  # type: List[events.Event]
 
     def add(self, product: model.Product):
         self._add(product)
@@ -29,6 +44,15 @@ class AbstractRepository(abc.ABC):
 
         return product
 
+    def flush(self):
+        # for repositories whose changes the session does not track itself
+        pass
+
+    def add_batches(self, batches: List[events.BatchCreated]):
+        # plain records rather than mapped Batch objects, which are slow to build
+        self._add_batches(batches)
+        self.events.extend(batches)
+
     @abc.abstractmethod
     def _add(self, product: model.Product):
         raise NotImplementedError
@@ -41,22 +65,275 @@ class AbstractRepository(abc.ABC):
     def _get_by_batchref(self, batchref) -> model.Product:
         raise NotImplementedError
 
+    @abc.abstractmethod
+    def _add_batches(self, batches: List[events.BatchCreated]):
+        raise NotImplementedError
+
 
 class SqlAlchemyRepository(AbstractRepository):
-    def __init__(self, session):
+    def __init__(self, session, loading: str = None):
         super().__init__()
         self.session = session
+        self.loading = loading or config.get_product_loading()
+
+        if self.loading not in LOADING_STRATEGIES:
+            raise ValueError(f"Unknown loading strategy {self.loading}")
 
     def _add(self, product):
         self.session.add(product)
 
     def _get(self, sku):
-        return self.session.query(model.Product).filter_by(sku=sku).first()
+        return self._get_product(model.Product.sku == sku)
 
     def _get_by_batchref(self, batchref):
-        return (
-            self.session.query(model.Product)
-            .join(model.Batch)
-            .filter(orm.batches.c.reference == batchref)
-            .first()
+        sku = (
+            select(orm.batches.c.sku)
+            .where(orm.batches.c.reference == batchref)
+            .scalar_subquery()
+        )
+        return self._get_product(model.Product.sku == sku)
+
+    def _add_batches(self, batches):
+        skus = sorted({b.sku for b in batches})
+        insert = UPSERT_INSERTS[self.session.get_bind().dialect.name]
+        self.session.execute(
+            insert(orm.products).on_conflict_do_nothing(),
+            [dict(sku=sku) for sku in skus],
+        )
+        # as Product.add_batch would: invalidates cached copies and makes
+        # concurrent writers to these products retry
+        self.session.execute(
+            orm.products.update()
+            .where(orm.products.c.sku.in_(skus))
+            .values(version_number=orm.products.c.version_number + 1)
+        )
+        self.session.execute(
+            orm.batches.insert(),
+            [
+                dict(reference=b.ref, sku=b.sku, _purchased_quantity=b.qty, eta=b.eta)
+                for b in batches
+            ],
         )
+
+    def _get_product(self, criterion):
+        query = self.session.query(model.Product).filter(criterion)
+
+        if self.loading == "selectin":
+            query = query.options(
+                selectinload(model.Product.batches).selectinload(
+                    model.Batch._allocations
+                )
+            )
+        elif self.loading == "joined":
+            query = query.options(
+                joinedload(model.Product.batches).joinedload(model.Batch._allocations)
+            )
+        elif self.loading == "single_query":
+            # hydrate the whole aggregate from one hand-written outer join
+            query = (
+                query.outerjoin(model.Product.batches)
+                # joined by hand, as the relationship would alias allocations
+                # and its id, which sets the order the lines were allocated in
+                .outerjoin(
+                    orm.allocations, orm.allocations.c.batch_id == orm.batches.c.id
+                )
+                .outerjoin(
+                    orm.order_lines,
+                    orm.order_lines.c.id == orm.allocations.c.orderline_id,
+                )
+                .options(
+                    contains_eager(model.Product.batches).contains_eager(
+                        model.Batch._allocations
+                    )
+                )
+                .order_by(
+                    orm.batches.c.eta.nullsfirst(),
+                    orm.batches.c.id,
+                    orm.allocations.c.id,
+                )
+            )
+            return next(iter(query.all()), None)
+
+        return query.first()
+
+
+class ProductCache:
+    def __init__(self, max_products: int = 1000, max_lines: int = 1_000_000):
+        self.max_products = max_products
+        # allocated order lines plus batches, as a proxy for memory use
+        self.max_lines = max_lines
+        self.lines = 0
+        self.hits = self.misses = self.evictions = 0
+        self._products = OrderedDict()  # type: OrderedDict[str, model.Product]
+        self._lock = threading.Lock()
+
+    def get(self, sku: str, version_number: int) -> Optional[model.Product]:
+        with self._lock:
+            product = self._products.get(sku)
+            if product is not None and product.version_number == version_number:
+                self._products.move_to_end(sku)
+                self.hits += 1
+                return product
+
+            self.misses += 1
+            return None
+
+    def put(self, product: model.Product):
+        lines = self._lines_of(product)
+        with self._lock:
+            self._discard(product.sku)
+            self._products[product.sku] = product
+            self.lines += lines
+            while self._products and (
+                len(self._products) > self.max_products or self.lines > self.max_lines
+            ):
+                self._discard(next(iter(self._products)))
+                self.evictions += 1
+
+    def discard(self, sku: str):
+        with self._lock:
+            self._discard(sku)
+
+    def _discard(self, sku):
+        product = self._products.pop(sku, None)
+        if product is not None:
+            self.lines -= self._lines_of(product)
+
+    @staticmethod
+    def _lines_of(product):
+        return sum(len(b._allocations) + 1 for b in product.batches)
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                size=len(self._products),
+                lines=self.lines,
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+            )
+
+
+class CachingSqlAlchemyRepository(SqlAlchemyRepository):
+    def __init__(self, session, cache: ProductCache, loading: str = None):
+        super().__init__(session, loading)
+        self.cache = cache
+
+    def _get(self, sku):
+        version_number = self.session.execute(
+            select(orm.products.c.version_number).where(orm.products.c.sku == sku)
+        ).scalar()
+        if version_number is None:
+            return None
+
+        cached = self.cache.get(sku, version_number)
+        if cached is not None:
+            # copy the cached aggregate into this session without any SQL
+            return self.session.merge(cached, load=False)
+
+        return super()._get(sku)
+
+    def _get_by_batchref(self, batchref):
+        sku = self.session.execute(
+            select(orm.batches.c.sku).where(orm.batches.c.reference == batchref)
+        ).scalar()
+        return self._get(sku) if sku is not None else None
+
+
+class InMemoryStore:
+    # products and their indexes, shared by the units of work running over them
+    def __init__(self):
+        self.products = {}  # type: Dict[str, model.Product]
+        self.skus_by_batchref = {}  # type: Dict[str, str]
+        # orderid -> (sku, batchref) for the allocations read model
+        self.allocations = {}  # type: Dict[str, List[Tuple[str, str]]]
+        # held for a whole unit of work, so they run one at a time
+        self.lock = threading.RLock()
+
+
+def _snapshot(product: model.Product):
+    # the allocations are copied on write, so only the batches that change are
+    # actually copied
+    return (
+        product.version_number,
+        product._allocatable_from,
+        list(product.events),
+        list(product.batches),
+        [
+            (b._purchased_quantity, b._allocations.copy(), b._allocated_quantity)
+            for b in product.batches
+        ],
+    )
+
+
+def _restore(product: model.Product, snapshot):
+    # in place, as the handlers that saw the product may still hold it
+    version_number, allocatable_from, events_, batches, batch_states = snapshot
+    product.version_number = version_number
+    product._allocatable_from = allocatable_from
+    product.events = events_
+    product.batches = batches
+    for batch, (quantity, allocations, allocated) in zip(batches, batch_states):
+        batch._purchased_quantity = quantity
+        batch._allocations = allocations
+        batch._allocated_quantity = allocated
+
+
+class InMemoryRepository(AbstractRepository):
+    def __init__(self, store: InMemoryStore):
+        super().__init__()
+        self.store = store
+        self._snapshots = {}  # type: Dict[str, tuple]
+        self._added = set()  # type: Set[str]
+
+    def _add(self, product):
+        self.store.products[product.sku] = product
+        self._added.add(product.sku)
+
+    def _get(self, sku):
+        product = self.store.products.get(sku)
+        if product is not None and not (sku in self._snapshots or sku in self._added):
+            self._snapshots[sku] = _snapshot(product)
+        return product
+
+    def _get_by_batchref(self, batchref):
+        sku = self.store.skus_by_batchref.get(batchref)
+        return self._get(sku) if sku is not None else None
+
+    def _add_batches(self, batches):
+        by_sku = defaultdict(list)  # type: Dict[str, List[model.Batch]]
+        for b in batches:
+            by_sku[b.sku].append(model.Batch(b.ref, b.sku, b.qty, b.eta))
+
+        for sku, new_batches in by_sku.items():
+            product = self._get(sku)
+            if product is None:
+                product = model.Product(sku, batches=[])
+                self._add(product)
+            # without Product.add_batch, which would raise the events again
+            product.batches = sorted(
+                product.batches + new_batches, key=model.eta_order
+            )
+            product._allocatable_from = 0
+            product.version_number += 1
+            self.seen.add(product)
+
+    def commit(self):
+        for product in self.seen:
+            snapshot = self._snapshots.get(product.sku)
+            if snapshot is None or len(snapshot[3]) != len(product.batches):
+                for batch in product.batches:
+                    self.store.skus_by_batchref[batch.reference] = product.sku
+            # moved off the shared product, which later units of work append to
+            self.events.extend(product.events)
+            product.events = []
+        self._snapshots.clear()
+        self._added.clear()
+
+    def rollback(self):
+        for sku, snapshot in self._snapshots.items():
+            _restore(self.store.products[sku], snapshot)
+        for sku in self._added:
+            del self.store.products[sku]
+        self._snapshots.clear()
+        self._added.clear()
@@ -0,0 +1,36 @@
+import dataclasses
+import json
+import re
+from datetime import date
+from typing import Optional, Type, TypeVar, Union
+
+from allocation.domain import commands, events
+
+Message = TypeVar("Message", bound=Union[commands.Command, events.Event])
+
+
+def dumps(message: Union[commands.Command, events.Event]) -> str:
+    return json.dumps(dataclasses.asdict(message), default=_encode)
+
+
+def loads(message_type: Type[Message], payload: str) -> Message:
+    data = json.loads(payload)
+    for field in dataclasses.fields(message_type):
+        if field.type in (date, Optional[date]) and data.get(field.name) is not None:
+            data[field.name] = date.fromisoformat(data[field.name])
+    return message_type(**data)
+
+
+def event_type(name: str) -> Type[events.Event]:
+    return getattr(events, name)
+
+
+def channel_name(message_type: type) -> str:
+    # ChangeBatchQuantity -> change_batch_quantity
+    return re.sub(r"(?<!^)(?=[A-Z])", "_", message_type.__name__).lower()
+
+
+def _encode(value):
+    if isinstance(value, date):
+        return value.isoformat()
+    raise TypeError(f"cannot serialize {value!r}")
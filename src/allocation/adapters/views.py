@@ -0,0 +1,105 @@
+import abc
+from typing import Dict, Iterable, List, Tuple
+
+from sqlalchemy import and_, bindparam, select
+
+from allocation.adapters import orm
+from allocation.adapters.repository import UPSERT_INSERTS
+
+# (orderid, sku, batchref), at most one per orderid and sku
+AllocationRow = Tuple[str, str, str]
+
+
+class AbstractAllocationsView(abc.ABC):
+    @abc.abstractmethod
+    def add(self, rows: Iterable[AllocationRow]):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def remove(self, rows: Iterable[AllocationRow]):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def for_order(self, orderid: str) -> List[Dict[str, str]]:
+        raise NotImplementedError
+
+
+class SqlAlchemyAllocationsView(AbstractAllocationsView):
+    def __init__(self, session):
+        self.session = session
+
+    def add(self, rows):
+        # an upsert, so handling an Allocated twice, or after the line was
+        # reallocated, leaves the one row pointing at its latest batch
+        params = [dict(orderid=o, sku=s, batchref=b) for o, s, b in rows]
+        if params:
+            insert = UPSERT_INSERTS[self.session.get_bind().dialect.name]
+            statement = insert(orm.allocations_view)
+            self.session.execute(
+                statement.on_conflict_do_update(
+                    index_elements=["orderid", "sku"],
+                    set_=dict(batchref=statement.excluded.batchref),
+                ),
+                params,
+            )
+
+    def remove(self, rows):
+        # by orderid and sku, and only while the row still has that batch: a
+        # Deallocated handled after the line's reallocation leaves it alone
+        params = [dict(v_orderid=o, v_sku=s, v_batchref=b) for o, s, b in rows]
+        if params:
+            view = orm.allocations_view.c
+            self.session.execute(
+                orm.allocations_view.delete().where(
+                    and_(
+                        view.orderid == bindparam("v_orderid"),
+                        view.sku == bindparam("v_sku"),
+                        view.batchref == bindparam("v_batchref"),
+                    )
+                ),
+                params,
+            )
+
+    def for_order(self, orderid):
+        view = orm.allocations_view.c
+        rows = self.session.execute(
+            select(view.sku, view.batchref).where(view.orderid == orderid)
+        )
+        return [dict(sku=sku, batchref=batchref) for sku, batchref in rows]
+
+
+class InMemoryAllocationsView(AbstractAllocationsView):
+    def __init__(self, allocations: Dict[str, List[Tuple[str, str]]]):
+        self.allocations = allocations
+        self._pending = []  # type: List[Tuple[bool, List[AllocationRow]]]
+
+    def add(self, rows):
+        self._pending.append((True, list(rows)))
+
+    def remove(self, rows):
+        self._pending.append((False, list(rows)))
+
+    def commit(self):
+        # with the same upsert and delete as SqlAlchemyAllocationsView
+        for adding, rows in self._pending:
+            for orderid, sku, batchref in rows:
+                lines = self.allocations.setdefault(orderid, [])
+                existing = next((line for line in lines if line[0] == sku), None)
+                if adding:
+                    if existing is not None:
+                        lines.remove(existing)
+                    lines.append((sku, batchref))
+                elif existing == (sku, batchref):
+                    lines.remove(existing)
+                if not lines:
+                    del self.allocations[orderid]
+        self._pending = []
+
+    def rollback(self):
+        self._pending = []
+
+    def for_order(self, orderid):
+        return [
+            dict(sku=sku, batchref=batchref)
+            for sku, batchref in self.allocations.get(orderid, [])
+        ]
@@ -1,5 +1,7 @@
 import os
 
+from allocation.domain import model
+
 
 def get_postgres_uri():
     host = os.environ.get("DB_HOST", "localhost")
@@ -11,6 +13,46 @@ def get_postgres_uri():
     return f"postgresql://{user}:{password}@{host}:{port}/{db_name}"
 
 
+def get_async_postgres_uri():
+    # the same database, through asyncpg, for the asgi app
+    return get_postgres_uri().replace("postgresql://", "postgresql+asyncpg://", 1)
+
+
+def get_db_isolation_level():
+    # concurrent writers are caught by the optimistic lock on
+    # products.version_number, so stricter isolation is opt-in
+    return os.environ.get("DB_ISOLATION_LEVEL", "READ COMMITTED")
+
+
+def get_db_pool_options():
+    options = dict(
+        pool_size=int(os.environ.get("DB_POOL_SIZE", 5)),
+        max_overflow=int(os.environ.get("DB_MAX_OVERFLOW", 10)),
+        pool_timeout=float(os.environ.get("DB_POOL_TIMEOUT", 30)),
+        pool_recycle=int(os.environ.get("DB_POOL_RECYCLE", 1800)),
+        pool_pre_ping=os.environ.get("DB_POOL_PRE_PING", "true") == "true",
+    )
+
+    statement_timeout = os.environ.get("DB_STATEMENT_TIMEOUT_MS")
+    if statement_timeout:
+        options["connect_args"] = {
+            "options": f"-c statement_timeout={int(statement_timeout)}"
+        }
+
+    return options
+
+
+def get_redis_host_and_port():
+    host = os.environ.get("REDIS_HOST", "localhost")
+    port = 63791 if host == "localhost" else 6379
+    return dict(host=host, port=port)
+
+
+def get_event_broker():
+    # "redis" to publish events to, and consume commands from, redis streams
+    return os.environ.get("EVENT_BROKER")
+
+
 def get_api_url():
     host = os.environ.get("API_HOST", "localhost")
     port = 5005 if host == "localhost" else os.environ.get("API_PORT", 80)
@@ -19,3 +61,91 @@ def get_api_url():
         return f"http://{host}"
 
     return f"http://{host}:{port}"
+
+
+def get_product_loading():
+    # one of adapters.repository.LOADING_STRATEGIES
+    return os.environ.get("PRODUCT_LOADING", "selectin")
+
+
+def get_event_outbox():
+    # events are handled in-process after each commit unless EVENT_OUTBOX is set,
+    # in which case a separate publisher picks them up from the outbox table
+    return os.environ.get("EVENT_OUTBOX", "false") == "true"
+
+
+def get_event_worker_options():
+    # events are handled inline unless EVENT_WORKERS is set
+    workers = int(os.environ.get("EVENT_WORKERS", 0))
+    if not workers:
+        return None
+
+    return dict(
+        max_workers=workers,
+        max_pending=int(os.environ.get("EVENT_WORKERS_MAX_PENDING", 1000)),
+    )
+
+
+def get_product_cache_options():
+    # products are reloaded on every request unless PRODUCT_CACHE_SIZE is set
+    size = int(os.environ.get("PRODUCT_CACHE_SIZE", 0))
+    if not size:
+        return None
+
+    return dict(
+        max_products=size,
+        max_lines=int(os.environ.get("PRODUCT_CACHE_MAX_LINES", 1_000_000)),
+    )
+
+
+def get_deallocation_policy():
+    # a shrunk batch evicts as few lines as it can unless DEALLOCATION_POLICY names
+    # another of model.DEALLOCATION_POLICIES, e.g. last_allocated_first
+    name = os.environ.get("DEALLOCATION_POLICY", "fewest_lines")
+    if name not in model.DEALLOCATION_POLICIES:
+        raise ValueError(
+            f"Unknown DEALLOCATION_POLICY {name}, expected one of"
+            f" {', '.join(model.DEALLOCATION_POLICIES)}"
+        )
+    return model.DEALLOCATION_POLICIES[name]
+
+
+def get_bus_shards():
+    # commands run in the receiving process unless BUS_SHARDS is set, in which
+    # case they are partitioned by sku across that many worker processes
+    return int(os.environ.get("BUS_SHARDS", 0))
+
+
+def get_metrics_enabled():
+    # handler, unit of work and sql timings cost a little on every request, so
+    # they are only recorded when METRICS_ENABLED is set
+    return os.environ.get("METRICS_ENABLED", "false") == "true"
+
+
+def get_in_memory_store():
+    # products live in the api process instead of postgres when IN_MEMORY_STORE
+    # is set, for simulations; nothing survives a restart
+    return os.environ.get("IN_MEMORY_STORE", "false") == "true"
+
+
+def get_event_sourcing_options():
+    # products are kept in the batches and order_lines tables unless
+    # PRODUCT_STORE=events, in which case they are rebuilt from their events
+    if os.environ.get("PRODUCT_STORE", "tables") != "events":
+        return None
+
+    return dict(snapshot_every=int(os.environ.get("PRODUCT_SNAPSHOT_EVERY", 100)))
+
+
+def get_allocate_batching_options():
+    # each /allocate request commits on its own unless ALLOCATE_BATCH_WINDOW_MS is
+    # set, in which case concurrent requests for a sku arriving within that many
+    # milliseconds are allocated together, with a single commit
+    window_ms = float(os.environ.get("ALLOCATE_BATCH_WINDOW_MS", 0))
+    if not window_ms:
+        return None
+
+    return dict(
+        window_seconds=window_ms / 1000,
+        max_batch=int(os.environ.get("ALLOCATE_BATCH_MAX", 100)),
+    )
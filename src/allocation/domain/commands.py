@@ -1,6 +1,6 @@
 from dataclasses import dataclass
 from datetime import date
-from typing import Optional
+from typing import List, Optional
 
 
 class Command:
@@ -14,6 +14,11 @@ class Allocate(Command):
     qty: int
 
 
+@dataclass
+class AllocateMany(Command):
+    lines: List[Allocate]
+
+
 @dataclass
 class CreateBatch(Command):
     ref: str
@@ -22,6 +27,11 @@ class CreateBatch(Command):
     eta: Optional[date] = None
 
 
+@dataclass
+class ImportBatches(Command):
+    batches: List[CreateBatch]
+
+
 @dataclass
 class ChangeBatchQuantity(Command):
     ref: str
@@ -12,6 +12,22 @@ class OutOfStock(Event):
     sku: str
 
 
+@dataclass
+class Allocated(Event):
+    orderid: str
+    sku: str
+    qty: int
+    batchref: str
+
+
+@dataclass
+class Deallocated(Event):
+    orderid: str
+    sku: str
+    qty: int
+    batchref: str
+
+
 @dataclass
 class BatchCreated(Event):
     ref: str
@@ -1,8 +1,12 @@
 from __future__ import annotations
 
+import bisect
+import sys
+from collections.abc import MutableSet
 from dataclasses import dataclass
 from datetime import date
-from typing import List, Optional, Set
+from itertools import islice
+from typing import Callable, Dict, Iterable, List, Optional
 
 from . import events
 
@@ -10,37 +14,188 @@ from . import events
 class Product:
     def __init__(self, sku: str, batches: List[Batch], version_number: int = 0):
         self.sku = sku
-        self.batches = batches
+        self.batches = sorted(batches, key=eta_order)
         self.version_number = version_number
         self.events = []  # type: List[events.Event]
+        # batches before this index are known to be fully allocated
+        self._allocatable_from = 0
+
+    def add_batch(self, batch: Batch):
+        key = eta_order(batch)
+        low, high = 0, len(self.batches)
+        while low < high:
+            middle = (low + high) // 2
+            if key < eta_order(self.batches[middle]):
+                high = middle
+            else:
+                low = middle + 1
+
+        self.batches.insert(low, batch)
+        self._allocatable_from = min(self._allocatable_from, low)
+        self.version_number += 1
+        self.events.append(
+            events.BatchCreated(
+                batch.reference, batch.sku, batch._purchased_quantity, batch.eta
+            )
+        )
 
     def allocate(self, line: OrderLine) -> str:
+        batches = self.batches
+        start = self._allocatable_from
+        while start < len(batches) and batches[start].available_quantity <= 0:
+            start += 1
+        self._allocatable_from = start
+
         try:
-            batch = next(b for b in sorted(self.batches) if b.can_allocate(line))
+            batch = next(
+                b for b in islice(batches, start, None) if b.can_allocate(line)
+            )
             batch.allocate(line)
             self.version_number += 1
+            self.events.append(
+                events.Allocated(line.orderid, line.sku, line.qty, batch.reference)
+            )
             return batch.reference
         except StopIteration:
             self.events.append(events.OutOfStock(line.sku))
             return None
 
-    def change_batch_quantity(self, ref: str, qty: int):
-        batch = next(b for b in self.batches if b.reference == ref)
+    def change_batch_quantity(
+        self, ref: str, qty: int, policy: DeallocationPolicy = None
+    ):
+        index, batch = next(
+            (i, b) for i, b in enumerate(self.batches) if b.reference == ref
+        )
         batch._purchased_quantity = qty
+        self._allocatable_from = min(self._allocatable_from, index)
+        self.version_number += 1
+        self.events.append(events.BatchQuantityChanged(ref, qty))
 
-        while batch.available_quantity < 0:
-            line = batch.deallocate_one()
+        excess = -batch.available_quantity
+        if excess <= 0:
+            return
+
+        policy = policy or fewest_lines
+        for line in policy(batch._allocations, excess):
+            batch.deallocate(line)
+            self.events.append(
+                events.Deallocated(line.orderid, line.sku, line.qty, batch.reference)
+            )
             self.events.append(
                 events.AllocationRequired(line.orderid, line.sku, line.qty)
             )
 
 
+DeallocationPolicy = Callable[[Iterable["OrderLine"], int], List["OrderLine"]]
+
+
+def fewest_lines(allocations: Iterable[OrderLine], excess: int) -> List[OrderLine]:
+    # as few lines as there can be, the last the smallest that covers the rest,
+    # so each shrink sends as few lines as possible back to be reallocated
+    by_qty = sorted(allocations, key=lambda line: line.qty)
+    quantities = [line.qty for line in by_qty]
+    evicted = []
+    while excess > 0 and by_qty:
+        index = min(bisect.bisect_left(quantities, excess), len(by_qty) - 1)
+        del quantities[index]
+        evicted.append(by_qty.pop(index))
+        excess -= evicted[-1].qty
+    return evicted
+
+
+def largest_first(allocations: Iterable[OrderLine], excess: int) -> List[OrderLine]:
+    return _until_covered(
+        sorted(allocations, key=lambda line: line.qty, reverse=True), excess
+    )
+
+
+def last_allocated_first(allocations: AllocationSet, excess: int) -> List[OrderLine]:
+    return _until_covered(reversed(allocations), excess)
+
+
+def _until_covered(lines: Iterable[OrderLine], excess: int) -> List[OrderLine]:
+    evicted = []
+    for line in lines:
+        if excess <= 0:
+            break
+        evicted.append(line)
+        excess -= line.qty
+    return evicted
+
+
+DEALLOCATION_POLICIES = {
+    "fewest_lines": fewest_lines,
+    "largest_first": largest_first,
+    "last_allocated_first": last_allocated_first,
+}  # type: Dict[str, DeallocationPolicy]
+
+
+def eta_order(batch: Batch):
+    # warehouse stock (no eta) first, then shipments by eta
+    return batch.eta is not None, batch.eta or date.min
+
+
 @dataclass(unsafe_hash=True)
 class OrderLine:
     orderid: str
     sku: str
     qty: int
 
+    def __post_init__(self):
+        # a product's lines share one sku string rather than a copy each; a
+        # missing sku is left for the handlers to reject as InvalidSku
+        if isinstance(self.sku, str):
+            self.sku = sys.intern(self.sku)
+
+
+class AllocationSet(MutableSet):
+    # a set of order lines that remembers the order they were allocated in
+    def __init__(self, lines: Iterable[OrderLine] = ()):
+        self._lines = dict.fromkeys(lines)  # type: Dict[OrderLine, None]
+        # set by copy(): the lines are shared until either set changes
+        self._shared = False
+
+    def __contains__(self, line):
+        return line in self._lines
+
+    def __iter__(self):
+        return iter(self._lines)
+
+    def __reversed__(self):
+        return reversed(self._lines.keys())
+
+    def __len__(self):
+        return len(self._lines)
+
+    def __repr__(self):
+        return f"AllocationSet({list(self._lines)!r})"
+
+    def _unshare(self):
+        if self._shared:
+            self._lines = self._lines.copy()
+            self._shared = False
+
+    def add(self, line: OrderLine):
+        self._unshare()
+        self._lines[line] = None
+
+    def discard(self, line: OrderLine):
+        self._unshare()
+        self._lines.pop(line, None)
+
+    def pop(self) -> OrderLine:
+        # the most recently allocated
+        self._unshare()
+        line, _ = self._lines.popitem()
+        return line
+
+    def copy(self) -> AllocationSet:
+        # copied on write, so a copy of lines nobody changes costs nothing
+        copy = AllocationSet()
+        copy._lines = self._lines
+        copy._shared = self._shared = True
+        return copy
+
 
 class Batch:
     def __init__(self, ref: str, sku: str, qty: int, eta: Optional[date]):
@@ -48,7 +203,8 @@ class Batch:
         self.sku = sku
         self.eta = eta
         self._purchased_quantity = qty
-        self._allocations = set()  # type: Set[OrderLine]
+        self._allocations = AllocationSet()
+        self._allocated_quantity = 0  # type: Optional[int]
 
     def __repr__(self):
         return f"<Batch {self.reference}>"
@@ -69,16 +225,23 @@ class Batch:
         return self.eta > other.eta
 
     def allocate(self, line: OrderLine):
-        if self.can_allocate(line):
+        if self.can_allocate(line) and line not in self._allocations:
             self._allocations.add(line)
+            self._allocated_quantity += line.qty
 
     def deallocate(self, line: OrderLine):
         if line in self._allocations:
+            allocated_quantity = self.allocated_quantity
             self._allocations.remove(line)
+            self._allocated_quantity = allocated_quantity - line.qty
 
     @property
     def allocated_quantity(self) -> int:
-        return sum(line.qty for line in self._allocations)
+        # None means the counter was invalidated (e.g. by an ORM load) and must
+        # be rebuilt from the allocations once
+        if self._allocated_quantity is None:
+            self._allocated_quantity = sum(line.qty for line in self._allocations)
+        return self._allocated_quantity
 
     @property
     def available_quantity(self) -> int:
@@ -86,6 +249,3 @@ class Batch:
 
     def can_allocate(self, line: OrderLine) -> bool:
         return self.sku == line.sku and self.available_quantity >= line.qty
-
-    def deallocate_one(self) -> OrderLine:
-        return self._allocations.pop()
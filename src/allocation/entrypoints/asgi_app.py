@@ -0,0 +1,235 @@
+import json
+import logging
+from datetime import datetime
+from typing import Callable
+
+from sqlalchemy.util import greenlet_spawn
+
+from allocation import config, metrics
+from allocation.adapters import broker, orm, repository
+from allocation.domain import commands
+from allocation.service_layer import handlers, messagebus, retries, unit_of_work
+
+logger = logging.getLogger(__name__)
+
+
+class BadRequest(Exception):
+    pass
+
+
+class JsonResponse:
+    def __init__(self, body, status: int = 200):
+        self.body = json.dumps(body).encode()
+        self.status = status
+        self.content_type = b"application/json"
+
+
+class TextResponse:
+    def __init__(
+        self, body: str, status: int = 200, content_type="text/html; charset=utf-8"
+    ):
+        self.body = body.encode()
+        self.status = status
+        self.content_type = content_type.encode()
+
+
+class AllocationApp:
+    # the flask app's routes, served from one event loop: each request's
+    # handlers run in a greenlet and wait for the database without a thread
+    def __init__(
+        self,
+        new_uow: Callable[[], unit_of_work.AbstractUnitOfWork],
+        event_broker: broker.AbstractBroker = None,
+        product_cache: repository.ProductCache = None,
+        get_engine: Callable = None,
+    ):
+        self.new_uow = new_uow
+        # publishes on a thread, as the redis client would block the event loop
+        if event_broker is not None:
+            event_broker = broker.ExecutorBroker(event_broker)
+        self.event_broker = event_broker
+        self.product_cache = product_cache
+        self.get_engine = get_engine
+        self.routes = {
+            ("POST", "/add_batch"): self.add_batch,
+            ("POST", "/allocate"): self.allocate,
+            ("POST", "/allocate_many"): self.allocate_many,
+            ("GET", "/pool_status"): self.pool_status,
+            ("GET", "/product_cache_status"): self.product_cache_status,
+            ("GET", "/retry_status"): self.retry_status,
+            ("GET", "/metrics"): self.metrics_endpoint,
+        }
+
+    def get_bus(self):
+        # no retry queue or event workers: both run handlers on other threads,
+        # so failed event handlers back off inline, on the event loop
+        return messagebus.AsyncMessageBus(
+            messagebus.MessageBus(self.new_uow(), broker=self.event_broker)
+        )
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+            return
+
+        method, path = scope["method"], scope["path"]
+        try:
+            if method == "GET" and path.startswith("/allocations/"):
+                response = await self.allocations_view(path[len("/allocations/") :])
+            elif (method, path) in self.routes:
+                response = await self.routes[method, path](await read_json(receive))
+            else:
+                response = TextResponse("not found", 404)
+        except BadRequest as e:
+            response = JsonResponse({"message": str(e)}, 400)
+        except Exception:
+            logger.exception(f"Exception serving {method} {path}")
+            response = TextResponse("internal server error", 500)
+
+        await send(
+            {
+                "type": "http.response.start",
+                "status": response.status,
+                "headers": [(b"content-type", response.content_type)],
+            }
+        )
+        await send({"type": "http.response.body", "body": response.body})
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                orm.start_mappers()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if self.get_engine is not None:
+                    await self.get_engine().dispose()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def add_batch(self, body):
+        ref, sku, qty, eta = fields(body, "ref", "sku", "qty", "eta")
+        if eta is not None:
+            eta = datetime.fromisoformat(eta).date()
+        command = commands.CreateBatch(ref, sku, qty, eta)
+        await self.get_bus().handle(command)
+        return TextResponse("OK", 201)
+
+    async def allocate(self, body):
+        try:
+            command = commands.Allocate(*fields(body, "orderid", "sku", "qty"))
+            results = await self.get_bus().handle(command)
+            batchref = results.pop(0)
+        except handlers.InvalidSku as e:
+            return JsonResponse({"message": str(e)}, 400)
+
+        return JsonResponse({"batchref": batchref}, 201)
+
+    async def allocate_many(self, body):
+        try:
+            [lines] = fields(body, "lines")
+            command = commands.AllocateMany(
+                [
+                    commands.Allocate(*fields(line, "orderid", "sku", "qty"))
+                    for line in lines
+                ]
+            )
+            [batchrefs] = await self.get_bus().handle(command)
+        except handlers.InvalidSku as e:
+            return JsonResponse({"message": str(e)}, 400)
+
+        return JsonResponse({"batchrefs": batchrefs}, 201)
+
+    async def allocations_view(self, orderid):
+        result = await greenlet_spawn(self._allocations_for, orderid)
+        if not result:
+            return TextResponse("not found", 404)
+
+        return JsonResponse(result)
+
+    def _allocations_for(self, orderid):
+        with self.new_uow() as uow:
+            return uow.allocations_view.for_order(orderid)
+
+    async def pool_status(self, body):
+        if self.get_engine is None:
+            return TextResponse("no database pool", 404)
+
+        return JsonResponse(unit_of_work.pool_metrics(self.get_engine().sync_engine))
+
+    async def product_cache_status(self, body):
+        if self.product_cache is None:
+            return TextResponse("product cache disabled", 404)
+
+        return JsonResponse(self.product_cache.stats())
+
+    async def retry_status(self, body):
+        return JsonResponse(dict(retries.metrics.snapshot(), delayed=0))
+
+    async def metrics_endpoint(self, body):
+        return TextResponse(
+            metrics.render(), content_type="text/plain; version=0.0.4"
+        )
+
+
+async def read_json(receive):
+    body = b""
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get("body", b"")
+        more_body = message.get("more_body", False)
+    if not body:
+        return None
+    try:
+        return json.loads(body)
+    except ValueError:
+        raise BadRequest("Invalid json body")
+
+
+def fields(body, *names) -> list:
+    if not isinstance(body, dict):
+        raise BadRequest("Expected a json object")
+    missing = [name for name in names if name not in body]
+    if missing:
+        raise BadRequest(f"Missing {', '.join(missing)}")
+    return [body[name] for name in names]
+
+
+def create_app():
+    product_cache = None
+    product_cache_options = config.get_product_cache_options()
+    if product_cache_options:
+        product_cache = repository.ProductCache(**product_cache_options)
+
+    if config.get_in_memory_store():
+        memory_store = repository.InMemoryStore()
+        return AllocationApp(
+            lambda: unit_of_work.InMemoryUnitOfWork(memory_store),
+            broker.get_broker(),
+        )
+
+    def async_pool_metrics():
+        return unit_of_work.pool_metrics(unit_of_work.get_async_engine().sync_engine)
+
+    metrics.Gauge(
+        "allocation_db_pool_checked_out",
+        "Connections currently checked out of the pool",
+        lambda: async_pool_metrics()["checked_out"],
+    )
+    metrics.Gauge(
+        "allocation_db_pool_checkout_wait_seconds",
+        "Total time spent waiting for a pooled connection",
+        lambda: async_pool_metrics()["checkout_wait_seconds"],
+    )
+    # the engine, and asyncpg with it, is only set up by the first request
+    return AllocationApp(
+        lambda: unit_of_work.AsyncSqlAlchemyUnitOfWork(product_cache=product_cache),
+        broker.get_broker(),
+        product_cache,
+        unit_of_work.get_async_engine,
+    )
+
+
+# uvicorn allocation.entrypoints.asgi_app:app
+app = create_app()
@@ -0,0 +1,82 @@
+import argparse
+import csv
+import json
+import sys
+import time
+from datetime import date
+from itertools import islice
+from pathlib import Path
+from typing import IO, Iterable, Iterator, List
+
+from allocation.adapters import orm
+from allocation.domain import commands
+from allocation.service_layer import messagebus, unit_of_work
+
+FORMATS = ("csv", "jsonl")
+
+
+def to_command(row: dict) -> commands.CreateBatch:
+    eta = row.get("eta") or None
+    if eta is not None:
+        eta = date.fromisoformat(eta)
+    return commands.CreateBatch(row["ref"], row["sku"], int(row["qty"]), eta)
+
+
+def read_batches(lines: IO[str], format: str) -> Iterator[commands.CreateBatch]:
+    if format == "csv":
+        rows = csv.DictReader(lines)
+    else:
+        rows = (json.loads(line) for line in lines if line.strip())
+    return map(to_command, rows)
+
+
+def chunked(iterable: Iterable, size: int) -> Iterator[List]:
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def import_batches(
+    bus: messagebus.AbstractMessageBus,
+    batches: Iterable[commands.CreateBatch],
+    chunk_size: int = 5000,
+) -> int:
+    # only one chunk is held in memory at a time, and each is its own transaction
+    imported = 0
+    for chunk in chunked(batches, chunk_size):
+        bus.handle(commands.ImportBatches(chunk))
+        imported += len(chunk)
+    return imported
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="import batches from a feed")
+    parser.add_argument("path", help="file to import, or - for stdin")
+    parser.add_argument("--format", choices=FORMATS, help="default: from the suffix")
+    parser.add_argument("--chunk-size", type=int, default=5000)
+    args = parser.parse_args(argv)
+
+    format = args.format or Path(args.path).suffix.lstrip(".")
+    if format not in FORMATS:
+        parser.error(f"cannot tell the format of {args.path}, use --format")
+
+    orm.start_mappers()
+    bus = messagebus.MessageBus(unit_of_work.SqlAlchemyUnitOfWork())
+
+    lines = sys.stdin if args.path == "-" else open(args.path, newline="")
+    with lines:
+        start = time.perf_counter()
+        imported = import_batches(bus, read_batches(lines, format), args.chunk_size)
+        elapsed = time.perf_counter() - start
+
+    print(
+        f"imported {imported} batches in {elapsed:.1f}s"
+        f" ({imported / max(elapsed, 1e-9):.0f} rows/s)"
+    )
+
+
+if __name__ == "__main__":
+    main()
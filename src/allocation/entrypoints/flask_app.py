@@ -1,41 +1,200 @@
+import atexit
 from datetime import datetime
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
 
-from allocation.domain import model
-from allocation.adapters import orm
-from allocation.service_layer import services, unit_of_work, messagebus
-from allocation.domain import events
+from allocation import config, metrics
+from allocation.adapters import broker, orm, repository
+from allocation.domain import commands
+from allocation.service_layer import (
+    coalescing,
+    dispatcher,
+    handlers,
+    messagebus,
+    retries,
+    sharding,
+    unit_of_work,
+)
 
 app = Flask(__name__)
 orm.start_mappers()
 
 
+event_broker = broker.get_broker()
+
+product_cache = None
+product_cache_options = config.get_product_cache_options()
+if product_cache_options:
+    product_cache = repository.ProductCache(**product_cache_options)
+
+memory_store = None
+if config.get_in_memory_store():
+    memory_store = repository.InMemoryStore()
+
+
+def new_uow():
+    if memory_store is not None:
+        return unit_of_work.InMemoryUnitOfWork(memory_store)
+    return unit_of_work.SqlAlchemyUnitOfWork(product_cache=product_cache)
+
+
+def sync_bus():
+    return messagebus.MessageBus(
+        new_uow(),
+        broker=event_broker,
+        retry_queue=retry_queue,
+    )
+
+
+event_dispatcher = None
+event_worker_options = config.get_event_worker_options()
+if event_worker_options:
+    event_dispatcher = dispatcher.EventDispatcher(sync_bus, **event_worker_options)
+    atexit.register(event_dispatcher.shutdown)
+
+
+# registered after the dispatcher, so it is shut down first, as atexit runs
+# in reverse: its last due retries still find the dispatcher open
+retry_queue = retries.DelayQueue(sync_bus, event_dispatcher)
+atexit.register(retry_queue.shutdown)
+
+
+sharded_bus = None
+if config.get_bus_shards():
+    sharded_bus = sharding.ShardedMessageBus(config.get_bus_shards())
+    atexit.register(sharded_bus.close)
+
+
+metrics.Gauge(
+    "allocation_db_pool_checked_out",
+    "Connections currently checked out of the pool",
+    lambda: unit_of_work.pool_metrics()["checked_out"],
+)
+metrics.Gauge(
+    "allocation_db_pool_checkout_wait_seconds",
+    "Total time spent waiting for a pooled connection",
+    lambda: unit_of_work.pool_metrics()["checkout_wait_seconds"],
+)
+metrics.Gauge(
+    "allocation_retries_delayed",
+    "Event handlers waiting in the retry queue",
+    lambda: len(retry_queue),
+)
+if product_cache is not None:
+    metrics.CallbackCounter(
+        "allocation_product_cache_hits_total",
+        "Products served from the cache",
+        lambda: product_cache.stats()["hits"],
+    )
+    metrics.CallbackCounter(
+        "allocation_product_cache_misses_total",
+        "Products loaded from the database",
+        lambda: product_cache.stats()["misses"],
+    )
+    metrics.CallbackCounter(
+        "allocation_product_cache_evictions_total",
+        "Products dropped from the full cache",
+        lambda: product_cache.stats()["evictions"],
+    )
+
+
+def get_bus():
+    if sharded_bus is not None:
+        return sharded_bus
+    return messagebus.MessageBus(
+        new_uow(),
+        event_dispatcher,
+        event_broker,
+        retry_queue,
+    )
+
+
+allocation_coalescer = None
+allocate_batching_options = config.get_allocate_batching_options()
+if allocate_batching_options:
+    allocation_coalescer = coalescing.AllocationCoalescer(
+        get_bus, **allocate_batching_options
+    )
+
+
 @app.route("/add_batch", methods=["POST"])
 def add_batch():
     eta = request.json["eta"]
     if eta is not None:
         eta = datetime.fromisoformat(eta).date()
-    services.add_batch(
+    command = commands.CreateBatch(
         request.json["ref"],
         request.json["sku"],
         request.json["qty"],
         eta,
-        unit_of_work.SqlAlchemyUnitOfWork(),
     )
+    get_bus().handle(command)
     return "OK", 201
 
 
 @app.route("/allocate", methods=["POST"])
 def allocate_endpoint():
     try:
-        event = events.AllocationRequired(
+        command = commands.Allocate(
             request.json.get("orderid"),
             request.json.get("sku"),
             request.json.get("qty"),
         )
-        results = messagebus.handle(event, unit_of_work.SqlAlchemyUnitOfWork())
-        batchref = results.pop(0)
-    except (model.OutOfStock, services.InvalidSku) as e:
+        if allocation_coalescer is not None:
+            batchref = allocation_coalescer.allocate(command)
+        else:
+            results = get_bus().handle(command)
+            batchref = results.pop(0)
+    except handlers.InvalidSku as e:
         return jsonify({"message": str(e)}), 400
 
     return jsonify({"batchref": batchref}), 201
+
+
+@app.route("/allocate_many", methods=["POST"])
+def allocate_many_endpoint():
+    try:
+        command = commands.AllocateMany(
+            [
+                commands.Allocate(line["orderid"], line["sku"], line["qty"])
+                for line in request.json["lines"]
+            ]
+        )
+        [batchrefs] = get_bus().handle(command)
+    except handlers.InvalidSku as e:
+        return jsonify({"message": str(e)}), 400
+
+    return jsonify({"batchrefs": batchrefs}), 201
+
+
+@app.route("/allocations/<orderid>", methods=["GET"])
+def allocations_view_endpoint(orderid):
+    with new_uow() as uow:
+        result = uow.allocations_view.for_order(orderid)
+
+    if not result:
+        return "not found", 404
+
+    return jsonify(result), 200
+
+
+@app.route("/pool_status", methods=["GET"])
+def pool_status_endpoint():
+    return jsonify(unit_of_work.pool_metrics()), 200
+
+
+@app.route("/product_cache_status", methods=["GET"])
+def product_cache_status_endpoint():
+    if product_cache is None:
+        return "product cache disabled", 404
+
+    return jsonify(product_cache.stats()), 200
+
+
+@app.route("/retry_status", methods=["GET"])
+def retry_status_endpoint():
+    return jsonify(dict(retries.metrics.snapshot(), delayed=len(retry_queue))), 200
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
@@ -0,0 +1,63 @@
+import argparse
+import logging
+import time
+from typing import Callable
+
+from allocation.adapters import broker, orm
+from allocation.adapters.outbox import SqlAlchemyOutbox
+from allocation.service_layer import messagebus, unit_of_work
+
+logger = logging.getLogger(__name__)
+
+
+class OutboxPublisher:
+    def __init__(
+        self,
+        bus_factory: Callable[[], messagebus.AbstractMessageBus],
+        session_factory=None,
+        batch_size: int = 100,
+    ):
+        self.bus_factory = bus_factory
+        self.session_factory = session_factory or unit_of_work.get_session_factory()
+        self.batch_size = batch_size
+
+    def publish_pending(self) -> int:
+        session = self.session_factory()
+        try:
+            outbox = SqlAlchemyOutbox(session)
+            claimed = outbox.claim(self.batch_size)
+            if claimed:
+                ids, pending = zip(*claimed)
+                # handlers log their own failures; a crash before the commit
+                # below leaves the rows to be claimed again
+                self.bus_factory().handle_events(pending)
+                outbox.mark_processed(list(ids))
+            session.commit()
+            return len(claimed)
+        finally:
+            session.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="publish events from the outbox")
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--poll-interval", type=float, default=1.0)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    orm.start_mappers()
+    event_broker = broker.get_broker()
+    publisher = OutboxPublisher(
+        lambda: messagebus.MessageBus(
+            unit_of_work.SqlAlchemyUnitOfWork(), broker=event_broker
+        ),
+        batch_size=args.batch_size,
+    )
+    logger.info("publishing events from the outbox")
+    while True:
+        if not publisher.publish_pending():
+            time.sleep(args.poll_interval)
+
+
+if __name__ == "__main__":
+    main()
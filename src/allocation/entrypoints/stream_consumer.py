@@ -0,0 +1,167 @@
+import argparse
+import logging
+import os
+import socket
+from collections import defaultdict
+from typing import Callable, Dict, List, Tuple
+
+from allocation.adapters import orm, serialization
+from allocation.adapters.broker import AbstractBroker, RedisBroker, StreamMessage
+from allocation.domain import commands
+from allocation.service_layer import messagebus, retries, unit_of_work
+
+logger = logging.getLogger(__name__)
+
+# read in this order, so batches exist before the lines allocated to them
+COMMAND_STREAMS = {
+    serialization.channel_name(command_type): command_type
+    for command_type in (
+        commands.CreateBatch,
+        commands.Allocate,
+        commands.ChangeBatchQuantity,
+    )
+}
+
+
+class StreamConsumer:
+    # worth handling again later; an unknown sku, a bad payload or a bug is not
+    retry_policy = retries.RetryPolicy(
+        transient=retries.TRANSIENT_ERRORS + (unit_of_work.ConcurrentModification,)
+    )
+
+    def __init__(
+        self,
+        broker: AbstractBroker,
+        bus_factory: Callable[[], messagebus.AbstractMessageBus],
+        group: str = "allocation",
+        consumer: str = None,
+        batch_size: int = 100,
+        block_ms: int = 1000,
+        reclaim_idle_ms: int = 60_000,
+        max_deliveries: int = 5,
+    ):
+        self.broker = broker
+        self.bus_factory = bus_factory
+        self.group = group
+        self.consumer = consumer or f"{socket.gethostname()}-{os.getpid()}"
+        self.batch_size = batch_size
+        self.block_ms = block_ms
+        self.reclaim_idle_ms = reclaim_idle_ms
+        self.max_deliveries = max_deliveries
+        for stream in COMMAND_STREAMS:
+            self.broker.create_group(stream, group)
+
+    def consume(self) -> int:
+        # messages left pending by a transient failure, here or on a consumer
+        # that has since died, go before the new ones
+        messages = self._reclaim()
+        # every consumer in the group gets a different share of the messages
+        messages += self.broker.read_group(
+            list(COMMAND_STREAMS),
+            self.group,
+            self.consumer,
+            self.batch_size,
+            self.block_ms,
+        )
+        by_stream = defaultdict(list)  # type: Dict[str, List[StreamMessage]]
+        for message in messages:
+            by_stream[message[0]].append(message)
+
+        bus = self.bus_factory()
+        for stream in COMMAND_STREAMS:
+            if by_stream[stream]:
+                self._handle(bus, stream, by_stream[stream])
+        return len(messages)
+
+    def _reclaim(self) -> List[StreamMessage]:
+        stale = self.broker.claim_stale(
+            list(COMMAND_STREAMS),
+            self.group,
+            self.consumer,
+            self.reclaim_idle_ms,
+            self.batch_size,
+        )
+        messages = []
+        for message, deliveries in stale:
+            stream, id, _ = message
+            if deliveries > self.max_deliveries:
+                logger.error(
+                    f"dropping {stream} {id} after {deliveries - 1} deliveries"
+                )
+                self.broker.ack(stream, self.group, [id])
+            else:
+                messages.append(message)
+        return messages
+
+    def _handle(self, bus, stream, messages):
+        command_type = COMMAND_STREAMS[stream]
+        done = []  # type: List[str]
+        batch = []  # type: List[Tuple[List[str], commands.Command]]
+        for _, id, fields in messages:
+            try:
+                command = serialization.loads(command_type, fields["data"])
+            except Exception:
+                logger.exception(f"dropping {stream} {id}, which cannot be read")
+                done.append(id)
+            else:
+                batch.append(([id], command))
+
+        if command_type is commands.Allocate:
+            # one transaction per sku instead of one per line
+            ids_by_sku = defaultdict(list)  # type: Dict[str, List[str]]
+            by_sku = defaultdict(list)  # type: Dict[str, List[commands.Allocate]]
+            for [id], command in batch:
+                ids_by_sku[command.sku].append(id)
+                by_sku[command.sku].append(command)
+            batch = [
+                (ids_by_sku[sku], commands.AllocateMany(lines))
+                for sku, lines in by_sku.items()
+            ]
+
+        for ids, command in batch:
+            try:
+                bus.handle(command)
+            except Exception as e:
+                # the bus has logged the traceback; ack it or leave it pending
+                if self.retry_policy.is_transient(e):
+                    logger.warning(f"{stream} {ids} left pending to retry: {e!r}")
+                    continue
+                logger.error(f"dropping {stream} {ids}, which failed for good: {e!r}")
+            done.extend(ids)
+
+        self.broker.ack(stream, self.group, done)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="handle commands from redis streams")
+    parser.add_argument("--group", default="allocation")
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument(
+        "--reclaim-idle-ms",
+        type=int,
+        default=60_000,
+        help="take over messages left pending for this long",
+    )
+    parser.add_argument("--max-deliveries", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    orm.start_mappers()
+    broker = RedisBroker()
+    consumer = StreamConsumer(
+        broker,
+        lambda: messagebus.MessageBus(
+            unit_of_work.SqlAlchemyUnitOfWork(), broker=broker
+        ),
+        group=args.group,
+        batch_size=args.batch_size,
+        reclaim_idle_ms=args.reclaim_idle_ms,
+        max_deliveries=args.max_deliveries,
+    )
+    logger.info(f"consuming {', '.join(COMMAND_STREAMS)} as {consumer.consumer}")
+    while True:
+        consumer.consume()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+import bisect
+import contextlib
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from allocation import config
+
+# checked at every instrumented call site; when off, timers are a shared no-op
+enabled = config.get_metrics_enabled()
+
+LATENCY_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+_NOT_TIMED = contextlib.nullcontext()
+
+
+class Metric:
+    type = ""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key: Tuple[str, ...], **extra) -> str:
+        pairs = list(zip(self.labelnames, key)) + list(extra.items())
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        return [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} {self.type}",
+            *self.samples(),
+        ]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values = {}  # type: Dict[Tuple[str, ...], float]
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f"{self.name}{self._labels(key)} {value}" for key, value in values]
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(self, name, help, function: Callable[[], float]):
+        # read when rendered, from state that is kept elsewhere anyway
+        super().__init__(name, help)
+        self.function = function
+
+    def samples(self):
+        return [f"{self.name} {self.function()}"]
+
+
+class CallbackCounter(Gauge):
+    # a running total kept elsewhere, read when rendered
+    type = "counter"
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+        # per label set: a count per bucket (and one for +Inf), sum
+        self._values = {}  # type: Dict[Tuple[str, ...], Tuple[List[int], list]]
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.setdefault(
+                key, ([0] * (len(self.buckets) + 1), [0.0])
+            )
+            counts[index] += 1
+            total[0] += value
+
+    def count(self, **labels) -> int:
+        with self._lock:
+            counts, _ = self._values.get(self._key(labels), ([], []))
+            return sum(counts)
+
+    def time(self, **labels):
+        if not enabled:
+            return _NOT_TIMED
+        return _Timer(self, labels)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(
+                (key, list(counts), total[0])
+                for key, (counts, total) in self._values.items()
+            )
+
+        lines = []
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append(
+                    f"{self.name}_bucket{self._labels(key, le=bound)} {cumulative}"
+                )
+            lines.append(f"{self.name}_sum{self._labels(key)} {total}")
+            lines.append(f"{self.name}_count{self._labels(key)} {cumulative}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram: Histogram, labels: Dict[str, str]):
+        self.histogram = histogram
+        self.labels = labels
+        self.start = None  # type: Optional[float]
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *args):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+registry = []  # type: List[Metric]
+
+
+def render() -> str:
+    return "\n".join(line for metric in registry for line in metric.render()) + "\n"
+
+
+HANDLER_SECONDS = Histogram(
+    "allocation_handler_seconds",
+    "Time spent in command and event handlers",
+    ("kind", "handler"),
+)
+QUEUE_DEPTH = Histogram(
+    "allocation_messagebus_queue_depth",
+    "Messages left in the bus queue as each one is taken off it",
+    buckets=COUNT_BUCKETS,
+)
+UOW_SECONDS = Histogram(
+    "allocation_uow_seconds",
+    "Time a unit of work stayed open, and spent committing or rolling back",
+    ("phase",),
+)
+UOW_STATEMENTS = Histogram(
+    "allocation_uow_statements",
+    "SQL statements executed per unit of work",
+    buckets=COUNT_BUCKETS,
+)
+ALLOCATE_BATCH_SIZE = Histogram(
+    "allocation_allocate_batch_size",
+    "Concurrent allocate requests for a sku committed together",
+    buckets=COUNT_BUCKETS,
+)
+DB_STATEMENTS = Counter(
+    "allocation_db_statements_total", "SQL statements executed", ("statement",)
+)
+DB_STATEMENT_SECONDS = Histogram(
+    "allocation_db_statement_seconds", "Time spent executing SQL", ("statement",)
+)
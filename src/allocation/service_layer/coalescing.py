@@ -0,0 +1,105 @@
+from __future__ import annotations
+
+import threading
+from concurrent.futures import Future
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional
+
+from allocation import metrics
+from allocation.domain import commands
+from allocation.service_layer.handlers import InvalidSku
+from allocation.service_layer.unit_of_work import ConcurrentModification
+
+if TYPE_CHECKING:
+    from allocation.service_layer.messagebus import AbstractMessageBus
+
+# raised by allocate_many before it commits: a lost race, or a line the domain
+# can't take. Anything else, like ShardDied or a failed publish, may come after
+# the commit, when running the lines again would allocate them twice
+LINE_ERRORS = (ConcurrentModification, TypeError, ValueError)
+
+
+class _Group:
+    def __init__(self):
+        self.commands = []  # type: List[commands.Allocate]
+        self.futures = []  # type: List[Future]
+        self.full = threading.Event()
+
+
+class AllocationCoalescer:
+    # group commit: the first request for a sku waits up to window_seconds for
+    # others, then allocates all of them on its own thread in a single unit of
+    # work; the rest wait for their share of the result
+    def __init__(
+        self,
+        bus_factory: Callable[[], AbstractMessageBus],
+        window_seconds: float = 0.002,
+        max_batch: int = 100,
+    ):
+        self.bus_factory = bus_factory
+        self.window_seconds = window_seconds
+        self.max_batch = max_batch
+        self._lock = threading.Lock()
+        self._open = {}  # type: Dict[str, _Group]
+
+    def allocate(self, command: commands.Allocate) -> Optional[str]:
+        future = Future()  # type: Future
+        with self._lock:
+            group = self._open.get(command.sku)
+            leader = group is None
+            if leader:
+                group = self._open[command.sku] = _Group()
+            group.commands.append(command)
+            group.futures.append(future)
+            if len(group.commands) >= self.max_batch:
+                del self._open[command.sku]
+                group.full.set()
+
+        if leader:
+            group.full.wait(self.window_seconds)
+            with self._lock:
+                if self._open.get(command.sku) is group:
+                    del self._open[command.sku]
+            try:
+                self._run(group)
+            except Exception as e:
+                # never leave the others waiting
+                for waiting in group.futures:
+                    if not waiting.done():
+                        waiting.set_exception(e)
+
+        return future.result()
+
+    def _run(self, group: _Group):
+        if metrics.enabled:
+            metrics.ALLOCATE_BATCH_SIZE.observe(len(group.commands))
+        bus = self.bus_factory()
+        if len(group.commands) == 1:
+            self._run_each(bus, group)
+            return
+
+        try:
+            [batchrefs] = bus.handle(commands.AllocateMany(group.commands))
+        except InvalidSku as e:
+            # the same sku for all of them
+            for future in group.futures:
+                future.set_exception(e)
+        except LINE_ERRORS:
+            # one line may have failed the whole group, so each caller gets the
+            # outcome of its own line, at the cost of a commit per line
+            self._run_each(self.bus_factory(), group)
+        except Exception as e:
+            for future in group.futures:
+                future.set_exception(e)
+        else:
+            for future, batchref in zip(group.futures, batchrefs):
+                future.set_result(batchref)
+
+    @staticmethod
+    def _run_each(bus: AbstractMessageBus, group: _Group):
+        for command, future in zip(group.commands, group.futures):
+            try:
+                batchref = bus.handle(command)[0]
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(batchref)
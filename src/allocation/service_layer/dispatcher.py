@@ -0,0 +1,74 @@
+from __future__ import annotations
+
+import contextlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Callable, Dict, Optional
+
+from allocation.service_layer.retries import handler_name
+
+if TYPE_CHECKING:
+    from allocation.service_layer.messagebus import AbstractMessageBus
+
+logger = logging.getLogger(__name__)
+
+
+class EventDispatcher:
+    def __init__(
+        self,
+        bus_factory: Callable[[], AbstractMessageBus],
+        max_workers: int = 4,
+        max_pending: int = 1000,
+        # by handler name, so they match the functools.partials that publish
+        handler_limits: Optional[Dict[str, int]] = None,
+    ):
+        self.bus_factory = bus_factory
+        # a thread per partition, and a sku's events always go to the same one,
+        # so its handlers run in the order the events were raised: the read
+        # model never sees a line deallocated before it was allocated
+        self._partitions = [
+            ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"event-worker-{i}")
+            for i in range(max_workers)
+        ]
+        # dispatch() blocks once max_pending handler runs are queued or running
+        self._pending = threading.BoundedSemaphore(max_pending)
+        self._handler_limits = {
+            name: threading.BoundedSemaphore(limit)
+            for name, limit in (handler_limits or {}).items()
+        }
+        self._closed = False
+
+    def dispatch(self, handler: Callable, event, attempt: int = 1):
+        if self._closed:
+            raise RuntimeError("EventDispatcher has been shut down")
+
+        self._pending.acquire()
+        try:
+            self._partition(event).submit(self._run, handler, event, attempt)
+        except Exception:
+            self._pending.release()
+            raise
+
+    def _partition(self, event) -> ThreadPoolExecutor:
+        # coalescing handlers take a list of events for one sku
+        first = event[0] if isinstance(event, list) else event
+        key = getattr(first, "sku", None) or getattr(first, "ref", "")
+        return self._partitions[hash(key) % len(self._partitions)]
+
+    def _run(self, handler: Callable, event, attempt: int):
+        limit = self._handler_limits.get(handler_name(handler))
+        try:
+            with limit or contextlib.nullcontext():
+                # each run gets its own bus and unit of work, which handles any
+                # follow-up messages inline on this worker thread
+                self.bus_factory().run_handler(handler, event, attempt)
+        except Exception:
+            logger.exception(f"Exception running {handler} for {event}")
+        finally:
+            self._pending.release()
+
+    def shutdown(self, wait: bool = True):
+        self._closed = True
+        for partition in self._partitions:
+            partition.shutdown(wait=wait)
@@ -1,19 +1,25 @@
 from __future__ import annotations
 
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
 
-from allocation.adapters import email
+from allocation import config
+from allocation.adapters import email, serialization
 from allocation.domain import (
+    Allocated,
     AllocationRequired,
     BatchCreated,
     BatchQuantityChanged,
+    Deallocated,
+    Event,
     OutOfStock,
 )
+from allocation.domain.commands import AllocateMany, ImportBatches
 from allocation.domain.model import Batch, OrderLine, Product
-
-from . import messagebus
+from allocation.service_layer.retries import CONFLICT_RETRIES
+from allocation.service_layer.unit_of_work import ConcurrentModification
 
 if TYPE_CHECKING:
+    from allocation.adapters.broker import AbstractBroker
     from . import unit_of_work
 
 
@@ -25,16 +31,31 @@ def add_batch(
     event: BatchCreated,
     uow: unit_of_work.AbstractUnitOfWork,
 ):
-    with uow:
+    for attempt in CONFLICT_RETRIES.attempts():
+        with attempt, uow:
+            product = uow.products.get(sku=event.sku)
 
-        product = uow.products.get(sku=event.sku)
+            if product is None:
+                product = Product(event.sku, batches=[])
+                uow.products.add(product)
 
-        if product is None:
-            product = Product(event.sku, batches=[])
-            uow.products.add(product)
+            product.add_batch(Batch(event.ref, event.sku, event.qty, event.eta))
+            uow.commit()
 
-        product.batches.append(Batch(event.ref, event.sku, event.qty, event.eta))
-        uow.commit()
+
+def import_batches(
+    command: ImportBatches,
+    uow: unit_of_work.AbstractUnitOfWork,
+):
+    # written straight to the tables, grouped by sku, without loading products
+    batches = sorted(
+        (BatchCreated(c.ref, c.sku, c.qty, c.eta) for c in command.batches),
+        key=lambda b: b.sku,
+    )
+    for attempt in CONFLICT_RETRIES.attempts():
+        with attempt, uow:
+            uow.products.add_batches(batches)
+            uow.commit()
 
 
 def allocate(
@@ -43,26 +64,88 @@ def allocate(
 ) -> str:
     line = OrderLine(event.orderid, event.sku, event.qty)
 
+    for attempt in CONFLICT_RETRIES.attempts():
+        with attempt, uow:
+            product = uow.products.get(sku=line.sku)
+
+            if product is None:
+                raise InvalidSku(f"Invalid sku {line.sku}")
+
+            batchref = product.allocate(line)
+
+            uow.commit()
+
+    return batchref
+
+
+def allocate_many(
+    command: AllocateMany,
+    uow: unit_of_work.AbstractUnitOfWork,
+) -> List[Optional[str]]:
+    lines_by_sku = {}  # type: Dict[str, List[Tuple[int, OrderLine]]]
+    for position, cmd in enumerate(command.lines):
+        line = OrderLine(cmd.orderid, cmd.sku, cmd.qty)
+        lines_by_sku.setdefault(line.sku, []).append((position, line))
+
+    batchrefs = [None] * len(command.lines)  # type: List[Optional[str]]
+
     with uow:
-        product = uow.products.get(sku=line.sku)
+        # every sku is looked up before the first commit, so an unknown one fails
+        # the whole command rather than leaving the skus before it allocated
+        products = {sku: uow.products.get(sku=sku) for sku in lines_by_sku}
+        for sku, product in products.items():
+            if product is None:
+                raise InvalidSku(f"Invalid sku {sku}")
+
+        for sku, lines in lines_by_sku.items():
+            for attempt in CONFLICT_RETRIES.attempts():
+                with attempt:
+                    # reloaded when retrying a conflict
+                    product = products.pop(sku, None) or uow.products.get(sku=sku)
+
+                    for position, line in lines:
+                        batchrefs[position] = product.allocate(line)
+
+                    try:
+                        uow.commit()
+                    except ConcurrentModification:
+                        # the retry reloads this product; drop what the failed
+                        # attempt recorded so it is not published
+                        product.events.clear()
+                        raise
+
+    return batchrefs
+
+
+def reallocate(
+    events: List[AllocationRequired],
+    uow: unit_of_work.AbstractUnitOfWork,
+):
+    sku = events[0].sku
 
-        if product is None:
-            raise InvalidSku(f"Invalid sku {line.sku}")
+    for attempt in CONFLICT_RETRIES.attempts():
+        with attempt, uow:
+            product = uow.products.get(sku=sku)
 
-        batchref = product.allocate(line)
+            if product is None:
+                raise InvalidSku(f"Invalid sku {sku}")
 
-        uow.commit()
-        return batchref
+            for event in events:
+                product.allocate(OrderLine(event.orderid, event.sku, event.qty))
+
+            uow.commit()
 
 
 def change_batch_quantity(
     event: BatchQuantityChanged,
     uow: unit_of_work.AbstractUnitOfWork,
 ):
-    with uow:
-        product = uow.products.get_by_batchref(batchref=event.ref)
-        product.change_batch_quantity(ref=event.ref, qty=event.qty)
-        uow.commit()
+    policy = config.get_deallocation_policy()
+    for attempt in CONFLICT_RETRIES.attempts():
+        with attempt, uow:
+            product = uow.products.get_by_batchref(batchref=event.ref)
+            product.change_batch_quantity(ref=event.ref, qty=event.qty, policy=policy)
+            uow.commit()
 
 
 def send_out_of_stock_notification(
@@ -70,3 +153,40 @@ def send_out_of_stock_notification(
     uow: unit_of_work.AbstractUnitOfWork,
 ):
     email.send_mail("stock@made.com", f"Out of stock fr {event.sku}")
+
+
+def publish_events(
+    events: List[Event],
+    uow: unit_of_work.AbstractUnitOfWork,
+    broker: AbstractBroker,
+):
+    broker.publish(
+        serialization.channel_name(type(events[0])),
+        [dict(data=serialization.dumps(event)) for event in events],
+    )
+
+
+def publish_event(
+    event: Event,
+    uow: unit_of_work.AbstractUnitOfWork,
+    broker: AbstractBroker,
+):
+    publish_events([event], uow, broker)
+
+
+def add_allocations_to_read_model(
+    events: List[Allocated],
+    uow: unit_of_work.AbstractUnitOfWork,
+):
+    with uow:
+        uow.allocations_view.add((e.orderid, e.sku, e.batchref) for e in events)
+        uow.commit()
+
+
+def remove_allocations_from_read_model(
+    events: List[Deallocated],
+    uow: unit_of_work.AbstractUnitOfWork,
+):
+    with uow:
+        uow.allocations_view.remove((e.orderid, e.sku, e.batchref) for e in events)
+        uow.commit()
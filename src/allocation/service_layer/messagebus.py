@@ -1,9 +1,30 @@
-from typing import Callable, Dict, List, Type, Union
+from __future__ import annotations
+
+import functools
+from collections import deque
+from typing import (
+    TYPE_CHECKING,
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Type,
+    Union,
+)
 import logging
 
+from sqlalchemy.util import greenlet_spawn
+
+from allocation import metrics
 from allocation.domain import commands, events
-from allocation.service_layer import handlers, unit_of_work
-from tenacity import Retrying, RetryError, stop_after_attempt, wait_exponential
+from allocation.service_layer import handlers, retries, unit_of_work
+from allocation.service_layer.retries import DelayQueue, RetryPolicy, handler_name
+
+if TYPE_CHECKING:
+    from allocation.adapters.broker import AbstractBroker
+    from allocation.service_layer.dispatcher import EventDispatcher
 
 Message = Union[commands.Command, events.Event]
 
@@ -13,57 +34,155 @@ logger = logging.getLogger(__name__)
 class AbstractMessageBus:
     EVENT_HANDLERS: Dict[Type[events.Event], List[Callable]]
     COMMAND_HANDLERS: Dict[Type[commands.Command], Callable]
+    # handlers that take every queued event of a type for the same sku at once
+    COALESCING_EVENT_HANDLERS = {}  # type: Dict[Type[events.Event], List[Callable]]
+    RETRY_POLICIES = {}  # type: Dict[Callable, RetryPolicy]
+    DEFAULT_RETRY_POLICY = RetryPolicy()
 
-    def __init__(self, uow: unit_of_work.AbstractUnitOfWork):
+    def __init__(
+        self,
+        uow: unit_of_work.AbstractUnitOfWork,
+        dispatcher: Optional[EventDispatcher] = None,
+        retry_queue: Optional[DelayQueue] = None,
+    ):
         self.uow = uow
+        self.dispatcher = dispatcher
+        self.retry_queue = retry_queue
+        self._routes = {}  # type: Dict[type, Callable]
 
     def handle(self, message: Message):
+        return self._process(deque([message]))
+
+    def handle_events(self, new_events: Iterable[events.Event]):
+        # queued together, so coalescing handlers see the whole batch
+        self._process(deque(new_events))
+
+    def run_handler(self, handler: Callable, event, attempt: int = 1):
+        queue = deque()  # type: Deque[Message]
+        self._run_handler(handler, event, queue, self.uow, attempt)
+        self._process(queue)
+
+    def _process(self, queue: Deque[Message]) -> list:
         results = []
-        queue = [message]
 
         while queue:
-            message = queue.pop(0)
+            message = queue.popleft()
+            if metrics.enabled:
+                metrics.QUEUE_DEPTH.observe(len(queue))
+            route = self._routes.get(type(message)) or self._route(message)
+            route(message, queue, results)
+
+        return results
+
+    def _route(self, message: Message) -> Callable:
+        # resolved once per message type, then served from self._routes
+        if type(message) in self.COALESCING_EVENT_HANDLERS:
+            handlers_ = self.COALESCING_EVENT_HANDLERS[type(message)]
+
+            def route(event, queue, results):
+                coalesced = self._coalesce(event, queue)
+                self.handle_event(coalesced, queue, self.uow, handlers_)
+
+        elif isinstance(message, events.Event):
+            handlers_ = self.EVENT_HANDLERS[type(message)]
+
+            def route(event, queue, results):
+                self.handle_event(event, queue, self.uow, handlers_)
 
-            if isinstance(message, events.Event):
-                self.handle_event(message, queue, self.uow)
-            elif isinstance(message, commands.Command):
-                cmd_result = self.handle_command(message, queue, self.uow)
-                results.append(cmd_result)
+        elif isinstance(message, commands.Command):
+            handler = self.COMMAND_HANDLERS[type(message)]
+
+            def route(command, queue, results):
+                results.append(self.handle_command(command, queue, self.uow, handler))
+
+        else:
+            raise Exception(f"{message} was not an Event or Command")
+
+        self._routes[type(message)] = route
+        return route
+
+    @staticmethod
+    def _coalesce(event: events.Event, queue: Deque[Message]) -> List[events.Event]:
+        coalesced = [event]  # type: List[events.Event]
+        remaining = deque()  # type: Deque[Message]
+        for message in queue:
+            if type(message) is type(event) and message.sku == event.sku:
+                coalesced.append(message)
             else:
-                raise Exception(f"{message} was not an Event or Command")
+                remaining.append(message)
 
-        return results
+        queue.clear()
+        queue.extend(remaining)
+        return coalesced
 
     def handle_event(
         self,
         event: events.Event,
-        queue: List[Message],
+        queue: Deque[Message],
         uow: unit_of_work.AbstractUnitOfWork,
+        handlers_: List[Callable] = None,
     ):
-        for handler in self.EVENT_HANDLERS[type(event)]:
+        if handlers_ is None:
+            handlers_ = self.EVENT_HANDLERS[type(event)]
+
+        for handler in handlers_:
+            if self.dispatcher is not None:
+                self.dispatcher.dispatch(handler, event)
+            else:
+                self._run_handler(handler, event, queue, uow)
+
+    def _run_handler(
+        self,
+        handler: Callable,
+        event,
+        queue: Deque[Message],
+        uow: unit_of_work.AbstractUnitOfWork,
+        attempt: int = 1,
+    ):
+        policy = self.RETRY_POLICIES.get(
+            getattr(handler, "func", handler), self.DEFAULT_RETRY_POLICY
+        )
+        while True:
             try:
-                for attempt in Retrying(
-                    stop=stop_after_attempt(3), wait=wait_exponential()
+                logger.debug(f"handling event {event} with handler {handler}")
+                with metrics.HANDLER_SECONDS.time(
+                    kind="event", handler=handler_name(handler)
                 ):
-                    with attempt:
-                        logger.debug(f"handling event {event} with handler {handler}")
-                        handler(event, uow=uow)
-                        queue.extend(uow.collect_new_events())
-            except Exception:
-                logger.exception(f"Exception handling event {event}")
-                continue
+                    handler(event, uow=uow)
+                queue.extend(uow.collect_new_events())
+                return
+            except Exception as e:
+                transient = policy.is_transient(e)
+                if not transient or attempt >= policy.max_attempts:
+                    retries.metrics.record_failure(handler, transient)
+                    logger.exception(f"Exception handling event {event}")
+                    return
+
+                delay = policy.delay(attempt)
+                retries.metrics.record_retry(handler, delay)
+                attempt += 1
+                if self.retry_queue is not None:
+                    # backs off on the scheduler's thread, not this one
+                    self.retry_queue.schedule(delay, handler, event, attempt)
+                    return
+                retries.pause(delay)
 
     def handle_command(
         self,
         command: commands.Command,
-        queue: List[Message],
+        queue: Deque[Message],
         uow: unit_of_work.AbstractUnitOfWork,
+        handler: Callable = None,
     ):
         logger.debug(f"Handling command {command}")
 
         try:
-            handler = self.COMMAND_HANDLERS[type(command)]
-            result = handler(command, uow=uow)
+            if handler is None:
+                handler = self.COMMAND_HANDLERS[type(command)]
+            with metrics.HANDLER_SECONDS.time(
+                kind="command", handler=handler_name(handler)
+            ):
+                result = handler(command, uow=uow)
             queue.extend(uow.collect_new_events())
             return result
         except Exception:
@@ -74,10 +193,75 @@ class AbstractMessageBus:
 class MessageBus(AbstractMessageBus):
     EVENT_HANDLERS = {
         events.OutOfStock: [handlers.send_out_of_stock_notification],
+        events.BatchCreated: [],
+        events.BatchQuantityChanged: [],
+    }  # type: Dict[Type[events.Event], List[Callable]]
+
+    COALESCING_EVENT_HANDLERS = {
+        events.Allocated: [handlers.add_allocations_to_read_model],
+        events.Deallocated: [handlers.remove_allocations_from_read_model],
+        events.AllocationRequired: [handlers.reallocate],
     }  # type: Dict[Type[events.Event], List[Callable]]
 
     COMMAND_HANDLERS = {
         commands.Allocate: handlers.allocate,
+        commands.AllocateMany: handlers.allocate_many,
         commands.CreateBatch: handlers.add_batch,
+        commands.ImportBatches: handlers.import_batches,
         commands.ChangeBatchQuantity: handlers.change_batch_quantity,
     }  # type: Dict[Type[commands.Command], Callable]
+
+    RETRY_POLICIES = {
+        # mail and broker outages last longer than a lost race on a row
+        handlers.send_out_of_stock_notification: RetryPolicy(
+            max_attempts=5, base_delay=1.0, max_delay=60.0, transient=(OSError,)
+        ),
+        handlers.publish_events: RetryPolicy(
+            max_attempts=5, base_delay=0.5, max_delay=30.0, transient=(Exception,)
+        ),
+        handlers.publish_event: RetryPolicy(
+            max_attempts=5, base_delay=0.5, max_delay=30.0, transient=(Exception,)
+        ),
+    }  # type: Dict[Callable, RetryPolicy]
+
+    # sent to the broker, when the bus has one
+    PUBLISHED_EVENTS = (events.Allocated, events.Deallocated, events.OutOfStock)
+
+    def __init__(
+        self,
+        uow: unit_of_work.AbstractUnitOfWork,
+        dispatcher: Optional[EventDispatcher] = None,
+        broker: Optional[AbstractBroker] = None,
+        retry_queue: Optional[DelayQueue] = None,
+    ):
+        super().__init__(uow, dispatcher, retry_queue)
+        if broker is not None:
+            self._publish_to(broker)
+
+    def _publish_to(self, broker: AbstractBroker):
+        # copied, so buses without a broker keep the class-level handlers
+        self.EVENT_HANDLERS = dict(self.EVENT_HANDLERS)
+        self.COALESCING_EVENT_HANDLERS = dict(self.COALESCING_EVENT_HANDLERS)
+        for event_type in self.PUBLISHED_EVENTS:
+            if event_type in self.COALESCING_EVENT_HANDLERS:
+                # coalesced events for a sku go out in a single round trip
+                self.COALESCING_EVENT_HANDLERS[event_type] = [
+                    *self.COALESCING_EVENT_HANDLERS[event_type],
+                    functools.partial(handlers.publish_events, broker=broker),
+                ]
+            else:
+                self.EVENT_HANDLERS[event_type] = [
+                    *self.EVENT_HANDLERS.get(event_type, []),
+                    functools.partial(handlers.publish_event, broker=broker),
+                ]
+
+
+class AsyncMessageBus:
+    # runs a bus in a greenlet, as AsyncSession.run_sync does: the handlers stay
+    # synchronous, and each database call they make through an async driver
+    # gives way to the other requests on the event loop until it returns
+    def __init__(self, bus: AbstractMessageBus):
+        self.bus = bus
+
+    async def handle(self, message: Message):
+        return await greenlet_spawn(self.bus.handle, message)
@@ -0,0 +1,217 @@
+from __future__ import annotations
+
+import asyncio
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import (
+    TYPE_CHECKING,
+    Callable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Type,
+)
+
+from sqlalchemy.exc import DBAPIError, MissingGreenlet, OperationalError
+from sqlalchemy.util import await_only
+
+from allocation.service_layer.unit_of_work import ConcurrentModification
+
+if TYPE_CHECKING:
+    from allocation.service_layer.dispatcher import EventDispatcher
+    from allocation.service_layer.messagebus import AbstractMessageBus
+
+logger = logging.getLogger(__name__)
+
+# worth another try; anything else (InvalidSku, bugs) fails the same way again.
+# ConcurrentModification is left out: handlers retry their own unit of work on
+# a conflict, by CONFLICT_RETRIES, and a second layer here would multiply them
+TRANSIENT_ERRORS = (
+    OperationalError,
+    ConnectionError,
+    TimeoutError,
+)  # type: Tuple[Type[BaseException], ...]
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    max_attempts: int = 3
+    base_delay: float = 0.05
+    max_delay: float = 2.0
+    transient: Tuple[Type[BaseException], ...] = TRANSIENT_ERRORS
+
+    def is_transient(self, error: BaseException) -> bool:
+        if isinstance(error, DBAPIError) and error.connection_invalidated:
+            return True
+        return isinstance(error, self.transient)
+
+    def delay(self, attempt: int) -> float:
+        # exponential backoff with full jitter
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+    def attempts(self) -> Iterator[Attempt]:
+        # for attempt in policy.attempts(): with attempt: ...
+        # runs the block again, after a backoff, while it fails transiently
+        for number in itertools.count(1):
+            attempt = Attempt(self, number)
+            yield attempt
+            if attempt.delay is None:
+                return
+            pause(attempt.delay)
+
+
+class Attempt:
+    def __init__(self, policy: RetryPolicy, number: int):
+        self.policy = policy
+        self.number = number
+        self.delay = None  # type: Optional[float]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc is None or self.number >= self.policy.max_attempts:
+            return False
+        if not self.policy.is_transient(exc):
+            return False
+        self.delay = self.policy.delay(self.number)
+        return True
+
+
+# another writer bumped the product's version first: reload and try again
+CONFLICT_RETRIES = RetryPolicy(
+    max_attempts=5,
+    base_delay=0.01,
+    max_delay=0.2,
+    transient=(ConcurrentModification,),
+)
+
+
+def pause(seconds: float):
+    # handlers run by an AsyncMessageBus wait on its event loop, so the requests
+    # on the other greenlets go ahead; everywhere else, the thread sleeps
+    sleep = asyncio.sleep(seconds)
+    try:
+        await_only(sleep)
+    except MissingGreenlet:
+        sleep.close()
+        time.sleep(seconds)
+
+
+def handler_name(handler: Callable) -> str:
+    return getattr(handler, "func", handler).__name__
+
+
+class RetryMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.retries = Counter()  # type: Counter[str]
+        self.gave_up = Counter()  # type: Counter[str]
+        self.permanent_failures = Counter()  # type: Counter[str]
+        self.backoff_seconds = 0.0
+
+    def record_retry(self, handler: Callable, delay: float):
+        with self._lock:
+            self.retries[handler_name(handler)] += 1
+            self.backoff_seconds += delay
+
+    def record_failure(self, handler: Callable, transient: bool):
+        with self._lock:
+            failures = self.gave_up if transient else self.permanent_failures
+            failures[handler_name(handler)] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return dict(
+                retries=dict(self.retries),
+                gave_up=dict(self.gave_up),
+                permanent_failures=dict(self.permanent_failures),
+                backoff_seconds=self.backoff_seconds,
+            )
+
+
+metrics = RetryMetrics()
+
+
+class DelayQueue:
+    def __init__(
+        self,
+        bus_factory: Callable[[], AbstractMessageBus],
+        dispatcher: Optional[EventDispatcher] = None,
+        max_workers: int = 4,
+    ):
+        self.bus_factory = bus_factory
+        # the scheduler thread only keeps time: due retries run on the
+        # dispatcher's workers, or on a pool of their own, so one slow handler
+        # doesn't hold up every other retry that is due
+        self.dispatcher = dispatcher
+        self._executor = None  # type: Optional[ThreadPoolExecutor]
+        if dispatcher is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=max_workers, thread_name_prefix="retry-worker"
+            )
+        self._heap = []  # type: List[tuple]
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(
+            target=self._run, name="retry-scheduler", daemon=True
+        )
+        self._thread.start()
+
+    def schedule(self, delay: float, handler: Callable, event, attempt: int):
+        due = time.monotonic() + delay
+        with self._condition:
+            heapq.heappush(
+                self._heap, (due, next(self._sequence), handler, event, attempt)
+            )
+            self._condition.notify()
+
+    def __len__(self):
+        with self._condition:
+            return len(self._heap)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._closed:
+                    timeout = None
+                    if self._heap:
+                        timeout = self._heap[0][0] - time.monotonic()
+                        if timeout <= 0:
+                            break
+                    self._condition.wait(timeout)
+                if self._closed:
+                    return
+                _, _, handler, event, attempt = heapq.heappop(self._heap)
+
+            try:
+                if self.dispatcher is not None:
+                    self.dispatcher.dispatch(handler, event, attempt)
+                else:
+                    self._executor.submit(self._retry, handler, event, attempt)
+            except Exception:
+                logger.exception(f"Exception retrying {handler} for {event}")
+
+    def _retry(self, handler: Callable, event, attempt: int):
+        try:
+            # a fresh bus and unit of work, as the original ones may be gone
+            self.bus_factory().run_handler(handler, event, attempt)
+        except Exception:
+            logger.exception(f"Exception retrying {handler} for {event}")
+
+    def shutdown(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+        if self._executor is not None:
+            self._executor.shutdown()
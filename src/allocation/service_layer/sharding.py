@@ -0,0 +1,258 @@
+import itertools
+import logging
+import multiprocessing
+import pickle
+import queue
+import threading
+import zlib
+from collections import OrderedDict, defaultdict
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import select
+
+from allocation import config
+from allocation.adapters import broker, orm, repository
+from allocation.domain import commands
+from allocation.service_layer import messagebus, unit_of_work
+
+logger = logging.getLogger(__name__)
+
+
+class ShardDied(Exception):
+    pass
+
+
+def shard_for(sku: str, shards: int) -> int:
+    # stable across processes and restarts, unlike hash()
+    return zlib.crc32(sku.encode()) % shards
+
+
+def default_bus_factory() -> messagebus.AbstractMessageBus:
+    # runs in each worker. Other processes (the apps, the stream consumer, the
+    # outbox and import paths) still write the same products, so the cache is
+    # kept valid by the version check in CachingSqlAlchemyRepository._get
+    orm.start_mappers()
+    cache_options = config.get_product_cache_options() or {}
+    product_cache = repository.ProductCache(**cache_options)
+    return messagebus.MessageBus(
+        unit_of_work.SqlAlchemyUnitOfWork(product_cache=product_cache),
+        broker=broker.get_broker(),
+    )
+
+
+def sku_of_batch(batchref: str) -> Optional[str]:
+    # just the sku, rather than the whole product with all of its batches
+    if config.get_event_sourcing_options():
+        sku, reference = orm.product_events.c.sku, orm.product_events.c.batchref
+    else:
+        sku, reference = orm.batches.c.sku, orm.batches.c.reference
+    with unit_of_work.get_session_factory()() as session:
+        query = select(sku).where(reference == batchref).limit(1)
+        return session.execute(query).scalar()
+
+
+def _run_shard(bus_factory, inbox, replies):
+    bus = bus_factory()
+    while True:
+        request = inbox.get()
+        if request is None:
+            return
+        request_id, command = request
+        try:
+            replies.put((request_id, bus.handle(command), None))
+        except Exception as e:
+            try:
+                pickle.dumps(e)
+            except Exception:
+                e = RuntimeError(repr(e))
+            replies.put((request_id, None, e))
+
+
+class ShardedMessageBus:
+    def __init__(
+        self,
+        shards: int,
+        bus_factory: Callable[[], messagebus.AbstractMessageBus] = None,
+        sku_for_batchref: Callable[[str], Optional[str]] = sku_of_batch,
+        max_cached_batches: int = 100_000,
+        liveness_interval: float = 1.0,
+    ):
+        self.shards = shards
+        self.bus_factory = bus_factory or default_bus_factory
+        self.sku_for_batchref = sku_for_batchref
+        self.max_cached_batches = max_cached_batches
+        self.liveness_interval = liveness_interval
+        self._batch_skus = OrderedDict()  # type: OrderedDict[str, str]
+        self._pending = {}  # type: Dict[int, Tuple[int, Future]]
+        self._lock = threading.Lock()
+        self._request_ids = itertools.count()
+        self._closing = False
+
+        # spawned, not forked: workers must not share the parent's connections
+        self._context = multiprocessing.get_context("spawn")
+        self._replies = self._context.Queue()
+        self._inboxes = [None] * shards  # type: List[multiprocessing.Queue]
+        self._workers = [None] * shards  # type: List[multiprocessing.Process]
+        for shard in range(shards):
+            self._start_worker(shard)
+        self._reader = threading.Thread(target=self._read_replies, daemon=True)
+        self._reader.start()
+
+    def _start_worker(self, shard: int):
+        # a fresh inbox, so a replacement never runs what its predecessor was sent
+        self._inboxes[shard] = self._context.Queue()
+        self._workers[shard] = self._context.Process(
+            target=_run_shard,
+            args=(self.bus_factory, self._inboxes[shard], self._replies),
+            name=f"shard-{shard}",
+            daemon=True,
+        )
+        self._workers[shard].start()
+
+    def handle(self, command: commands.Command) -> list:
+        if isinstance(command, commands.AllocateMany):
+            return [self._allocate_many(command)]
+
+        if isinstance(command, commands.ImportBatches):
+            return [self._import_batches(command)]
+
+        return self._send(self._shard_of(command), command).result()
+
+    def _import_batches(self, command: commands.ImportBatches):
+        by_shard = defaultdict(list)  # type: Dict[int, List[commands.CreateBatch]]
+        for batch in command.batches:
+            self._remember_sku(batch.ref, batch.sku)
+            by_shard[shard_for(batch.sku, self.shards)].append(batch)
+
+        futures = [
+            self._send(shard, commands.ImportBatches(batches))
+            for shard, batches in by_shard.items()
+        ]
+        for future in futures:
+            future.result()
+
+    def _allocate_many(self, command: commands.AllocateMany) -> List[Optional[str]]:
+        by_shard = defaultdict(list)  # type: Dict[int, List[int]]
+        for position, line in enumerate(command.lines):
+            by_shard[shard_for(line.sku, self.shards)].append(position)
+
+        futures = []
+        for shard, positions in by_shard.items():
+            lines = [command.lines[p] for p in positions]
+            future = self._send(shard, commands.AllocateMany(lines))
+            futures.append((positions, future))
+
+        batchrefs = [None] * len(command.lines)  # type: List[Optional[str]]
+        for positions, future in futures:
+            [shard_batchrefs] = future.result()
+            for position, batchref in zip(positions, shard_batchrefs):
+                batchrefs[position] = batchref
+        return batchrefs
+
+    def _shard_of(self, command: commands.Command) -> int:
+        if isinstance(command, commands.ChangeBatchQuantity):
+            with self._lock:
+                sku = self._batch_skus.get(command.ref)
+                if sku is not None:
+                    self._batch_skus.move_to_end(command.ref)
+            if sku is None:
+                sku = self.sku_for_batchref(command.ref)
+                if sku is None:
+                    # not cached: the batch may yet be created, for some other sku
+                    return shard_for(command.ref, self.shards)
+                # a batch never moves to another sku, so this is safe to keep
+                self._remember_sku(command.ref, sku)
+            return shard_for(sku, self.shards)
+
+        if isinstance(command, commands.CreateBatch):
+            self._remember_sku(command.ref, command.sku)
+        return shard_for(command.sku, self.shards)
+
+    def _remember_sku(self, batchref: str, sku: str):
+        with self._lock:
+            self._batch_skus[batchref] = sku
+            self._batch_skus.move_to_end(batchref)
+            while len(self._batch_skus) > self.max_cached_batches:
+                self._batch_skus.popitem(last=False)
+
+    def _send(self, shard: int, command: commands.Command) -> Future:
+        future = Future()  # type: Future
+        with self._lock:
+            request_id = next(self._request_ids)
+            self._pending[request_id] = (shard, future)
+            # under the lock, so it can't go to the inbox of a worker just replaced
+            self._inboxes[shard].put((request_id, command))
+        return future
+
+    def _read_replies(self):
+        while True:
+            try:
+                reply = self._replies.get(timeout=self.liveness_interval)
+            except queue.Empty:
+                reply = ()
+            if reply is None:
+                return
+            if reply:
+                self._deliver(reply)
+            self._check_workers()
+
+    def _deliver(self, reply):
+        request_id, result, error = reply
+        with self._lock:
+            _, future = self._pending.pop(request_id, (None, None))
+        if future is None:
+            # already failed, its worker having died
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def _check_workers(self):
+        dead = [
+            shard
+            for shard, worker in enumerate(self._workers)
+            if not worker.is_alive()
+        ]
+        if not dead or self._closing:
+            return
+
+        # whatever the dead workers finished may still be on its way
+        while True:
+            try:
+                reply = self._replies.get_nowait()
+            except queue.Empty:
+                break
+            if reply is None:
+                self._replies.put(None)
+                return
+            self._deliver(reply)
+
+        failed = []
+        with self._lock:
+            if self._closing:
+                return
+            for shard in dead:
+                logger.error(
+                    f"shard {shard} worker died with exit code "
+                    f"{self._workers[shard].exitcode}, restarting it"
+                )
+                # not resubmitted: the worker may have committed some of them
+                for request_id, (owner, future) in list(self._pending.items()):
+                    if owner == shard:
+                        del self._pending[request_id]
+                        failed.append(future)
+                self._start_worker(shard)
+        for future in failed:
+            future.set_exception(ShardDied("the worker for this shard died"))
+
+    def close(self):
+        with self._lock:
+            self._closing = True
+        for inbox in self._inboxes:
+            inbox.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._replies.put(None)
+        self._reader.join()
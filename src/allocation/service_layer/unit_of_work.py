@@ -2,18 +2,46 @@
 from __future__ import annotations
 
 import abc
-from typing import Protocol
-from sqlalchemy import create_engine
+import contextvars
+import functools
+import threading
+import time
+from typing import Protocol, Set
+from sqlalchemy import create_engine, event, inspect
+from sqlalchemy.exc import DBAPIError, IntegrityError
+from sqlalchemy.ext.asyncio import create_async_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm.exc import StaleDataError
 from sqlalchemy.orm.session import Session
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
 
 
-from allocation import config
-from allocation.adapters.repository import AbstractRepository, SqlAlchemyRepository
+from allocation import config, metrics
+from allocation.adapters.event_store import EventSourcedRepository
+from allocation.adapters.outbox import SqlAlchemyOutbox
+from allocation.domain import model
+from allocation.adapters.repository import (
+    AbstractRepository,
+    CachingSqlAlchemyRepository,
+    InMemoryRepository,
+    InMemoryStore,
+    ProductCache,
+    SqlAlchemyRepository,
+)
+from allocation.adapters.views import (
+    AbstractAllocationsView,
+    InMemoryAllocationsView,
+    SqlAlchemyAllocationsView,
+)
+
+
+class ConcurrentModification(Exception):
+    pass
 
 
 class AbstractUnitOfWork(Protocol):
     products: AbstractRepository
+    allocations_view: AbstractAllocationsView
 
     def __enter__(self) -> AbstractUnitOfWork:
         return self
@@ -26,8 +54,13 @@ class AbstractUnitOfWork(Protocol):
 
     def collect_new_events(self):
         for product in self.products.seen:
-            while product.events:
-                yield product.events.pop(0)
+            if product.events:
+                # swap the list out instead of popping from its head
+                new_events, product.events = product.events, []
+                yield from new_events
+        if self.products.events:
+            new_events, self.products.events = self.products.events, []
+            yield from new_events
 
     @abc.abstractmethod
     def _commit(self):
@@ -38,29 +71,249 @@ class AbstractUnitOfWork(Protocol):
         raise NotImplementedError
 
 
-DEFAULT_SESSION_FACTORY = sessionmaker(
-    bind=create_engine(
+def is_serialization_failure(error: DBAPIError) -> bool:
+    # SQLSTATE 40001, raised by Postgres under REPEATABLE READ and SERIALIZABLE
+    return getattr(error.orig, "pgcode", None) == "40001"
+
+
+def is_duplicate_product(error: DBAPIError) -> bool:
+    # two requests adding the same new product both insert it; the loser's
+    # primary key violation is a conflict, and its retry finds the product.
+    # Any other constraint, like a duplicate batch reference, is a real error
+    if not isinstance(error, IntegrityError):
+        return False
+    diag = getattr(error.orig, "diag", None)  # psycopg2
+    if diag is not None and diag.constraint_name:
+        return diag.constraint_name == "products_pkey"
+    # sqlite, and asyncpg as sqlalchemy wraps it
+    message = str(error.orig)
+    return "products.sku" in message or '"products_pkey"' in message
+
+
+class MeteredQueuePool(QueuePool):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._metrics_lock = threading.Lock()
+        self.checkouts = 0
+        self.checkout_wait_seconds = 0.0
+        self.max_checkout_wait_seconds = 0.0
+
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            return super().connect()
+        finally:
+            waited = time.perf_counter() - start
+            with self._metrics_lock:
+                self.checkouts += 1
+                self.checkout_wait_seconds += waited
+                self.max_checkout_wait_seconds = max(
+                    self.max_checkout_wait_seconds, waited
+                )
+
+
+class MeteredAsyncQueuePool(MeteredQueuePool, AsyncAdaptedQueuePool):
+    pass
+
+
+# statements run by each thread, or each greenlet of an AsyncMessageBus, so a
+# unit of work can count its own
+_executed = contextvars.ContextVar("statements_executed", default=0)
+
+
+def statements_executed() -> int:
+    return _executed.get()
+
+
+def instrument_engine(engine):
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, params, context, executemany):
+        context._metrics_started = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, params, context, executemany):
+        elapsed = time.perf_counter() - context._metrics_started
+        kind = statement.lstrip().split(None, 1)[0].upper()
+        metrics.DB_STATEMENTS.inc(statement=kind)
+        metrics.DB_STATEMENT_SECONDS.observe(elapsed, statement=kind)
+        _executed.set(_executed.get() + 1)
+
+
+@functools.lru_cache(maxsize=None)
+def get_engine():
+    engine = create_engine(
         config.get_postgres_uri(),
-        isolation_level="REPEATABLE READ",
+        isolation_level=config.get_db_isolation_level(),
+        poolclass=MeteredQueuePool,
+        **config.get_db_pool_options(),
+    )
+    if metrics.enabled:
+        instrument_engine(engine)
+    return engine
+
+
+@functools.lru_cache(maxsize=None)
+def get_session_factory():
+    return sessionmaker(bind=get_engine())
+
+
+@functools.lru_cache(maxsize=None)
+def get_async_engine():
+    options = config.get_db_pool_options()
+    connect_args = options.pop("connect_args", None)
+    if connect_args:
+        # asyncpg takes server settings, not a libpq options string
+        timeout = connect_args["options"].rsplit("=", 1)[1]
+        options["connect_args"] = {"server_settings": {"statement_timeout": timeout}}
+    engine = create_async_engine(
+        config.get_async_postgres_uri(),
+        isolation_level=config.get_db_isolation_level(),
+        poolclass=MeteredAsyncQueuePool,
+        **options,
+    )
+    if metrics.enabled:
+        instrument_engine(engine.sync_engine)
+    return engine
+
+
+@functools.lru_cache(maxsize=None)
+def get_async_session_factory():
+    # the session is the one AsyncSession wraps, so it only works under
+    # greenlet_spawn, i.e. in handlers run by an AsyncMessageBus
+    return sessionmaker(bind=get_async_engine().sync_engine)
+
+
+def pool_metrics(engine=None):
+    pool = (engine or get_engine()).pool
+    return dict(
+        size=pool.size(),
+        checked_in=pool.checkedin(),
+        checked_out=pool.checkedout(),
+        overflow=pool.overflow(),
+        checkouts=pool.checkouts,
+        checkout_wait_seconds=pool.checkout_wait_seconds,
+        max_checkout_wait_seconds=pool.max_checkout_wait_seconds,
     )
-)
 
 
 class SqlAlchemyUnitOfWork(AbstractUnitOfWork):
-    def __init__(self, session_factory=DEFAULT_SESSION_FACTORY):
-        self.session_factory = session_factory
+    def __init__(
+        self,
+        session_factory=None,
+        product_cache: ProductCache = None,
+        outbox: bool = None,
+        event_sourcing: dict = None,
+    ):
+        self.session_factory = session_factory or get_session_factory()
+        self.use_outbox = config.get_event_outbox() if outbox is None else outbox
+        if event_sourcing is None:
+            event_sourcing = config.get_event_sourcing_options()
+        self.event_sourcing = event_sourcing
+        # cached products are validated against products.version_number, which
+        # event-sourced products do not keep up to date
+        self.product_cache = None if event_sourcing else product_cache
 
     def __enter__(self):
-        self.session = self.session_factory()  # type: Session
-        self.products = SqlAlchemyRepository(self.session)
+        if metrics.enabled:
+            self._opened = time.perf_counter()
+            self._statements_before = statements_executed()
+        self._committed = set()  # type: Set[model.Product]
+        if self.event_sourcing:
+            self.session = self.session_factory()
+            self.products = EventSourcedRepository(
+                self.session, **self.event_sourcing
+            )
+        elif self.product_cache is None:
+            self.session = self.session_factory()  # type: Session
+            self.products = SqlAlchemyRepository(self.session)
+        else:
+            # committed aggregates must stay loaded to be reused by later requests
+            self.session = self.session_factory(expire_on_commit=False)
+            self.products = CachingSqlAlchemyRepository(
+                self.session, self.product_cache
+            )
+        self.allocations_view = SqlAlchemyAllocationsView(self.session)
+        self.outbox = SqlAlchemyOutbox(self.session)
         return super().__enter__()
 
     def __exit__(self, *args):
+        clean = not (self.session.new or self.session.dirty or self.session.deleted)
         super().__exit__(*args)
         self.session.close()
+        if metrics.enabled:
+            opened_for = time.perf_counter() - self._opened
+            metrics.UOW_SECONDS.observe(opened_for, phase="open")
+            metrics.UOW_STATEMENTS.observe(
+                statements_executed() - self._statements_before
+            )
+        if self.product_cache is not None and clean:
+            for product in self._committed:
+                # a rollback after the last commit expires everything it loaded
+                if not inspect(product).expired:
+                    self.product_cache.put(product)
+
+    def _commit(self):
+        try:
+            # before the outbox takes the events off the products
+            self.products.flush()
+            if self.use_outbox:
+                # saved in the same transaction, so collect_new_events() comes
+                # back empty and the bus leaves the events to the publisher
+                self.outbox.add(self.collect_new_events())
+            with metrics.UOW_SECONDS.time(phase="commit"):
+                self.session.commit()
+        except (StaleDataError, DBAPIError) as e:
+            self.session.rollback()
+            if (
+                isinstance(e, StaleDataError)
+                or is_serialization_failure(e)
+                or is_duplicate_product(e)
+            ):
+                raise ConcurrentModification(str(e)) from e
+            raise
+        self._committed.update(self.products.seen)
+
+    def rollback(self):
+        with metrics.UOW_SECONDS.time(phase="rollback"):
+            self.session.rollback()
+
+
+class AsyncSqlAlchemyUnitOfWork(SqlAlchemyUnitOfWork):
+    # the same unit of work over asyncpg; used through an AsyncMessageBus, it
+    # waits for the database without holding a thread
+    def __init__(self, session_factory=None, **kwargs):
+        super().__init__(session_factory or get_async_session_factory(), **kwargs)
+
+
+class InMemoryUnitOfWork(AbstractUnitOfWork):
+    def __init__(self, store: InMemoryStore = None):
+        self.store = store or InMemoryStore()
+        self.products = InMemoryRepository(self.store)
+        self.allocations_view = InMemoryAllocationsView(self.store.allocations)
+
+    def __enter__(self):
+        self.store.lock.acquire()
+        self.products = InMemoryRepository(self.store)
+        self.allocations_view = InMemoryAllocationsView(self.store.allocations)
+        return super().__enter__()
+
+    def __exit__(self, *args):
+        try:
+            super().__exit__(*args)
+        finally:
+            self.store.lock.release()
+
+    def collect_new_events(self):
+        # only what this unit of work committed; the products themselves are
+        # shared, and may already hold another one's uncommitted events
+        if self.products.events:
+            new_events, self.products.events = self.products.events, []
+            yield from new_events
 
     def _commit(self):
-        self.session.commit()
+        self.products.commit()
+        self.allocations_view.commit()
 
     def rollback(self):
-        self.session.rollback()
+        self.products.rollback()
+        self.allocations_view.rollback()
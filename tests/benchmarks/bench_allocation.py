@@ -0,0 +1,52 @@
+import time
+from datetime import date, timedelta
+
+from allocation.domain.model import Batch, OrderLine, Product
+
+SKU = "HOT-SKU"
+
+
+def product_with_allocated_lines(n_lines, n_batches=10):
+    batches = [
+        Batch(f"batch-{i}", SKU, n_lines * 2, eta=None) for i in range(n_batches)
+    ]
+    for batch in batches:
+        for i in range(n_lines):
+            batch.allocate(OrderLine(f"{batch.reference}-order-{i}", SKU, 1))
+    return Product(SKU, batches)
+
+
+def product_with_exhausted_shipments(n_batches):
+    today = date.today()
+    batches = [
+        Batch(f"batch-{i}", SKU, 1, eta=today + timedelta(days=i))
+        for i in range(n_batches)
+    ]
+    product = Product(SKU, batches)
+    for i in range(n_batches - 1):
+        product.allocate(OrderLine(f"setup-order-{i}", SKU, 1))
+    product.batches[-1]._purchased_quantity = 1_000_000
+    return product
+
+
+def time_allocations(product, repeat=1000):
+    start = time.perf_counter()
+    for i in range(repeat):
+        product.allocate(OrderLine(f"bench-order-{i}", SKU, 1))
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    print(f"{'lines per batch':>16} {'us per allocation':>18}")
+    for n_lines in (10, 100, 1_000, 10_000):
+        product = product_with_allocated_lines(n_lines)
+        print(f"{n_lines:>16} {time_allocations(product) * 1e6:>18.2f}")
+
+    print(f"{'batches':>16} {'us per allocation':>18}")
+    for n_batches in (10, 100, 1_000):
+        product = product_with_exhausted_shipments(n_batches)
+        print(f"{n_batches:>16} {time_allocations(product) * 1e6:>18.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+import argparse
+import threading
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from allocation import config
+from allocation.adapters import orm
+from allocation.domain import commands
+from allocation.service_layer import handlers, unit_of_work
+from tests.random_refs import random_batchref, random_orderid, random_sku
+
+
+class CountingUnitOfWork(unit_of_work.SqlAlchemyUnitOfWork):
+    def __init__(self, session_factory, conflicts):
+        super().__init__(session_factory)
+        self.conflicts = conflicts
+
+    def _commit(self):
+        try:
+            super()._commit()
+        except unit_of_work.ConcurrentModification:
+            self.conflicts.append(1)
+            raise
+
+
+def run(session_factory, writers, allocations_per_writer):
+    sku, batchref = random_sku(), random_batchref()
+    session = session_factory()
+    session.execute(orm.products.insert(), dict(sku=sku, version_number=0))
+    session.execute(
+        orm.batches.insert(),
+        dict(reference=batchref, sku=sku, _purchased_quantity=10**9, eta=None),
+    )
+    session.commit()
+
+    conflicts, failures = [], []
+
+    def writer():
+        for _ in range(allocations_per_writer):
+            command = commands.Allocate(random_orderid(), sku, 1)
+            uow = CountingUnitOfWork(session_factory, conflicts)
+            try:
+                handlers.allocate(command, uow)
+            except unit_of_work.ConcurrentModification:
+                failures.append(1)
+
+    threads = [threading.Thread(target=writer) for _ in range(writers)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    total = writers * allocations_per_writer
+    return (total - len(failures)) / elapsed, len(conflicts) / total, len(failures)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--uri", default=config.get_postgres_uri())
+    parser.add_argument("--allocations", type=int, default=50)
+    args = parser.parse_args()
+
+    engine = create_engine(
+        args.uri,
+        isolation_level=config.get_db_isolation_level(),
+        pool_size=64,
+        max_overflow=0,
+    )
+    orm.metadata.create_all(engine)
+    orm.start_mappers()
+    session_factory = sessionmaker(bind=engine)
+
+    header = ("writers", "allocations/s", "retries/allocation", "gave up")
+    print("{:>8} {:>14} {:>19} {:>8}".format(*header))
+    for writers in (1, 2, 4, 8, 16, 32, 64):
+        throughput, retries, failures = run(
+            session_factory, writers, args.allocations
+        )
+        print(f"{writers:>8} {throughput:>14.1f} {retries:>19.3f} {failures:>8}")
+
+
+if __name__ == "__main__":
+    main()
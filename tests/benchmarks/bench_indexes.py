@@ -0,0 +1,131 @@
+import argparse
+import os
+import tempfile
+import time
+
+from sqlalchemy import create_engine, text
+
+from allocation.adapters import orm
+
+QUERIES = {
+    "product by batchref": (
+        "SELECT products.sku FROM products JOIN batches ON products.sku = batches.sku"
+        " WHERE batches.reference = :ref"
+    ),
+    "batches of a product": "SELECT id FROM batches WHERE sku = :sku",
+    "allocations of a batch": (
+        "SELECT order_lines.id FROM order_lines"
+        " JOIN allocations ON order_lines.id = allocations.orderline_id"
+        " WHERE allocations.batch_id = :batch_id"
+    ),
+    "lines of an order": "SELECT id FROM order_lines WHERE orderid = :orderid",
+}
+
+
+def create_unindexed_schema(engine):
+    orm.metadata.drop_all(engine)
+    orm.metadata.create_all(engine)
+    for table in orm.metadata.sorted_tables:
+        for index in table.indexes:
+            index.drop(bind=engine)
+
+
+def populate(engine, rows, chunk=50_000):
+    skus = max(rows // 100, 1)
+    with engine.begin() as connection:
+        connection.execute(
+            orm.products.insert(), [dict(sku=f"sku-{i}") for i in range(skus)]
+        )
+        for start in range(0, rows, chunk):
+            ids = range(start, min(start + chunk, rows))
+            connection.execute(
+                orm.batches.insert(),
+                [
+                    dict(
+                        id=i + 1,
+                        reference=f"batch-{i}",
+                        sku=f"sku-{i % skus}",
+                        _purchased_quantity=100,
+                    )
+                    for i in ids
+                ],
+            )
+            connection.execute(
+                orm.order_lines.insert(),
+                [
+                    dict(id=i + 1, orderid=f"order-{i}", sku=f"sku-{i % skus}", qty=1)
+                    for i in ids
+                ],
+            )
+            connection.execute(
+                orm.allocations.insert(),
+                [dict(orderline_id=i + 1, batch_id=i + 1) for i in ids],
+            )
+
+
+def explain(connection, sql, params):
+    if connection.dialect.name == "sqlite":
+        sql = "EXPLAIN QUERY PLAN " + sql
+    else:
+        sql = "EXPLAIN " + sql
+    rows = connection.execute(text(sql), params)
+    return [" ".join(str(column) for column in row) for row in rows]
+
+
+def run_queries(engine, rows, repeat):
+    params = dict(
+        ref=f"batch-{rows // 2}",
+        sku=f"sku-{rows // 200}",
+        batch_id=rows // 2,
+        orderid=f"order-{rows // 2}",
+    )
+    with engine.connect() as connection:
+        for name, sql in QUERIES.items():
+            start = time.perf_counter()
+            for _ in range(repeat):
+                connection.execute(text(sql), params).fetchall()
+            elapsed = (time.perf_counter() - start) / repeat
+            print(f"  {name:<24} {elapsed * 1e3:>10.3f} ms")
+            for line in explain(connection, sql, params):
+                print(f"    {line}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--uri", help="scratch database to run against (default: a new sqlite file)"
+    )
+    parser.add_argument(
+        "--i-know-this-drops-everything",
+        action="store_true",
+        help="allow --uri: every allocation table in it is dropped and recreated",
+    )
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+    if args.uri and not args.i_know_this_drops_everything:
+        parser.error(
+            f"{args.uri} would lose every allocation table; point --uri at a"
+            " scratch database and pass --i-know-this-drops-everything"
+        )
+
+    with tempfile.TemporaryDirectory() as tmp:
+        uri = args.uri or f"sqlite:///{os.path.join(tmp, 'bench.db')}"
+        engine = create_engine(uri)
+        create_unindexed_schema(engine)
+        start = time.perf_counter()
+        populate(engine, args.rows)
+        print(f"loaded {args.rows} rows in {time.perf_counter() - start:.1f}s")
+
+        print("before upgrade_schema:")
+        run_queries(engine, args.rows, args.repeat)
+        start = time.perf_counter()
+        orm.upgrade_schema(engine)
+        print(f"upgrade_schema took {time.perf_counter() - start:.1f}s")
+        print("after upgrade_schema:")
+        run_queries(engine, args.rows, args.repeat)
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
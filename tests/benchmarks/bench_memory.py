@@ -0,0 +1,95 @@
+import argparse
+import gc
+import tracemalloc
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import clear_mappers, sessionmaker
+
+from allocation.adapters import orm
+from allocation.adapters.repository import SqlAlchemyRepository
+from allocation.domain import model
+
+SKU = "HIPSTER-WORKBENCH-WITH-A-LONG-SKU"
+
+
+def populate(engine, n_lines):
+    with engine.begin() as connection:
+        connection.execute(orm.products.insert(), [dict(sku=SKU, version_number=1)])
+        connection.execute(
+            orm.batches.insert(),
+            [dict(id=1, reference="batch1", sku=SKU, _purchased_quantity=n_lines)],
+        )
+        connection.execute(
+            orm.order_lines.insert(),
+            [
+                dict(id=i + 1, orderid=f"order-{i:08d}", sku=SKU, qty=1)
+                for i in range(n_lines)
+            ],
+        )
+        connection.execute(
+            orm.allocations.insert(),
+            [dict(orderline_id=i + 1, batch_id=1) for i in range(n_lines)],
+        )
+
+
+def retained_bytes(load):
+    gc.collect()
+    tracemalloc.start()
+    product = load()
+    product.batches[0].available_quantity  # rebuild the allocation counter
+    gc.collect()
+    retained, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return product, retained
+
+
+def measure_orm(engine, interned):
+    orm.start_mappers()
+    if not interned:
+        event.remove(model.OrderLine, "load", orm.receive_line_load)
+    try:
+        session = sessionmaker(bind=engine)()
+        product, retained = retained_bytes(
+            lambda: SqlAlchemyRepository(session, "selectin").get(SKU)
+        )
+        assert product.batches[0].available_quantity == 0
+        session.close()
+        return retained
+    finally:
+        if not interned:
+            event.listen(model.OrderLine, "load", orm.receive_line_load)
+        clear_mappers()
+
+
+def measure_domain(n_lines):
+    def build():
+        batch = model.Batch("batch1", SKU, n_lines, eta=None)
+        for i in range(n_lines):
+            batch.allocate(model.OrderLine(f"order-{i:08d}", "".join(SKU), 1))
+        return model.Product(SKU, [batch])
+
+    _, retained = retained_bytes(build)
+    return retained
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lines", type=int, default=100_000)
+    args = parser.parse_args()
+
+    engine = create_engine("sqlite://")
+    orm.metadata.create_all(engine)
+    populate(engine, args.lines)
+
+    per_100k = 100_000 / args.lines / 1e6
+    print(f"{'aggregate':<40} {'MB per 100k allocations':>24}")
+    for name, retained in (
+        ("loaded, one sku string per line", measure_orm(engine, interned=False)),
+        ("loaded, interned sku", measure_orm(engine, interned=True)),
+        ("built in memory, unmapped", measure_domain(args.lines)),
+    ):
+        print(f"{name:<40} {retained * per_100k:>24.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+import time
+from datetime import date
+
+from allocation.domain import commands
+from allocation.service_layer.messagebus import MessageBus
+from tests.unit.mocks import FakeUnitOfWork
+
+SKU = "CASCADING-SKU"
+
+
+def bus_with_allocated_lines(n_lines):
+    uow = FakeUnitOfWork()
+    bus = MessageBus(uow)
+    bus.handle(commands.CreateBatch("in-stock", SKU, n_lines, None))
+    bus.handle(commands.CreateBatch("shipment", SKU, n_lines, date.today()))
+    for i in range(n_lines):
+        bus.handle(commands.Allocate(f"order-{i}", SKU, 1))
+    return bus
+
+
+def time_reallocation_cascade(n_lines):
+    bus = bus_with_allocated_lines(n_lines)
+    start = time.perf_counter()
+    bus.handle(commands.ChangeBatchQuantity("in-stock", 0))
+    return time.perf_counter() - start
+
+
+def main():
+    print(f"{'reallocated lines':>18} {'seconds':>10} {'messages/s':>12}")
+    for n_lines in (100, 1_000, 10_000):
+        elapsed = time_reallocation_cascade(n_lines)
+        messages = n_lines + 1
+        print(f"{n_lines:>18} {elapsed:>10.4f} {messages / elapsed:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
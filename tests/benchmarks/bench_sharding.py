@@ -0,0 +1,84 @@
+import argparse
+import functools
+import threading
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from allocation import config
+from allocation.adapters import orm, repository
+from allocation.domain import commands
+from allocation.service_layer import messagebus, unit_of_work
+from allocation.service_layer.sharding import ShardedMessageBus
+from tests.random_refs import random_batchref, random_orderid, random_sku
+
+
+def bench_bus(uri):
+    # runs in each shard worker
+    orm.start_mappers()
+    session_factory = sessionmaker(bind=create_engine(uri))
+    uow = unit_of_work.SqlAlchemyUnitOfWork(
+        session_factory, product_cache=repository.ProductCache()
+    )
+    return messagebus.MessageBus(uow)
+
+
+def create_products(session_factory, n_skus):
+    skus = [random_sku() for _ in range(n_skus)]
+    session = session_factory()
+    for sku in skus:
+        session.execute(orm.products.insert(), dict(sku=sku, version_number=0))
+        session.execute(
+            orm.batches.insert(),
+            dict(reference=random_batchref(), sku=sku, _purchased_quantity=10**9),
+        )
+    session.commit()
+    return skus
+
+
+def run(bus, skus, clients, allocations_per_client):
+    def client(offset):
+        for i in range(allocations_per_client):
+            sku = skus[(offset + i) % len(skus)]
+            bus.handle(commands.Allocate(random_orderid(), sku, 1))
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return clients * allocations_per_client / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--uri", default=config.get_postgres_uri())
+    parser.add_argument("--skus", type=int, default=16)
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--allocations", type=int, default=50)
+    args = parser.parse_args()
+
+    engine = create_engine(args.uri, pool_size=args.clients, max_overflow=0)
+    orm.metadata.create_all(engine)
+    orm.start_mappers()
+    session_factory = sessionmaker(bind=engine)
+
+    print(f"{'workers':>8} {'mode':>10} {'allocations/s':>14}")
+    # every client on a shared bus, contending on the products' rows
+    shared = messagebus.MessageBus(unit_of_work.SqlAlchemyUnitOfWork(session_factory))
+    skus = create_products(session_factory, args.skus)
+    throughput = run(shared, skus, args.clients, args.allocations)
+    print(f"{args.clients:>8} {'threads':>10} {throughput:>14.1f}")
+
+    for shards in (1, 2, 4, 8, 16):
+        bus = ShardedMessageBus(shards, functools.partial(bench_bus, args.uri))
+        skus = create_products(session_factory, args.skus)
+        throughput = run(bus, skus, args.clients, args.allocations)
+        bus.close()
+        print(f"{shards:>8} {'sharded':>10} {throughput:>14.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+import argparse
+import fnmatch
+import functools
+import itertools
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+import timeit
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable, Dict, Tuple
+
+import requests
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from allocation import config
+from allocation.adapters import orm
+from allocation.domain import commands
+from allocation.domain.model import Batch, OrderLine, Product
+from allocation.service_layer import messagebus, unit_of_work
+from tests.random_refs import random_batchref, random_orderid, random_sku
+from tests.unit.mocks import FakeUnitOfWork
+
+BASELINE = Path(__file__).parent / "baseline.json"
+
+# each case sets itself up and returns a step to time, and the operations it does
+Case = Callable[[argparse.Namespace], Tuple[Callable[[], None], int]]
+CASES = {}  # type: Dict[str, Case]
+
+
+def case(name: str, **params):
+    def register(factory):
+        label = ",".join(f"{key}={value}" for key, value in params.items())
+        CASES[f"{name}[{label}]" if label else name] = functools.partial(
+            factory, **params
+        )
+        return factory
+
+    return register
+
+
+def product(sku, n_batches, lines_per_batch):
+    batches = [
+        Batch(f"{sku}-batch-{i}", sku, 10**9, eta=None) for i in range(n_batches)
+    ]
+    for batch in batches:
+        for i in range(lines_per_batch):
+            batch.allocate(OrderLine(f"{batch.reference}-order-{i}", sku, 1))
+    return Product(sku, batches)
+
+
+# registered bottom up
+@case("domain.allocate", batches=1_000, lines=10)
+@case("domain.allocate", batches=100, lines=10)
+@case("domain.allocate", batches=1, lines=10_000)
+@case("domain.allocate", batches=1, lines=10)
+def allocate_to_product(args, batches, lines):
+    sku = "BENCH-SKU"
+    product_ = product(sku, batches, lines)
+    orders = itertools.count()
+
+    def step():
+        product_.allocate(OrderLine(f"bench-order-{next(orders)}", sku, 1))
+        product_.events.clear()
+
+    return step, 1
+
+
+def fake_bus(sku):
+    bus = messagebus.MessageBus(FakeUnitOfWork())
+    bus.handle(commands.CreateBatch("bench-batch", sku, 10**9, None))
+    return bus
+
+
+@case("bus.allocate")
+def handle_allocate(args):
+    bus, orders = fake_bus("BENCH-SKU"), itertools.count()
+
+    def step():
+        bus.handle(commands.Allocate(f"bench-order-{next(orders)}", "BENCH-SKU", 1))
+
+    return step, 1
+
+
+@case("bus.allocate_many", lines=100)
+def handle_allocate_many(args, lines):
+    bus, orders = fake_bus("BENCH-SKU"), itertools.count()
+
+    def step():
+        bus.handle(
+            commands.AllocateMany(
+                [
+                    commands.Allocate(f"bench-order-{next(orders)}", "BENCH-SKU", 1)
+                    for _ in range(lines)
+                ]
+            )
+        )
+
+    return step, lines
+
+
+@functools.lru_cache(maxsize=None)
+def session_factory(uri):
+    engine = create_engine(uri)
+    orm.metadata.create_all(engine)
+    orm.start_mappers()
+    return sessionmaker(bind=engine)
+
+
+def stored_product(args, n_batches, lines_per_batch):
+    sku = random_sku()
+    session = session_factory(args.db_uri)()
+    session.add(product(sku, n_batches, lines_per_batch))
+    session.commit()
+    session.close()
+    return sku
+
+
+@case("repository.get", batches=10, lines=100)
+def get_product(args, batches, lines):
+    sku = stored_product(args, batches, lines)
+    factory = session_factory(args.db_uri)
+
+    def step():
+        with unit_of_work.SqlAlchemyUnitOfWork(factory) as uow:
+            uow.products.get(sku=sku).batches[0].available_quantity
+
+    return step, 1
+
+
+@case("uow.allocate", batches=10, lines=100)
+def allocate_and_commit(args, batches, lines):
+    sku = stored_product(args, batches, lines)
+    bus = messagebus.MessageBus(
+        unit_of_work.SqlAlchemyUnitOfWork(session_factory(args.db_uri))
+    )
+
+    def step():
+        bus.handle(commands.Allocate(random_orderid(), sku, 1))
+
+    return step, 1
+
+
+@case("e2e.allocate")
+def post_allocate(args):
+    sku, http = random_sku(), requests.Session()
+    http.post(
+        f"{args.api_url}/add_batch",
+        json={"ref": random_batchref(), "sku": sku, "qty": 10**9, "eta": None},
+    ).raise_for_status()
+
+    def step():
+        http.post(
+            f"{args.api_url}/allocate",
+            json={"orderid": random_orderid(), "sku": sku, "qty": 1},
+        ).raise_for_status()
+
+    return step, 1
+
+
+def measure(step: Callable[[], None], ops: int, repeat: int) -> dict:
+    timer = timeit.Timer(step)
+    number, _ = timer.autorange()
+    # the fastest run is the one least disturbed by everything else on the box
+    best = min(timer.repeat(repeat=repeat, number=number)) / (number * ops)
+    return dict(ops_per_second=1 / best, seconds_per_op=best, number=number * ops)
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    regressions = []
+    print(f"{'benchmark':<44} {'ops/s':>12} {'baseline':>12} {'change':>8}")
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None:
+            print(f"{name:<44} {result['ops_per_second']:>12.1f} {'-':>12} {'':>8}")
+            continue
+
+        change = result["ops_per_second"] / before["ops_per_second"] - 1
+        flag = ""
+        if change < -tolerance:
+            regressions.append(name)
+            flag = " REGRESSED"
+        print(
+            f"{name:<44} {result['ops_per_second']:>12.1f}"
+            f" {before['ops_per_second']:>12.1f} {change:>+8.1%}{flag}"
+        )
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="time the allocation service from the domain model up to the api"
+    )
+    parser.add_argument("patterns", nargs="*", default=["*"], help="e.g. 'domain.*'")
+    parser.add_argument("--db-uri", help="default: a throwaway sqlite file")
+    parser.add_argument("--api-url", default=config.get_api_url())
+    parser.add_argument("--e2e", action="store_true", help="also time the live api")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", type=Path, help="write the results here as json")
+    parser.add_argument("--baseline", type=Path, default=BASELINE)
+    parser.add_argument(
+        "--tolerance", type=float, default=0.2, help="slowdown allowed, as a fraction"
+    )
+    parser.add_argument(
+        "--update-baseline", action="store_true", help="store these as the baseline"
+    )
+    args = parser.parse_args(argv)
+
+    if not (args.baseline.exists() or args.update_baseline):
+        print(
+            f"ERROR: no baseline at {args.baseline} to compare against; record"
+            " one on this machine with --update-baseline (make benchmark-baseline)"
+            " and commit it",
+            file=sys.stderr,
+        )
+        return 2
+
+    if args.db_uri is None:
+        args.db_uri = f"sqlite:///{tempfile.mkdtemp()}/bench.db"
+
+    names = [
+        name
+        for name in CASES
+        if any(fnmatch.fnmatch(name, pattern) for pattern in args.patterns)
+        and (args.e2e or not name.startswith("e2e."))
+    ]
+    results = {}
+    for name in names:
+        step, ops = CASES[name](args)
+        results[name] = measure(step, ops, args.repeat)
+
+    report = dict(
+        revision=git_revision(),
+        python=platform.python_version(),
+        platform=platform.platform(),
+        db=args.db_uri.split(":", 1)[0],
+        created_at=datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        results=results,
+    )
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2) + "\n")
+
+    baseline = {}
+    if args.baseline.exists():
+        stored = json.loads(args.baseline.read_text())
+        baseline = stored["results"]
+        if (stored["python"], stored["platform"]) != (
+            report["python"],
+            report["platform"],
+        ):
+            print(
+                f"WARNING: {args.baseline} was recorded with python"
+                f" {stored['python']} on {stored['platform']}; rerun with"
+                " --update-baseline on this machine for numbers worth comparing",
+                file=sys.stderr,
+            )
+    regressions = compare(results, baseline, args.tolerance)
+
+    if args.update_baseline:
+        # merged, so refreshing some of the cases keeps the others
+        stored = dict(report, results=dict(baseline, **results))
+        args.baseline.write_text(json.dumps(stored, indent=2) + "\n")
+        return 0
+
+    if regressions:
+        print(f"{len(regressions)} slower than the baseline by {args.tolerance:.0%}+")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -39,3 +39,39 @@ def test_unhappy_path_returns_400_and_error_message():
     r = requests.post(f'{url}/allocate', json=data)
     assert r.status_code == 400
     assert r.json()['message'] == f'Invalid sku {unknown_sku}'
+
+
+@pytest.mark.usefixtures('postgres_db')
+@pytest.mark.usefixtures('restart_api')
+def test_allocate_many_returns_201_and_a_batchref_per_line():
+    sku, othersku = random_sku(), random_sku('other')
+    batch1, batch2 = random_batchref(1), random_batchref(2)
+    post_to_add_batch(batch1, sku, 10, None)
+    post_to_add_batch(batch2, othersku, 10, None)
+    data = {'lines': [
+        {'orderid': random_orderid(1), 'sku': sku, 'qty': 5},
+        {'orderid': random_orderid(2), 'sku': othersku, 'qty': 5},
+        {'orderid': random_orderid(3), 'sku': sku, 'qty': 10},
+    ]}
+    url = config.get_api_url()
+    r = requests.post(f'{url}/allocate_many', json=data)
+    assert r.status_code == 201
+    assert r.json()['batchrefs'] == [batch1, batch2, None]
+
+
+@pytest.mark.usefixtures('postgres_db')
+@pytest.mark.usefixtures('restart_api')
+def test_allocations_view_returns_the_allocated_batch():
+    sku, batch, orderid = random_sku(), random_batchref(), random_orderid()
+    post_to_add_batch(batch, sku, 100, None)
+    url = config.get_api_url()
+    data = {'orderid': orderid, 'sku': sku, 'qty': 3}
+    r = requests.post(f'{url}/allocate', json=data)
+    assert r.status_code == 201
+
+    r = requests.get(f'{url}/allocations/{orderid}')
+    assert r.status_code == 200
+    assert r.json() == [{'sku': sku, 'batchref': batch}]
+
+    r = requests.get(f'{url}/allocations/{random_orderid()}')
+    assert r.status_code == 404
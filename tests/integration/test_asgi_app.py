@@ -0,0 +1,188 @@
+import asyncio
+import json
+import threading
+
+import pytest
+from sqlalchemy import select
+
+from allocation.adapters import orm
+from allocation.entrypoints.asgi_app import AllocationApp
+from allocation.service_layer import unit_of_work
+from tests.random_refs import random_batchref, random_orderid, random_sku
+from tests.unit.mocks import FakeBroker
+
+
+class Response:
+    def __init__(self, status_code: int, body: bytes):
+        self.status_code = status_code
+        self.text = body.decode()
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class AsgiClient:
+    # calls the app in-process, as an asgi server would
+    def __init__(self, app):
+        self.app = app
+
+    async def request(self, method, path, json_body=None, body=None):
+        if body is None:
+            body = json.dumps(json_body).encode() if json_body is not None else b""
+        sent = []
+
+        async def receive():
+            return {"type": "http.request", "body": body, "more_body": False}
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {"type": "http", "method": method, "path": path, "headers": []}
+        await self.app(scope, receive, send)
+        start, response_body = sent
+        return Response(start["status"], response_body["body"])
+
+    async def post(self, path, json_body):
+        return await self.request("POST", path, json_body)
+
+    async def get(self, path):
+        return await self.request("GET", path)
+
+
+def test_serves_the_api_routes(session_factory):
+    client = AsgiClient(
+        AllocationApp(lambda: unit_of_work.AsyncSqlAlchemyUnitOfWork(session_factory))
+    )
+    sku, batchref, orderid = random_sku(), random_batchref(), random_orderid()
+
+    async def scenario():
+        r = await client.post(
+            "/add_batch", dict(ref=batchref, sku=sku, qty=100, eta="2011-01-02")
+        )
+        assert (r.status_code, r.text) == (201, "OK")
+
+        r = await client.post("/allocate", dict(orderid=orderid, sku=sku, qty=3))
+        assert (r.status_code, r.json()) == (201, {"batchref": batchref})
+
+        r = await client.get(f"/allocations/{orderid}")
+        assert (r.status_code, r.json()) == (200, [dict(sku=sku, batchref=batchref)])
+
+        r = await client.post("/allocate", dict(orderid=orderid, sku="NOPE", qty=3))
+        assert (r.status_code, r.json()) == (400, {"message": "Invalid sku NOPE"})
+
+        assert (await client.get("/allocations/unknown")).status_code == 404
+        assert (await client.get("/no_such_route")).status_code == 404
+
+    asyncio.run(scenario())
+
+
+def test_bad_request_bodies_are_rejected(session_factory):
+    client = AsgiClient(
+        AllocationApp(lambda: unit_of_work.AsyncSqlAlchemyUnitOfWork(session_factory))
+    )
+
+    async def scenario():
+        return [
+            await client.request("POST", "/allocate"),
+            await client.request("POST", "/allocate", body=b"{not json"),
+            await client.post("/allocate", [1, 2]),
+            await client.post("/allocate", dict(orderid="o1", sku="RED-CHAIR")),
+            await client.post("/allocate_many", dict(lines=[dict(orderid="o1")])),
+            await client.post("/add_batch", dict(ref="b1", sku="RED-CHAIR", qty=1)),
+        ]
+
+    responses = asyncio.run(scenario())
+
+    assert [(r.status_code, r.json()["message"]) for r in responses] == [
+        (400, "Expected a json object"),
+        (400, "Invalid json body"),
+        (400, "Expected a json object"),
+        (400, "Missing qty"),
+        (400, "Missing sku, qty"),
+        (400, "Missing eta"),
+    ]
+
+
+def test_events_are_published_off_the_event_loop(session_factory):
+    class ThreadRecordingBroker(FakeBroker):
+        def publish(self, stream, messages):
+            self.thread = threading.current_thread()
+            super().publish(stream, messages)
+
+    event_broker = ThreadRecordingBroker()
+    client = AsgiClient(
+        AllocationApp(
+            lambda: unit_of_work.AsyncSqlAlchemyUnitOfWork(session_factory),
+            event_broker,
+        )
+    )
+    sku, batchref = random_sku(), random_batchref()
+
+    async def scenario():
+        await client.post("/add_batch", dict(ref=batchref, sku=sku, qty=10, eta=None))
+        return await client.post(
+            "/allocate", dict(orderid=random_orderid(), sku=sku, qty=1)
+        )
+
+    r = asyncio.run(scenario())
+
+    assert r.status_code == 201
+    assert event_broker.streams["allocated"]
+    assert event_broker.thread is not threading.current_thread()
+
+
+def test_requests_on_one_event_loop_allocate_in_turn(session_factory):
+    client = AsgiClient(
+        AllocationApp(lambda: unit_of_work.AsyncSqlAlchemyUnitOfWork(session_factory))
+    )
+    sku, batchref = random_sku(), random_batchref()
+
+    async def scenario():
+        await client.post(
+            "/add_batch", dict(ref=batchref, sku=sku, qty=100, eta=None)
+        )
+        return await asyncio.gather(
+            *(
+                client.post("/allocate", dict(orderid=f"o{i}", sku=sku, qty=1))
+                for i in range(40)
+            )
+        )
+
+    responses = asyncio.run(scenario())
+
+    assert {r.status_code for r in responses} == {201}
+    allocated = session_factory().execute(
+        select(orm.order_lines.c.id).where(orm.order_lines.c.sku == sku)
+    )
+    assert len(allocated.all()) == 40
+
+
+def test_concurrent_allocations_through_asyncpg(postgres_session_factory):
+    pytest.importorskip("asyncpg")
+    client = AsgiClient(AllocationApp(unit_of_work.AsyncSqlAlchemyUnitOfWork))
+    skus = [random_sku() for _ in range(50)]
+
+    async def scenario():
+        for sku in skus:
+            await client.post(
+                "/add_batch", dict(ref=random_batchref(), sku=sku, qty=10, eta=None)
+            )
+        responses = await asyncio.gather(
+            *(
+                client.post(
+                    "/allocate", dict(orderid=random_orderid(), sku=sku, qty=1)
+                )
+                for sku in skus
+                for _ in range(4)
+            )
+        )
+        await unit_of_work.get_async_engine().dispose()
+        return responses
+
+    responses = asyncio.run(scenario())
+
+    assert {r.status_code for r in responses} == {201}
+    allocated = postgres_session_factory().execute(
+        select(orm.order_lines.c.id).where(orm.order_lines.c.sku.in_(skus))
+    )
+    assert len(allocated.all()) == 200
@@ -0,0 +1,77 @@
+import io
+from datetime import date
+
+from allocation.domain import commands, events, model
+from allocation.entrypoints import batch_import
+from allocation.service_layer import messagebus, unit_of_work
+
+
+CSV_FEED = """ref,sku,qty,eta
+batch1,RETRO-CLOCK,100,
+batch2,RETRO-CLOCK,50,2011-01-02
+batch3,MINIMALIST-SPOON,20,
+"""
+
+JSONL_FEED = """{"ref": "batch1", "sku": "RETRO-CLOCK", "qty": 100, "eta": null}
+{"ref": "batch2", "sku": "RETRO-CLOCK", "qty": 50, "eta": "2011-01-02"}
+
+{"ref": "batch3", "sku": "MINIMALIST-SPOON", "qty": 20}
+"""
+
+
+def test_reads_csv_and_jsonl_feeds_alike():
+    from_csv = list(batch_import.read_batches(io.StringIO(CSV_FEED), "csv"))
+    from_jsonl = list(batch_import.read_batches(io.StringIO(JSONL_FEED), "jsonl"))
+
+    assert (
+        from_csv
+        == from_jsonl
+        == [
+            commands.CreateBatch("batch1", "RETRO-CLOCK", 100, None),
+            commands.CreateBatch("batch2", "RETRO-CLOCK", 50, date(2011, 1, 2)),
+            commands.CreateBatch("batch3", "MINIMALIST-SPOON", 20, None),
+        ]
+    )
+
+
+def test_imports_batches_in_chunks(session_factory):
+    session = session_factory()
+    session.execute(
+        "INSERT INTO products (sku, version_number) VALUES ('RETRO-CLOCK', 3)"
+    )
+    session.commit()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    bus = messagebus.MessageBus(uow)
+
+    feed = batch_import.read_batches(io.StringIO(CSV_FEED), "csv")
+    assert batch_import.import_batches(bus, feed, chunk_size=2) == 3
+
+    # one version bump per sku per chunk
+    assert list(session.execute("SELECT sku, version_number FROM products")) == [
+        ("RETRO-CLOCK", 4),
+        ("MINIMALIST-SPOON", 1),
+    ]
+    with uow:
+        product = uow.products.get(sku="RETRO-CLOCK")
+        assert [b.reference for b in product.batches] == ["batch1", "batch2"]
+        line = model.OrderLine("o1", "RETRO-CLOCK", 10)
+        assert product.allocate(line) == "batch1"
+
+
+def test_bulk_writes_raise_batch_created_events(session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+
+    with uow:
+        uow.products.add_batches(
+            [
+                events.BatchCreated("batch1", "RETRO-CLOCK", 100, None),
+                events.BatchCreated("batch2", "RETRO-CLOCK", 50, date(2011, 1, 2)),
+            ]
+        )
+        uow.commit()
+        new_events = list(uow.collect_new_events())
+
+    assert new_events == [
+        events.BatchCreated("batch1", "RETRO-CLOCK", 100, None),
+        events.BatchCreated("batch2", "RETRO-CLOCK", 50, date(2011, 1, 2)),
+    ]
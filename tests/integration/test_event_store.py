@@ -0,0 +1,103 @@
+from datetime import date
+
+import pytest
+from sqlalchemy import select
+
+from allocation.adapters import orm
+from allocation.domain import commands, model
+from allocation.service_layer import messagebus, unit_of_work
+
+
+def event_sourced_uow(session_factory, snapshot_every=100):
+    return unit_of_work.SqlAlchemyUnitOfWork(
+        session_factory, event_sourcing=dict(snapshot_every=snapshot_every)
+    )
+
+
+def test_products_are_rebuilt_from_their_events(session_factory):
+    bus = messagebus.MessageBus(event_sourced_uow(session_factory))
+    bus.handle(commands.CreateBatch("in-stock", "SOURCED-LAMP", 20, None))
+    bus.handle(commands.CreateBatch("shipment", "SOURCED-LAMP", 50, date.today()))
+    bus.handle(commands.Allocate("o1", "SOURCED-LAMP", 10))
+    bus.handle(commands.Allocate("o2", "SOURCED-LAMP", 8))
+    bus.handle(commands.ChangeBatchQuantity("in-stock", 12))
+
+    with event_sourced_uow(session_factory) as uow:
+        product = uow.products.get("SOURCED-LAMP")
+        in_stock, shipment = product.batches
+        assert in_stock.available_quantity == 2
+        assert shipment.available_quantity == 42
+        assert product.version_number == 6
+        assert uow.allocations_view.for_order("o2") == [
+            dict(sku="SOURCED-LAMP", batchref="shipment")
+        ]
+
+    session = session_factory()
+    assert session.execute(select(orm.batches.c.id)).all() == []
+    types = session.execute(
+        select(orm.product_events.c.type).order_by(orm.product_events.c.position)
+    ).scalars()
+    assert list(types) == [
+        "BatchCreated",
+        "BatchCreated",
+        "Allocated",
+        "Allocated",
+        "BatchQuantityChanged",
+        "Deallocated",
+        "Allocated",
+    ]
+
+
+def test_snapshots_are_taken_every_n_events(session_factory):
+    bus = messagebus.MessageBus(event_sourced_uow(session_factory, snapshot_every=3))
+    bus.handle(commands.CreateBatch("batch1", "SOURCED-RUG", 100, None))
+    for i in range(7):
+        bus.handle(commands.Allocate(f"o{i}", "SOURCED-RUG", 1))
+
+    session = session_factory()
+    [(position,)] = session.execute(select(orm.product_snapshots.c.position))
+    assert position == 6
+
+    with event_sourced_uow(session_factory) as uow:
+        product = uow.products.get("SOURCED-RUG")
+        assert product.batches[0].available_quantity == 93
+        assert product.version_number == 8
+        assert [line.orderid for line in product.batches[0]._allocations] == [
+            f"o{i}" for i in range(7)
+        ]
+
+
+def test_a_stale_append_is_a_concurrent_modification(session_factory):
+    messagebus.MessageBus(event_sourced_uow(session_factory)).handle(
+        commands.CreateBatch("batch1", "SOURCED-DESK", 100, None)
+    )
+
+    with event_sourced_uow(session_factory) as first:
+        product = first.products.get("SOURCED-DESK")
+        with event_sourced_uow(session_factory) as second:
+            line = model.OrderLine("o2", "SOURCED-DESK", 1)
+            second.products.get("SOURCED-DESK").allocate(line)
+            second.commit()
+
+        product.allocate(model.OrderLine("o1", "SOURCED-DESK", 1))
+        with pytest.raises(unit_of_work.ConcurrentModification):
+            first.commit()
+
+
+def test_imported_batches_are_found_by_reference(session_factory):
+    bus = messagebus.MessageBus(event_sourced_uow(session_factory))
+    bus.handle(commands.CreateBatch("batch1", "SOURCED-SOFA", 10, None))
+    bus.handle(
+        commands.ImportBatches(
+            [
+                commands.CreateBatch("batch2", "SOURCED-SOFA", 20, None),
+                commands.CreateBatch("batch3", "SOURCED-CHAIR", 30, None),
+            ]
+        )
+    )
+
+    with event_sourced_uow(session_factory) as uow:
+        sofa = uow.products.get_by_batchref("batch2")
+        assert [b.reference for b in sofa.batches] == ["batch1", "batch2"]
+        assert sofa.version_number == 2
+        assert uow.products.get_by_batchref("batch3").sku == "SOURCED-CHAIR"
@@ -1,3 +1,7 @@
+from allocation.adapters import orm
+from allocation.domain import model
+
+
 # def test_orderline_mapper_can_load_lines(session):
 #     session.execute(
 #         "INSERT INTO order_lines (orderid, sku, qty) VALUES "
@@ -22,3 +26,49 @@
 #
 #     rows = list(session.execute('SELECT orderid, sku, qty FROM "order_lines"'))
 #     assert rows == [("order1", "DECORATIVE-WIDGET", 12)]
+
+
+def test_upgrade_schema_adds_missing_indexes(in_memory_db):
+    for index in orm.batches.indexes:
+        index.drop(bind=in_memory_db)
+
+    orm.upgrade_schema(in_memory_db)
+
+    index_names = {
+        name
+        for [name] in in_memory_db.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index'"
+        )
+    }
+    assert {index.name for index in orm.batches.indexes} <= index_names
+
+
+def test_loaded_lines_share_one_sku_string(session):
+    session.execute(
+        "INSERT INTO order_lines (orderid, sku, qty) VALUES "
+        '("order1", "RED-CHAIR", 12),'
+        '("order2", "RED-CHAIR", 13)'
+    )
+
+    line1, line2 = session.query(model.OrderLine).all()
+
+    assert line1.sku is line2.sku
+    assert not session.dirty
+
+
+def test_allocations_load_in_the_order_they_were_made(session):
+    batch = model.Batch("batch1", "TEAL-CHAIR", 100, eta=None)
+    for orderid in ("order3", "order1", "order2"):
+        batch.allocate(model.OrderLine(orderid, "TEAL-CHAIR", 1))
+    session.add(batch)
+    session.commit()
+    session.expunge_all()
+
+    loaded = session.query(model.Batch).one()
+
+    assert isinstance(loaded._allocations, model.AllocationSet)
+    assert [line.orderid for line in reversed(loaded._allocations)] == [
+        "order2",
+        "order1",
+        "order3",
+    ]
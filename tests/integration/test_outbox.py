@@ -0,0 +1,76 @@
+from datetime import date
+
+from allocation.domain import commands
+from allocation.entrypoints.outbox_publisher import OutboxPublisher
+from allocation.service_layer import messagebus, unit_of_work
+
+today = date.today()
+
+
+def outbox_bus(session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory, outbox=True)
+    return messagebus.MessageBus(uow)
+
+
+def allocations_for(orderid, session_factory):
+    with unit_of_work.SqlAlchemyUnitOfWork(session_factory) as uow:
+        return uow.allocations_view.for_order(orderid)
+
+
+def pending_event_types(session):
+    return [
+        type
+        for [type] in session.execute(
+            "SELECT type FROM outbox WHERE processed_at IS NULL ORDER BY id"
+        )
+    ]
+
+
+def test_events_are_saved_with_the_commit_and_handled_by_the_publisher(
+    session_factory,
+):
+    bus = outbox_bus(session_factory)
+    bus.handle(commands.CreateBatch("b1", "sku1", 50, None))
+    bus.handle(commands.Allocate("o1", "sku1", 20))
+
+    session = session_factory()
+    assert pending_event_types(session) == ["BatchCreated", "Allocated"]
+    assert allocations_for("o1", session_factory) == []
+
+    publisher = OutboxPublisher(lambda: outbox_bus(session_factory), session_factory)
+    assert publisher.publish_pending() == 2
+
+    assert allocations_for("o1", session_factory) == [
+        {"sku": "sku1", "batchref": "b1"}
+    ]
+    assert pending_event_types(session) == []
+    assert publisher.publish_pending() == 0
+
+
+def test_follow_up_events_go_back_to_the_outbox(session_factory):
+    bus = outbox_bus(session_factory)
+    bus.handle(commands.CreateBatch("b1", "sku1", 50, None))
+    bus.handle(commands.CreateBatch("b2", "sku1", 50, today))
+    bus.handle(commands.Allocate("o1", "sku1", 40))
+    bus.handle(commands.ChangeBatchQuantity("b1", 10))
+    publisher = OutboxPublisher(lambda: outbox_bus(session_factory), session_factory)
+
+    publisher.publish_pending()  # reallocates o1
+    session = session_factory()
+    assert pending_event_types(session) == ["Allocated"]
+    publisher.publish_pending()
+
+    assert allocations_for("o1", session_factory) == [
+        {"sku": "sku1", "batchref": "b2"}
+    ]
+
+
+def test_uncommitted_events_are_not_saved(session_factory):
+    bus = outbox_bus(session_factory)
+    bus.handle(commands.CreateBatch("b1", "sku1", 50, None))
+
+    with unit_of_work.SqlAlchemyUnitOfWork(session_factory, outbox=True) as uow:
+        product = uow.products.get("sku1")
+        product.change_batch_quantity("b1", 10)
+
+    assert pending_event_types(session_factory()) == ["BatchCreated"]
@@ -1,3 +1,6 @@
+import pytest
+from sqlalchemy import event
+
 from allocation.domain import model
 from allocation.adapters import repository
 
@@ -66,3 +69,102 @@ def test_repository_can_retrieve_a_batch_with_allocations(session):
     assert retrieved._allocations == {
         model.OrderLine("order1", "GENERIC-SOFA", 12),
     }
+
+
+def insert_product_with_allocated_batches(session, sku, n_batches):
+    session.execute(
+        "INSERT INTO products (sku, version_number) VALUES (:sku, 1)", dict(sku=sku)
+    )
+    for i in range(n_batches):
+        session.execute(
+            "INSERT INTO batches (reference, sku, _purchased_quantity, eta)"
+            " VALUES (:ref, :sku, 10, :eta)",
+            dict(ref=f"{sku}-batch{i}", sku=sku, eta=f"2011-01-{i + 1:02d}"),
+        )
+    product = repository.SqlAlchemyRepository(session).get(sku)
+    for i in range(n_batches):
+        product.allocate(model.OrderLine(f"{sku}-order{i}", sku, 10))
+    session.execute(
+        "INSERT INTO batches (reference, sku, _purchased_quantity, eta)"
+        " VALUES (:ref, :sku, 10, '2012-01-01')",
+        dict(ref=f"{sku}-later", sku=sku),
+    )
+    session.commit()
+
+
+@pytest.mark.parametrize("loading", ["selectin", "joined", "single_query"])
+def test_statements_per_allocation_do_not_grow_with_batches(
+    loading, in_memory_db, session_factory
+):
+    statement_counts = []
+    for n_batches in (1, 10):
+        sku = f"SOFT-CUSHION-{n_batches}"
+        insert_product_with_allocated_batches(session_factory(), sku, n_batches)
+
+        statements = []
+
+        def count_statement(*args):
+            statements.append(args)
+
+        event.listen(in_memory_db, "before_cursor_execute", count_statement)
+        session = session_factory()
+        product = repository.SqlAlchemyRepository(session, loading).get(sku)
+        batchref = product.allocate(model.OrderLine("new-order", sku, 10))
+        assert batchref == f"{sku}-later"
+        session.commit()
+        event.remove(in_memory_db, "before_cursor_execute", count_statement)
+        statement_counts.append(len(statements))
+
+    assert statement_counts[0] == statement_counts[1]
+
+
+@pytest.mark.parametrize("loading", ["lazy", "selectin", "joined", "single_query"])
+def test_loading_strategies_hydrate_the_whole_aggregate(loading, session_factory):
+    insert_product_with_allocated_batches(session_factory(), "PLUMP-CUSHION", 3)
+
+    repo = repository.SqlAlchemyRepository(session_factory(), loading)
+    product = repo.get_by_batchref("PLUMP-CUSHION-batch1")
+
+    assert [b.reference for b in product.batches] == [
+        "PLUMP-CUSHION-batch0",
+        "PLUMP-CUSHION-batch1",
+        "PLUMP-CUSHION-batch2",
+        "PLUMP-CUSHION-later",
+    ]
+    assert [b.available_quantity for b in product.batches] == [0, 0, 0, 10]
+
+
+@pytest.mark.parametrize("loading", ["lazy", "selectin", "joined", "single_query"])
+def test_loading_strategies_keep_allocations_in_the_order_they_were_made(
+    loading, session_factory
+):
+    session = session_factory()
+    session.execute(
+        "INSERT INTO products (sku, version_number) VALUES ('TALL-LAMP', 1)"
+    )
+    batch_id = session.execute(
+        "INSERT INTO batches (reference, sku, _purchased_quantity, eta)"
+        " VALUES ('TALL-LAMP-batch', 'TALL-LAMP', 100, null)"
+    ).lastrowid
+    line_ids = {}
+    for orderid in ("order1", "order2", "order3"):
+        line_ids[orderid] = session.execute(
+            "INSERT INTO order_lines (orderid, sku, qty)"
+            " VALUES (:orderid, 'TALL-LAMP', 1)",
+            dict(orderid=orderid),
+        ).lastrowid
+    # allocated in another order than the lines were created in
+    for orderid in ("order3", "order1", "order2"):
+        insert_allocation(session, line_ids[orderid], batch_id)
+    session.commit()
+
+    product = repository.SqlAlchemyRepository(session_factory(), loading).get(
+        "TALL-LAMP"
+    )
+
+    [batch] = product.batches
+    assert [line.orderid for line in batch._allocations] == [
+        "order3",
+        "order1",
+        "order2",
+    ]
@@ -4,8 +4,12 @@ import time
 import traceback
 from typing import List
 import pytest
-from allocation.domain import model
-from allocation.service_layer import unit_of_work
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import IntegrityError
+from allocation import metrics
+from allocation.adapters.repository import ProductCache
+from allocation.domain import commands, model
+from allocation.service_layer import handlers, messagebus, unit_of_work
 from ..random_refs import random_sku, random_batchref, random_orderid
 
 
@@ -50,6 +54,39 @@ def test_uow_can_retrieve_a_batch_and_allocate_to_it(session_factory):
     assert batchref == 'batch1'
 
 
+def test_uow_rebuilds_allocated_quantity_of_loaded_batches(session_factory):
+    session = session_factory()
+    insert_batch(session, 'batch1', 'SHINY-LADDER', 100, None)
+    session.commit()
+
+    with unit_of_work.SqlAlchemyUnitOfWork(session_factory) as uow:
+        product = uow.products.get(sku='SHINY-LADDER')
+        product.allocate(model.OrderLine('o1', 'SHINY-LADDER', 10))
+        product.allocate(model.OrderLine('o2', 'SHINY-LADDER', 15))
+        uow.commit()
+
+    with unit_of_work.SqlAlchemyUnitOfWork(session_factory) as uow:
+        [batch] = uow.products.get(sku='SHINY-LADDER').batches
+        assert batch.allocated_quantity == 25
+        assert batch.available_quantity == 75
+
+
+def test_uow_loads_batches_in_eta_order(session_factory):
+    session = session_factory()
+    insert_batch(session, 'batch1', 'TIDY-DRESSER', 100, '2011-01-02')
+    session.execute(
+        'INSERT INTO batches (reference, sku, _purchased_quantity, eta) VALUES'
+        " ('batch2', 'TIDY-DRESSER', 100, null),"
+        " ('batch3', 'TIDY-DRESSER', 100, '2011-01-01')"
+    )
+    session.commit()
+
+    with unit_of_work.SqlAlchemyUnitOfWork(session_factory) as uow:
+        product = uow.products.get(sku='TIDY-DRESSER')
+        references = [b.reference for b in product.batches]
+        assert references == ['batch2', 'batch3', 'batch1']
+
+
 def test_rolls_back_uncommitted_work_by_default(session_factory):
     uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
     with uow:
@@ -75,6 +112,198 @@ def test_rolls_back_on_error(session_factory):
     assert rows == []
 
 
+def test_add_batch_retries_when_another_request_creates_the_product(session_factory):
+    class RacingUnitOfWork(unit_of_work.SqlAlchemyUnitOfWork):
+        raced = False
+
+        def _commit(self):
+            if not self.raced:
+                self.raced = True
+                handlers.add_batch(
+                    commands.CreateBatch("theirs", "RACY-SOFA", 10),
+                    unit_of_work.SqlAlchemyUnitOfWork(session_factory),
+                )
+            super()._commit()
+
+    # the first attempt loses the race to create the product, and the retry
+    # adds its batch to the one the other request created
+    handlers.add_batch(
+        commands.CreateBatch("ours", "RACY-SOFA", 10),
+        RacingUnitOfWork(session_factory),
+    )
+
+    with unit_of_work.SqlAlchemyUnitOfWork(session_factory) as uow:
+        product = uow.products.get(sku="RACY-SOFA")
+        assert [b.reference for b in product.batches] == ["theirs", "ours"]
+
+
+def test_a_duplicate_batch_reference_is_not_retried_as_a_conflict(session_factory):
+    class CountingUnitOfWork(unit_of_work.SqlAlchemyUnitOfWork):
+        commits = 0
+
+        def _commit(self):
+            self.commits += 1
+            super()._commit()
+
+    handlers.add_batch(
+        commands.CreateBatch("same-ref", "OLD-SOFA", 10),
+        unit_of_work.SqlAlchemyUnitOfWork(session_factory),
+    )
+    uow = CountingUnitOfWork(session_factory)
+
+    # a new product, but the batch reference is taken
+    with pytest.raises(IntegrityError, match="batches.reference"):
+        handlers.add_batch(commands.CreateBatch("same-ref", "NEW-SOFA", 10), uow)
+
+    assert uow.commits == 1
+
+
+def bump_version_behind_the_uows_back(session_factory, sku):
+    session = session_factory()
+    session.execute(
+        'UPDATE products SET version_number = version_number + 1 WHERE sku=:sku',
+        dict(sku=sku),
+    )
+    session.commit()
+
+
+def test_commit_raises_concurrent_modification_on_stale_version(session_factory):
+    session = session_factory()
+    insert_batch(session, 'batch1', 'RICKETY-CHAIR', 100, None)
+    session.commit()
+
+    with pytest.raises(unit_of_work.ConcurrentModification):
+        with unit_of_work.SqlAlchemyUnitOfWork(session_factory) as uow:
+            product = uow.products.get(sku='RICKETY-CHAIR')
+            product.allocate(model.OrderLine('o1', 'RICKETY-CHAIR', 10))
+            bump_version_behind_the_uows_back(session_factory, 'RICKETY-CHAIR')
+            uow.commit()
+
+
+class ConflictingUnitOfWork(unit_of_work.SqlAlchemyUnitOfWork):
+    def __init__(self, session_factory, sku, conflicts):
+        super().__init__(session_factory)
+        self.sku = sku
+        self.conflicts = conflicts
+
+    def _commit(self):
+        if self.conflicts:
+            self.conflicts -= 1
+            bump_version_behind_the_uows_back(self.session_factory, self.sku)
+        super()._commit()
+
+
+def test_allocate_retries_after_a_concurrent_modification(session_factory):
+    session = session_factory()
+    insert_batch(session, 'batch1', 'WOBBLY-CHAIR', 100, None, product_version=1)
+    session.commit()
+    uow = ConflictingUnitOfWork(session_factory, 'WOBBLY-CHAIR', conflicts=2)
+
+    bus = messagebus.MessageBus(uow)
+    [batchref] = bus.handle(commands.Allocate('o1', 'WOBBLY-CHAIR', 10))
+
+    assert batchref == 'batch1'
+    assert uow.conflicts == 0
+    [[version]] = session.execute(
+        'SELECT version_number FROM products WHERE sku=:sku', dict(sku='WOBBLY-CHAIR')
+    )
+    assert version == 4
+    assert get_allocated_batch_ref(session, 'o1', 'WOBBLY-CHAIR') == 'batch1'
+
+
+def test_allocate_many_retries_only_the_conflicting_sku(session_factory):
+    session = session_factory()
+    insert_batch(session, 'batch1', 'WOBBLY-TABLE', 100, None)
+    insert_batch(session, 'batch2', 'WOBBLY-LAMP', 100, None)
+    session.commit()
+    uow = ConflictingUnitOfWork(session_factory, 'WOBBLY-TABLE', conflicts=1)
+
+    [batchrefs] = messagebus.MessageBus(uow).handle(
+        commands.AllocateMany(
+            [
+                commands.Allocate('o1', 'WOBBLY-TABLE', 10),
+                commands.Allocate('o2', 'WOBBLY-LAMP', 10),
+            ]
+        )
+    )
+
+    assert batchrefs == ['batch1', 'batch2']
+    assert uow.conflicts == 0
+    assert get_allocated_batch_ref(session, 'o1', 'WOBBLY-TABLE') == 'batch1'
+    assert get_allocated_batch_ref(session, 'o2', 'WOBBLY-LAMP') == 'batch2'
+    rows = session.execute(
+        'SELECT orderid, batchref FROM allocations_view ORDER BY orderid'
+    )
+    assert list(rows) == [('o1', 'batch1'), ('o2', 'batch2')]
+
+
+def allocate_with_cache(session_factory, cache, orderid, sku, qty):
+    with unit_of_work.SqlAlchemyUnitOfWork(session_factory, cache) as uow:
+        product = uow.products.get(sku=sku)
+        batchref = product.allocate(model.OrderLine(orderid, sku, qty))
+        uow.commit()
+    return batchref
+
+
+def test_product_cache_serves_unchanged_products_without_reloading(
+    in_memory_db, session_factory
+):
+    session = session_factory()
+    insert_batch(session, 'batch1', 'CACHED-LAMP', 100, None)
+    session.commit()
+    cache = ProductCache()
+    allocate_with_cache(session_factory, cache, 'o1', 'CACHED-LAMP', 10)
+
+    statements = []
+    def count_statement(*args):
+        statements.append(args[2])
+    event.listen(in_memory_db, "before_cursor_execute", count_statement)
+    try:
+        with unit_of_work.SqlAlchemyUnitOfWork(session_factory, cache) as uow:
+            product = uow.products.get(sku='CACHED-LAMP')
+            assert product.batches[0].available_quantity == 90
+    finally:
+        event.remove(in_memory_db, "before_cursor_execute", count_statement)
+
+    assert len(statements) == 1  # just the version check
+    assert allocate_with_cache(session_factory, cache, 'o2', 'CACHED-LAMP', 10)
+    assert get_allocated_batch_ref(session, 'o2', 'CACHED-LAMP') == 'batch1'
+    assert cache.stats()['hits'] == 2
+
+
+def test_product_cache_reloads_products_changed_elsewhere(session_factory):
+    session = session_factory()
+    insert_batch(session, 'batch1', 'CACHED-RUG', 100, None)
+    session.commit()
+    cache = ProductCache()
+    allocate_with_cache(session_factory, cache, 'o1', 'CACHED-RUG', 10)
+
+    session.execute(
+        'UPDATE batches SET _purchased_quantity = 50 WHERE reference = :ref',
+        dict(ref='batch1'),
+    )
+    session.commit()
+    bump_version_behind_the_uows_back(session_factory, 'CACHED-RUG')
+
+    with unit_of_work.SqlAlchemyUnitOfWork(session_factory, cache) as uow:
+        product = uow.products.get(sku='CACHED-RUG')
+        assert product.batches[0].available_quantity == 40
+    assert cache.stats()['misses'] == 2
+
+
+def test_product_cache_skips_products_left_uncommitted(session_factory):
+    session = session_factory()
+    insert_batch(session, 'batch1', 'CACHED-SOFA', 100, None)
+    session.commit()
+    cache = ProductCache()
+
+    with unit_of_work.SqlAlchemyUnitOfWork(session_factory, cache) as uow:
+        product = uow.products.get(sku='CACHED-SOFA')
+        product.allocate(model.OrderLine('o1', 'CACHED-SOFA', 10))
+
+    assert cache.stats()['size'] == 0
+
+
 def try_to_allocate(orderid, sku, exceptions):
     line = model.OrderLine(orderid, sku, 10)
     try:
@@ -111,7 +340,7 @@ def test_concurrent_updates_to_version_are_not_allowed(postgres_session_factory)
     )
     assert version == 2
     [exception] = exceptions
-    assert 'could not serialize access due to concurrent update' in str(exception)
+    assert isinstance(exception, unit_of_work.ConcurrentModification)
 
     orders = list(session.execute(
         "SELECT orderid FROM allocations"
@@ -123,3 +352,75 @@ def test_concurrent_updates_to_version_are_not_allowed(postgres_session_factory)
     assert len(orders) == 1
     with unit_of_work.SqlAlchemyUnitOfWork() as uow:
         uow.session.execute('select 1')
+
+
+def test_pool_metrics_track_checkouts(tmp_path):
+    engine = create_engine(
+        f"sqlite:///{tmp_path / 'pool.db'}",
+        poolclass=unit_of_work.MeteredQueuePool,
+        pool_size=1,
+        max_overflow=1,
+    )
+    first, second = engine.connect(), engine.connect()
+
+    metrics = unit_of_work.pool_metrics(engine)
+    assert metrics['checked_out'] == 2
+    assert metrics['overflow'] == 1
+    assert metrics['checkouts'] == 2
+
+    first.close()
+    second.close()
+    assert unit_of_work.pool_metrics(engine)['checked_out'] == 0
+
+
+def test_concurrent_allocations_are_retried(postgres_session_factory):
+    sku, batch = random_sku(), random_batchref()
+    session = postgres_session_factory()
+    insert_batch(session, batch, sku, 100, eta=None, product_version=1)
+    session.commit()
+
+    order1, order2 = random_orderid(1), random_orderid(2)
+    threads = [
+        threading.Thread(
+            target=lambda orderid=orderid: handlers.allocate(
+                commands.Allocate(orderid, sku, 10),
+                unit_of_work.SqlAlchemyUnitOfWork(),
+            )
+        )
+        for orderid in (order1, order2)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    [[version]] = session.execute(
+        "SELECT version_number FROM products WHERE sku=:sku",
+        dict(sku=sku),
+    )
+    assert version == 3
+    assert get_allocated_batch_ref(session, order1, sku) == batch
+    assert get_allocated_batch_ref(session, order2, sku) == batch
+
+
+def test_uow_metrics_count_statements_per_unit_of_work(
+    in_memory_db, session_factory, monkeypatch
+):
+    monkeypatch.setattr(metrics, "enabled", True)
+    unit_of_work.instrument_engine(in_memory_db)
+    session = session_factory()
+    insert_batch(session, 'batch1', 'METERED-LAMP', 100, None)
+    session.commit()
+    statements_before = metrics.UOW_STATEMENTS.count()
+    commits_before = metrics.UOW_SECONDS.count(phase='commit')
+    selects_before = metrics.DB_STATEMENTS.value(statement='SELECT')
+
+    with unit_of_work.SqlAlchemyUnitOfWork(session_factory) as uow:
+        product = uow.products.get(sku='METERED-LAMP')
+        product.allocate(model.OrderLine('o1', 'METERED-LAMP', 10))
+        uow.commit()
+
+    assert metrics.UOW_STATEMENTS.count() == statements_before + 1
+    assert metrics.UOW_SECONDS.count(phase='commit') == commits_before + 1
+    assert metrics.DB_STATEMENTS.value(statement='SELECT') > selects_before
+    assert metrics.DB_STATEMENT_SECONDS.count(statement='UPDATE') >= 1
@@ -0,0 +1,69 @@
+from datetime import date
+
+import pytest
+from sqlalchemy.exc import IntegrityError
+
+from allocation.adapters import orm
+from allocation.domain import commands
+from allocation.service_layer import messagebus, unit_of_work
+
+today = date.today()
+
+
+def allocations_for(orderid, session_factory):
+    with unit_of_work.SqlAlchemyUnitOfWork(session_factory) as uow:
+        return uow.allocations_view.for_order(orderid)
+
+
+def test_allocations_view(session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    bus = messagebus.MessageBus(uow)
+    bus.handle(commands.CreateBatch("sku1batch", "sku1", 50, None))
+    bus.handle(commands.CreateBatch("sku2batch", "sku2", 50, today))
+    bus.handle(commands.Allocate("order1", "sku1", 20))
+    bus.handle(commands.Allocate("order1", "sku2", 20))
+    # add a spurious batch and order to make sure we're getting the right ones
+    bus.handle(commands.CreateBatch("sku1batch-later", "sku1", 50, today))
+    bus.handle(commands.Allocate("otherorder", "sku1", 30))
+    bus.handle(commands.Allocate("otherorder", "sku2", 10))
+
+    assert allocations_for("order1", session_factory) == [
+        {"sku": "sku1", "batchref": "sku1batch"},
+        {"sku": "sku2", "batchref": "sku2batch"},
+    ]
+
+
+def test_deallocation(session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    bus = messagebus.MessageBus(uow)
+    bus.handle(commands.CreateBatch("b1", "sku1", 50, None))
+    bus.handle(commands.CreateBatch("b2", "sku1", 50, today))
+    bus.handle(commands.Allocate("o1", "sku1", 40))
+    bus.handle(commands.ChangeBatchQuantity("b1", 10))
+
+    assert allocations_for("o1", session_factory) == [
+        {"sku": "sku1", "batchref": "b2"},
+    ]
+
+
+def test_read_model_handlers_are_idempotent_and_tolerate_reordering(session_factory):
+    with unit_of_work.SqlAlchemyUnitOfWork(session_factory) as uow:
+        uow.allocations_view.add([("o1", "sku1", "b1")])
+        uow.allocations_view.add([("o1", "sku1", "b1")])
+        # reallocated to b2, and the Allocated got here before the Deallocated
+        uow.allocations_view.add([("o1", "sku1", "b2")])
+        uow.allocations_view.remove([("o1", "sku1", "b1")])
+        uow.commit()
+
+    assert allocations_for("o1", session_factory) == [
+        {"sku": "sku1", "batchref": "b2"},
+    ]
+
+
+def test_an_order_has_one_row_per_sku(session_factory):
+    session = session_factory()
+    row = dict(orderid="o1", sku="sku1", batchref="b1")
+    with pytest.raises(IntegrityError):
+        session.execute(
+            orm.allocations_view.insert(), [row, dict(row, batchref="b2")]
+        )
@@ -1,5 +1,9 @@
-from allocation.adapters import repository
-from allocation.domain import events
+import itertools
+import time
+from collections import defaultdict
+
+from allocation.adapters import broker, repository, views
+from allocation.domain import events, model
 from allocation.service_layer import handlers, messagebus, unit_of_work
 
 from allocation.domain import commands
@@ -22,14 +26,91 @@ class FakeRepository(repository.AbstractRepository):
             None,
         )
 
+    def _add_batches(self, batches):
+        for created in batches:
+            batch = model.Batch(created.ref, created.sku, created.qty, created.eta)
+            product = self._get(batch.sku)
+            if product is None:
+                product = model.Product(batch.sku, batches=[])
+                self._products.add(product)
+            product.batches = sorted(product.batches + [batch], key=model.eta_order)
+            product.version_number += 1
+
+
+class FakeAllocationsView(views.AbstractAllocationsView):
+    def __init__(self):
+        self.rows = []
+
+    def add(self, rows):
+        for orderid, sku, batchref in rows:
+            self.rows = [r for r in self.rows if r[:2] != (orderid, sku)]
+            self.rows.append((orderid, sku, batchref))
+
+    def remove(self, rows):
+        for row in rows:
+            if row in self.rows:
+                self.rows.remove(row)
+
+    def for_order(self, orderid):
+        return [dict(sku=s, batchref=b) for o, s, b in self.rows if o == orderid]
+
+
+class FakeBroker(broker.AbstractBroker):
+    # an in-process stand-in for redis streams and consumer groups
+    def __init__(self):
+        self.streams = defaultdict(list)
+        # (stream, group) -> [next position, {pending id: [read at, deliveries]}]
+        self.groups = {}
+        self.round_trips = 0
+        self._ids = itertools.count(1)
+
+    def publish(self, stream, messages):
+        self.round_trips += 1
+        for fields in messages:
+            self.streams[stream].append((f"{next(self._ids)}-0", dict(fields)))
+
+    def create_group(self, stream, group):
+        self.groups.setdefault((stream, group), [0, {}])
+
+    def read_group(self, streams, group, consumer, count, block_ms):
+        # like XREADGROUP, count applies to each stream
+        messages = []
+        for stream in streams:
+            position, pending = self.groups[stream, group]
+            entries = self.streams[stream][position : position + count]
+            for id, fields in entries:
+                messages.append((stream, id, fields))
+                pending[id] = [time.monotonic(), 1]
+            self.groups[stream, group][0] = position + len(entries)
+        return messages
+
+    def claim_stale(self, streams, group, consumer, min_idle_ms, count):
+        claimed = []
+        now = time.monotonic()
+        for stream in streams:
+            pending = self.groups[stream, group][1]
+            entries = dict(self.streams[stream])
+            for id, (read_at, deliveries) in list(pending.items())[:count]:
+                if (now - read_at) * 1000 >= min_idle_ms:
+                    pending[id] = [now, deliveries + 1]
+                    claimed.append(((stream, id, entries[id]), deliveries + 1))
+        return claimed
+
+    def ack(self, stream, group, ids):
+        for id in ids:
+            self.groups[stream, group][1].pop(id, None)
+
 
 class FakeUnitOfWork(unit_of_work.AbstractUnitOfWork):
     def __init__(self):
         self.products = FakeRepository([])
+        self.allocations_view = FakeAllocationsView()
         self.committed = False
+        self.commits = 0
 
     def _commit(self):
         self.committed = True
+        self.commits += 1
 
     def rollback(self):
         pass
@@ -1,5 +1,5 @@
 from datetime import date
-from allocation.domain.model import Batch, OrderLine
+from allocation.domain.model import AllocationSet, Batch, OrderLine
 
 
 def test_allocating_to_a_batch_reduces_the_available_quantity():
@@ -51,3 +51,25 @@ def test_can_only_deallocate_allocated_lines():
     batch.deallocate(unallocated_line)
     assert batch.available_quantity == 20
 
+def test_allocated_quantity_is_rebuilt_once_invalidated():
+    batch = Batch("batch-001", "GREEN-VASE", 20, eta=None)
+    batch._allocations = {
+        OrderLine("order-1", "GREEN-VASE", 2),
+        OrderLine("order-2", "GREEN-VASE", 3),
+    }
+    batch._allocated_quantity = None
+    assert batch.available_quantity == 15
+    batch.allocate(OrderLine("order-3", "GREEN-VASE", 4))
+    assert batch.available_quantity == 11
+
+
+def test_allocations_and_their_copy_change_independently():
+    first, second = OrderLine("o1", "LAMP", 1), OrderLine("o2", "LAMP", 1)
+    allocations = AllocationSet([first])
+    copy = allocations.copy()
+
+    allocations.add(second)
+    copy.discard(first)
+
+    assert list(allocations) == [first, second]
+    assert list(copy) == []
@@ -0,0 +1,137 @@
+import threading
+
+from allocation.domain import commands
+from allocation.service_layer.coalescing import AllocationCoalescer
+from allocation.service_layer.handlers import InvalidSku
+from allocation.service_layer.messagebus import MessageBus
+from tests.unit.mocks import FakeUnitOfWork
+
+
+def allocate_from_threads(coalescer, allocations):
+    outcomes = [None] * len(allocations)
+
+    def allocate(position, command):
+        try:
+            outcomes[position] = coalescer.allocate(command)
+        except Exception as e:
+            outcomes[position] = e
+
+    threads = [
+        threading.Thread(target=allocate, args=(position, command))
+        for position, command in enumerate(allocations)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return outcomes
+
+
+def test_requests_for_a_sku_arriving_together_share_one_commit():
+    uow = FakeUnitOfWork()
+    bus = MessageBus(uow)
+    bus.handle(commands.CreateBatch("b1", "GROUPED-LAMP", 3, None))
+    commits_before = uow.commits
+    # the group closes as soon as all five are in, long before the window ends
+    coalescer = AllocationCoalescer(lambda: bus, window_seconds=5, max_batch=5)
+
+    outcomes = allocate_from_threads(
+        coalescer,
+        [commands.Allocate(f"o{i}", "GROUPED-LAMP", 1) for i in range(5)],
+    )
+
+    # one for the allocations, and one for the read model
+    assert uow.commits - commits_before == 2
+    assert sorted(outcomes, key=str) == [None, None, "b1", "b1", "b1"]
+
+
+def test_a_request_on_its_own_is_allocated_once_the_window_ends():
+    uow = FakeUnitOfWork()
+    bus = MessageBus(uow)
+    bus.handle(commands.CreateBatch("b1", "GROUPED-RUG", 10, None))
+    coalescer = AllocationCoalescer(lambda: bus, window_seconds=0.01)
+
+    assert coalescer.allocate(commands.Allocate("o1", "GROUPED-RUG", 1)) == "b1"
+    assert coalescer.allocate(commands.Allocate("o2", "GROUPED-RUG", 1)) == "b1"
+    assert uow.commits == 1 + 2 * 2
+
+
+def test_every_caller_for_an_unknown_sku_gets_invalid_sku():
+    bus = MessageBus(FakeUnitOfWork())
+    coalescer = AllocationCoalescer(lambda: bus, window_seconds=5, max_batch=3)
+
+    outcomes = allocate_from_threads(
+        coalescer, [commands.Allocate(f"o{i}", "NO-SUCH-SKU", 1) for i in range(3)]
+    )
+
+    assert all(isinstance(outcome, InvalidSku) for outcome in outcomes)
+
+
+def test_a_failed_group_is_retried_line_by_line():
+    class Bus:
+        def __init__(self):
+            self.handled = []
+
+        def handle(self, command):
+            self.handled.append(type(command).__name__)
+            if isinstance(command, commands.AllocateMany):
+                raise ValueError("one bad line")
+            if command.orderid == "bad":
+                raise ValueError("bad line")
+            return [f"batch-for-{command.orderid}"]
+
+    bus = Bus()
+    coalescer = AllocationCoalescer(lambda: bus, window_seconds=5, max_batch=3)
+
+    good, bad, other = allocate_from_threads(
+        coalescer,
+        [commands.Allocate(ref, "GROUPED-SOFA", 1) for ref in ("g", "bad", "o")],
+    )
+
+    assert (good, other) == ("batch-for-g", "batch-for-o")
+    assert isinstance(bad, ValueError)
+    assert bus.handled == ["AllocateMany", "Allocate", "Allocate", "Allocate"]
+
+
+def test_groups_are_kept_apart_by_sku():
+    uow = FakeUnitOfWork()
+    bus = MessageBus(uow)
+    bus.handle(commands.CreateBatch("lamps", "GROUPED-LAMP", 10, None))
+    bus.handle(commands.CreateBatch("chairs", "GROUPED-CHAIR", 10, None))
+    commits_before = uow.commits
+    coalescer = AllocationCoalescer(lambda: bus, window_seconds=5, max_batch=2)
+
+    outcomes = allocate_from_threads(
+        coalescer,
+        [
+            commands.Allocate("o1", "GROUPED-LAMP", 1),
+            commands.Allocate("o2", "GROUPED-CHAIR", 1),
+            commands.Allocate("o3", "GROUPED-LAMP", 1),
+            commands.Allocate("o4", "GROUPED-CHAIR", 1),
+        ],
+    )
+
+    assert outcomes == ["lamps", "chairs", "lamps", "chairs"]
+    assert uow.commits - commits_before == 2 * 2
+
+
+def test_a_group_that_fails_after_committing_is_not_run_again():
+    class Bus:
+        def __init__(self):
+            self.handled = []
+
+        def handle(self, command):
+            self.handled.append(type(command).__name__)
+            # as a sharded bus whose worker died after the commit would
+            raise RuntimeError("lost the reply")
+
+    bus = Bus()
+    coalescer = AllocationCoalescer(lambda: bus, window_seconds=5, max_batch=3)
+
+    outcomes = allocate_from_threads(
+        coalescer,
+        [commands.Allocate(ref, "GROUPED-SOFA", 1) for ref in ("o1", "o2", "o3")],
+    )
+
+    assert all(isinstance(outcome, RuntimeError) for outcome in outcomes)
+    assert bus.handled == ["AllocateMany"]
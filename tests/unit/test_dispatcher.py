@@ -0,0 +1,89 @@
+import functools
+import threading
+import time
+
+from allocation.domain import commands, events
+from allocation.service_layer.dispatcher import EventDispatcher
+from allocation.service_layer.messagebus import MessageBus
+from tests.unit.mocks import FakeAllocationsView, FakeUnitOfWork
+
+
+class RecordingMessageBus(MessageBus):
+    def __init__(self, uow, dispatcher=None):
+        super().__init__(uow, dispatcher)
+        self.EVENT_HANDLERS = {
+            events.OutOfStock: [self.slow_handler],
+            events.BatchCreated: [],
+        }
+        self.handled = []
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+
+    def slow_handler(self, event, uow):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(0.05)
+        with self.lock:
+            self.running -= 1
+            self.handled.append((event, threading.current_thread().name))
+
+
+def test_commands_return_before_events_are_handled():
+    uow = FakeUnitOfWork()
+    bus = RecordingMessageBus(uow)
+    dispatcher = EventDispatcher(lambda: bus, max_workers=2)
+    bus.dispatcher = dispatcher
+    bus.handle(commands.CreateBatch("batch1", "LONELY-SOCK", 1, None))
+
+    [batchref] = bus.handle(commands.Allocate("o1", "LONELY-SOCK", 10))
+
+    assert batchref is None
+    assert bus.handled == []
+    dispatcher.shutdown()
+    [(event, thread_name)] = bus.handled
+    assert event == events.OutOfStock("LONELY-SOCK")
+    assert thread_name.startswith("event-worker")
+
+
+def test_limits_concurrent_runs_of_a_handler():
+    bus = RecordingMessageBus(FakeUnitOfWork())
+    dispatcher = EventDispatcher(
+        lambda: bus, max_workers=4, handler_limits={"slow_handler": 1}
+    )
+
+    # spread over the partitions, which would otherwise run them side by side;
+    # fresh partials, as the bus registers its publish handlers
+    for i in range(4):
+        dispatcher.dispatch(
+            functools.partial(bus.slow_handler), events.OutOfStock(f"LONELY-SOCK-{i}")
+        )
+    dispatcher.shutdown()
+
+    assert len(bus.handled) == 4
+    assert bus.max_running == 1
+
+
+class SlowAllocationsView(FakeAllocationsView):
+    def add(self, rows):
+        rows = list(rows)
+        time.sleep(0.05)
+        super().add(rows)
+
+
+def test_read_model_handlers_for_a_sku_run_in_the_order_raised():
+    uow = FakeUnitOfWork()
+    uow.allocations_view = SlowAllocationsView()
+    dispatcher = EventDispatcher(lambda: MessageBus(uow), max_workers=4)
+    bus = MessageBus(uow, dispatcher)
+
+    bus.handle_events(
+        [
+            events.Allocated("o1", "LONELY-SOCK", 1, "batch1"),
+            events.Deallocated("o1", "LONELY-SOCK", 1, "batch1"),
+        ]
+    )
+    dispatcher.shutdown()
+
+    assert uow.allocations_view.for_order("o1") == []
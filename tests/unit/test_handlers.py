@@ -1,8 +1,11 @@
 from datetime import date
 
+import pytest
+
 from allocation.domain import events, commands
+from allocation.service_layer import handlers
 from allocation.service_layer.messagebus import MessageBus
-from tests.unit.mocks import FakeMessageBus, FakeUnitOfWork
+from tests.unit.mocks import FakeBroker, FakeMessageBus, FakeUnitOfWork
 
 
 class TestAddBatch:
@@ -14,6 +17,38 @@ class TestAddBatch:
         assert uow.committed
 
 
+class TestImportBatches:
+    def test_creates_products_and_batches(self):
+        uow = FakeUnitOfWork()
+        messagebus = MessageBus(uow)
+        messagebus.handle(commands.CreateBatch("b1", "SHINY-SOFA", 10, None))
+        messagebus.handle(
+            commands.ImportBatches(
+                [
+                    commands.CreateBatch("b2", "SHINY-SOFA", 20, date.today()),
+                    commands.CreateBatch("b3", "DULL-SOFA", 30, None),
+                ]
+            )
+        )
+
+        shiny, dull = uow.products.get("SHINY-SOFA"), uow.products.get("DULL-SOFA")
+        assert [b.reference for b in shiny.batches] == ["b1", "b2"]
+        assert [b.reference for b in dull.batches] == ["b3"]
+        assert shiny.version_number == 2
+        assert uow.commits == 2
+
+    def test_raises_batch_created_events(self):
+        uow = FakeUnitOfWork()
+        handlers.import_batches(
+            commands.ImportBatches([commands.CreateBatch("b1", "DULL-SOFA", 30)]),
+            uow,
+        )
+
+        assert list(uow.collect_new_events()) == [
+            events.BatchCreated("b1", "DULL-SOFA", 30, None)
+        ]
+
+
 class TestAllocate:
     def test_allocate_returns_allocation(self):
         uow = FakeUnitOfWork()
@@ -29,6 +64,89 @@ class TestAllocate:
         assert len(batches) == 1
         assert batches[0].reference == "batch1"
 
+    def test_updates_the_allocations_view(self):
+        uow = FakeUnitOfWork()
+        messagebus = MessageBus(uow)
+        messagebus.handle(commands.CreateBatch("batch1", "FLUFFY-RUG", 100, None))
+        messagebus.handle(commands.Allocate("o1", "FLUFFY-RUG", 10))
+
+        assert uow.allocations_view.for_order("o1") == [
+            {"sku": "FLUFFY-RUG", "batchref": "batch1"}
+        ]
+
+    def test_errors_for_a_missing_sku(self):
+        messagebus = MessageBus(FakeUnitOfWork())
+
+        with pytest.raises(handlers.InvalidSku, match="Invalid sku None"):
+            messagebus.handle(commands.Allocate("o1", None, 10))
+
+
+class TestPublishing:
+    def test_publishes_out_of_stock_to_the_broker(self):
+        broker = FakeBroker()
+        messagebus = MessageBus(FakeUnitOfWork(), broker=broker)
+        messagebus.handle(commands.CreateBatch("b1", "EMPTY-VASE", 1, None))
+        messagebus.handle(commands.Allocate("o1", "EMPTY-VASE", 10))
+
+        [(_, fields)] = broker.streams["out_of_stock"]
+        assert fields == {"data": '{"sku": "EMPTY-VASE"}'}
+
+    def test_buses_without_a_broker_do_not_publish(self):
+        MessageBus(FakeUnitOfWork(), broker=FakeBroker())
+
+        assert len(MessageBus.EVENT_HANDLERS[events.OutOfStock]) == 1
+
+
+class TestAllocateMany:
+    def test_returns_a_batchref_per_line_in_order(self):
+        uow = FakeUnitOfWork()
+        messagebus = MessageBus(uow)
+        messagebus.handle(commands.CreateBatch("batch1", "ROUND-TABLE", 10, None))
+        messagebus.handle(commands.CreateBatch("batch2", "SQUARE-TABLE", 10, None))
+
+        [batchrefs] = messagebus.handle(
+            commands.AllocateMany(
+                [
+                    commands.Allocate("o1", "ROUND-TABLE", 5),
+                    commands.Allocate("o2", "SQUARE-TABLE", 5),
+                    commands.Allocate("o3", "ROUND-TABLE", 5),
+                    commands.Allocate("o4", "ROUND-TABLE", 5),
+                ]
+            )
+        )
+
+        assert batchrefs == ["batch1", "batch2", "batch1", None]
+        assert uow.committed
+
+    def test_errors_for_invalid_sku(self):
+        uow = FakeUnitOfWork()
+        messagebus = MessageBus(uow)
+
+        with pytest.raises(handlers.InvalidSku, match="Invalid sku NONEXISTENTSKU"):
+            messagebus.handle(
+                commands.AllocateMany([commands.Allocate("o1", "NONEXISTENTSKU", 1)])
+            )
+
+    def test_an_invalid_sku_allocates_none_of_the_lines(self):
+        uow = FakeUnitOfWork()
+        messagebus = MessageBus(uow)
+        messagebus.handle(commands.CreateBatch("b1", "STURDY-LAMP", 100, None))
+        commits_before = uow.commits
+
+        with pytest.raises(handlers.InvalidSku, match="Invalid sku NONEXISTENTSKU"):
+            messagebus.handle(
+                commands.AllocateMany(
+                    [
+                        commands.Allocate("o1", "STURDY-LAMP", 10),
+                        commands.Allocate("o2", "NONEXISTENTSKU", 10),
+                    ]
+                )
+            )
+
+        assert uow.commits == commits_before
+        assert uow.products.get("STURDY-LAMP").batches[0].available_quantity == 100
+        assert uow.allocations_view.for_order("o1") == []
+
 
 class TestChangeBatchQuantity:
     def test_changes_available_quantity(self):
@@ -42,29 +160,71 @@ class TestChangeBatchQuantity:
 
         assert batch.available_quantity == 50
 
-    # def test_reallocates_if_necessary(self):
-    #     uow = FakeUnitOfWork()
-    #     messagebus = MessageBus(uow)
-    #     event_history = [
-    #         commands.CreateBatch("batch1", "INDIFFERENT-TABLE", 50, None),
-    #         commands.CreateBatch("batch2", "INDIFFERENT-TABLE", 50, date.today()),
-    #         commands.Allocate("order1", "INDIFFERENT-TABLE", 20),
-    #         commands.Allocate("order2", "INDIFFERENT-TABLE", 20),
-    #     ]
-    #
-    #     for e in event_history:
-    #         messagebus.handle(e)
-    #
-    #     [batch1, batch2] = uow.products.get(sku="INDIFFERENT-TABLE").batches
-    #     assert batch1.available_quantity == 10
-    #     assert batch2.available_quantity == 50
-    #
-    #     messagebus.handle(commands.ChangeBatchQuantity("batch1", 25))
-    #
-    #     # order1 or order2 will be deallocated, so we'll have 25 - 20
-    #     assert batch1.available_quantity == 5
-    #     # and 20 will be reallocated to the next batch
-    #     assert batch2.available_quantity == 30
+    def test_deallocates_by_the_configured_policy(self, monkeypatch):
+        uow = FakeUnitOfWork()
+        messagebus = MessageBus(uow)
+        messagebus.handle(commands.CreateBatch("batch1", "WOBBLY-SHELF", 30, None))
+        messagebus.handle(commands.Allocate("order1", "WOBBLY-SHELF", 10))
+        messagebus.handle(commands.Allocate("order2", "WOBBLY-SHELF", 15))
+
+        monkeypatch.setenv("DEALLOCATION_POLICY", "last_allocated_first")
+        messagebus.handle(commands.ChangeBatchQuantity("batch1", 20))
+
+        [batch] = uow.products.get(sku="WOBBLY-SHELF").batches
+        assert [line.orderid for line in batch._allocations] == ["order1"]
+
+    def test_refuses_an_unknown_deallocation_policy(self, monkeypatch):
+        uow = FakeUnitOfWork()
+        messagebus = MessageBus(uow)
+        messagebus.handle(commands.CreateBatch("batch1", "WOBBLY-SHELF", 30, None))
+
+        monkeypatch.setenv("DEALLOCATION_POLICY", "random")
+        with pytest.raises(ValueError, match="Unknown DEALLOCATION_POLICY random"):
+            messagebus.handle(commands.ChangeBatchQuantity("batch1", 20))
+
+    def test_reallocates_if_necessary(self):
+        uow = FakeUnitOfWork()
+        messagebus = MessageBus(uow)
+        event_history = [
+            commands.CreateBatch("batch1", "INDIFFERENT-TABLE", 50, None),
+            commands.CreateBatch("batch2", "INDIFFERENT-TABLE", 50, date.today()),
+            commands.Allocate("order1", "INDIFFERENT-TABLE", 20),
+            commands.Allocate("order2", "INDIFFERENT-TABLE", 20),
+        ]
+
+        for e in event_history:
+            messagebus.handle(e)
+
+        [batch1, batch2] = uow.products.get(sku="INDIFFERENT-TABLE").batches
+        assert batch1.available_quantity == 10
+        assert batch2.available_quantity == 50
+
+        messagebus.handle(commands.ChangeBatchQuantity("batch1", 25))
+
+        # order1 or order2 will be deallocated, so we'll have 25 - 20
+        assert batch1.available_quantity == 5
+        # and 20 will be reallocated to the next batch
+        assert batch2.available_quantity == 30
+
+    def test_reallocates_deallocated_lines_in_a_single_commit(self):
+        uow = FakeUnitOfWork()
+        messagebus = MessageBus(uow)
+        messagebus.handle(commands.CreateBatch("batch1", "SHAKY-STOOL", 50, None))
+        messagebus.handle(
+            commands.CreateBatch("batch2", "SHAKY-STOOL", 50, date.today())
+        )
+        for i in range(5):
+            messagebus.handle(commands.Allocate(f"order{i}", "SHAKY-STOOL", 10))
+        commits_before = uow.commits
+
+        messagebus.handle(commands.ChangeBatchQuantity("batch1", 10))
+
+        [batch1, batch2] = uow.products.get(sku="SHAKY-STOOL").batches
+        assert batch1.available_quantity == 0
+        assert batch2.available_quantity == 10
+        # the change itself, then one each for all of the reallocations and for
+        # the read model's deallocations and allocations
+        assert uow.commits - commits_before == 4
 
     def test_reallocates_if_necessary_isolated(self):
         uow = FakeUnitOfWork()
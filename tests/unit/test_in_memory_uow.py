@@ -0,0 +1,139 @@
+import threading
+from datetime import date
+
+from allocation.adapters.repository import InMemoryStore
+from allocation.domain import commands, events
+from allocation.domain.model import Batch, OrderLine, Product
+from allocation.service_layer.messagebus import MessageBus
+from allocation.service_layer.unit_of_work import InMemoryUnitOfWork
+
+
+def test_bus_allocates_and_reallocates_over_the_in_memory_store():
+    store = InMemoryStore()
+    bus = MessageBus(InMemoryUnitOfWork(store))
+    bus.handle(commands.CreateBatch("in-stock", "MEMORY-LAMP", 20, None))
+    bus.handle(commands.CreateBatch("shipment", "MEMORY-LAMP", 50, date.today()))
+    [batchref] = bus.handle(commands.Allocate("o1", "MEMORY-LAMP", 10))
+    assert batchref == "in-stock"
+
+    bus.handle(commands.ChangeBatchQuantity("in-stock", 5))
+
+    [shipment] = [b for b in store.products["MEMORY-LAMP"].batches if b.eta]
+    assert shipment.available_quantity == 40
+    with InMemoryUnitOfWork(store) as uow:
+        assert uow.allocations_view.for_order("o1") == [
+            dict(sku="MEMORY-LAMP", batchref="shipment")
+        ]
+
+
+def test_indexes_batches_by_reference_once_committed():
+    store = InMemoryStore()
+    MessageBus(InMemoryUnitOfWork(store)).handle(
+        commands.ImportBatches(
+            [
+                commands.CreateBatch("b1", "MEMORY-RUG", 10),
+                commands.CreateBatch("b2", "MEMORY-SOFA", 10),
+            ]
+        )
+    )
+
+    assert store.skus_by_batchref == {"b1": "MEMORY-RUG", "b2": "MEMORY-SOFA"}
+    with InMemoryUnitOfWork(store) as uow:
+        assert uow.products.get_by_batchref("b2").sku == "MEMORY-SOFA"
+        assert uow.products.get_by_batchref("b3") is None
+
+
+def test_rolls_back_uncommitted_changes():
+    store = InMemoryStore()
+    with InMemoryUnitOfWork(store) as uow:
+        uow.products.add(
+            Product("MEMORY-DESK", [Batch("b1", "MEMORY-DESK", 10, None)])
+        )
+        uow.commit()
+
+    with InMemoryUnitOfWork(store) as uow:
+        product = uow.products.get("MEMORY-DESK")
+        product.allocate(OrderLine("o1", "MEMORY-DESK", 4))
+        product.change_batch_quantity("b1", 2)
+        uow.products.add(Product("MEMORY-CHAIR", []))
+        uow.allocations_view.add([("o1", "MEMORY-DESK", "b1")])
+
+    assert set(store.products) == {"MEMORY-DESK"}
+    assert product.version_number == 0
+    assert product.events == []
+    assert product.batches[0].available_quantity == 10
+    assert store.allocations == {}
+
+
+def test_only_changed_batches_have_their_allocations_copied():
+    store = InMemoryStore()
+    with InMemoryUnitOfWork(store) as uow:
+        uow.products.add(
+            Product(
+                "MEMORY-SHELF",
+                [
+                    Batch("b1", "MEMORY-SHELF", 10, None),
+                    Batch("b2", "MEMORY-SHELF", 10, date.today()),
+                ],
+            )
+        )
+        uow.products.get("MEMORY-SHELF").batches[1].allocate(
+            OrderLine("o1", "MEMORY-SHELF", 1)
+        )
+        uow.commit()
+    b1, b2 = store.products["MEMORY-SHELF"].batches
+    b1_lines, b2_lines = b1._allocations._lines, b2._allocations._lines
+
+    with InMemoryUnitOfWork(store) as uow:
+        uow.products.get("MEMORY-SHELF").allocate(OrderLine("o2", "MEMORY-SHELF", 1))
+
+    assert b2._allocations._lines is b2_lines
+    assert b1._allocations._lines is b1_lines
+    assert list(b1._allocations) == []
+
+
+def test_the_allocations_view_keeps_one_row_per_order_line():
+    store = InMemoryStore()
+    with InMemoryUnitOfWork(store) as uow:
+        uow.allocations_view.add([("o1", "MEMORY-LAMP", "b1")])
+        uow.allocations_view.add([("o1", "MEMORY-LAMP", "b2")])
+        uow.allocations_view.remove([("o1", "MEMORY-LAMP", "b1")])
+        uow.commit()
+
+    assert store.allocations == {"o1": [("MEMORY-LAMP", "b2")]}
+
+
+def test_commit_keeps_events_off_the_shared_products():
+    store = InMemoryStore()
+    uow = InMemoryUnitOfWork(store)
+    with uow:
+        uow.products.add(Product("MEMORY-BED", [Batch("b1", "MEMORY-BED", 10, None)]))
+        uow.products.get("MEMORY-BED").allocate(OrderLine("o1", "MEMORY-BED", 1))
+        uow.commit()
+
+    assert store.products["MEMORY-BED"].events == []
+    assert list(uow.collect_new_events()) == [
+        events.Allocated("o1", "MEMORY-BED", 1, "b1")
+    ]
+
+
+def test_units_of_work_on_many_threads_do_not_lose_allocations():
+    store = InMemoryStore()
+    MessageBus(InMemoryUnitOfWork(store)).handle(
+        commands.CreateBatch("b1", "MEMORY-STOOL", 1000, None)
+    )
+
+    def allocate(client):
+        bus = MessageBus(InMemoryUnitOfWork(store))
+        for i in range(50):
+            bus.handle(commands.Allocate(f"o-{client}-{i}", "MEMORY-STOOL", 1))
+
+    threads = [threading.Thread(target=allocate, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    [batch] = store.products["MEMORY-STOOL"].batches
+    assert batch.available_quantity == 1000 - 8 * 50
+    assert sum(len(lines) for lines in store.allocations.values()) == 8 * 50
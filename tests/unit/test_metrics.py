@@ -0,0 +1,78 @@
+import pytest
+
+from allocation import metrics
+from allocation.domain import commands
+from allocation.service_layer import messagebus
+from tests.unit.mocks import FakeUnitOfWork
+
+
+@pytest.fixture
+def enabled(monkeypatch):
+    monkeypatch.setattr(metrics, "enabled", True)
+
+
+def test_histogram_renders_cumulative_buckets(monkeypatch):
+    monkeypatch.setattr(metrics, "registry", [])
+    histogram = metrics.Histogram(
+        "test_seconds", "Test timings", ("handler",), buckets=(0.1, 1.0)
+    )
+    for value in (0.05, 0.5, 0.5, 5.0):
+        histogram.observe(value, handler="allocate")
+
+    assert metrics.render().splitlines() == [
+        "# HELP test_seconds Test timings",
+        "# TYPE test_seconds histogram",
+        'test_seconds_bucket{handler="allocate",le="0.1"} 1',
+        'test_seconds_bucket{handler="allocate",le="1.0"} 3',
+        'test_seconds_bucket{handler="allocate",le="+Inf"} 4',
+        'test_seconds_sum{handler="allocate"} 6.05',
+        'test_seconds_count{handler="allocate"} 4',
+    ]
+
+
+def test_counters_and_gauges_render_their_values(monkeypatch):
+    monkeypatch.setattr(metrics, "registry", [])
+    counter = metrics.Counter("test_total", "Things", ("kind",))
+    counter.inc(kind="a")
+    counter.inc(2, kind="b")
+    metrics.Gauge("test_depth", "Depth", lambda: 7)
+    metrics.CallbackCounter("test_hits_total", "Hits", lambda: 3)
+
+    lines = metrics.render().splitlines()
+    assert 'test_total{kind="a"} 1' in lines
+    assert 'test_total{kind="b"} 2' in lines
+    assert "test_depth 7" in lines
+    assert "# TYPE test_hits_total counter" in lines
+    assert "test_hits_total 3" in lines
+
+
+def test_timers_record_nothing_when_disabled(monkeypatch):
+    monkeypatch.setattr(metrics, "enabled", False)
+    histogram = metrics.Histogram("test_disabled_seconds", "Unused")
+    with histogram.time():
+        pass
+
+    assert histogram.count() == 0
+
+
+def test_bus_times_command_and_event_handlers(enabled):
+    bus = messagebus.MessageBus(FakeUnitOfWork())
+    handler_seconds = metrics.HANDLER_SECONDS
+    commands_before = handler_seconds.count(kind="command", handler="allocate")
+    events_before = handler_seconds.count(
+        kind="event", handler="add_allocations_to_read_model"
+    )
+    depths_before = metrics.QUEUE_DEPTH.count()
+
+    bus.handle(commands.CreateBatch("b1", "TIMED-LAMP", 100, None))
+    bus.handle(commands.Allocate("o1", "TIMED-LAMP", 10))
+
+    assert handler_seconds.count(kind="command", handler="allocate") == (
+        commands_before + 1
+    )
+    assert (
+        handler_seconds.count(kind="event", handler="add_allocations_to_read_model")
+        == events_before + 1
+    )
+    # CreateBatch, its BatchCreated, Allocate and its Allocated
+    assert metrics.QUEUE_DEPTH.count() == depths_before + 4
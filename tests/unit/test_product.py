@@ -1,6 +1,6 @@
 from datetime import date, timedelta
 
-from allocation.domain import events
+from allocation.domain import events, model
 from allocation.domain.model import Batch, OrderLine, Product
 
 today = date.today()
@@ -72,3 +72,79 @@ def test_records_out_of_stock_event_if_cannot_allocate():
     allocation = product.allocate(OrderLine("order2", sku, 1))
     assert product.events[-1] == events.OutOfStock(sku=sku)
     assert allocation is None
+
+
+def test_keeps_batches_in_eta_order_when_adding():
+    product = Product(sku="NEAT-SHELF", batches=[])
+    latest = Batch("slow-batch", "NEAT-SHELF", 100, eta=later)
+    earliest = Batch("speedy-batch", "NEAT-SHELF", 100, eta=today)
+    in_stock = Batch("in-stock-batch", "NEAT-SHELF", 100, eta=None)
+    medium = Batch("normal-batch", "NEAT-SHELF", 100, eta=tomorrow)
+
+    for batch in (latest, earliest, in_stock, medium):
+        product.add_batch(batch)
+
+    assert product.batches == [in_stock, earliest, medium, latest]
+
+
+def test_skips_fully_allocated_batches():
+    in_stock = Batch("in-stock-batch", "TALL-SHELF", 10, eta=None)
+    shipment = Batch("shipment-batch", "TALL-SHELF", 100, eta=tomorrow)
+    product = Product(sku="TALL-SHELF", batches=[shipment, in_stock])
+
+    assert product.allocate(OrderLine("order1", "TALL-SHELF", 10)) == "in-stock-batch"
+    assert product.allocate(OrderLine("order2", "TALL-SHELF", 10)) == "shipment-batch"
+
+
+def test_allocates_to_a_batch_again_once_its_quantity_grows():
+    in_stock = Batch("in-stock-batch", "WIDE-SHELF", 10, eta=None)
+    shipment = Batch("shipment-batch", "WIDE-SHELF", 100, eta=tomorrow)
+    product = Product(sku="WIDE-SHELF", batches=[in_stock, shipment])
+    product.allocate(OrderLine("order1", "WIDE-SHELF", 10))
+    product.allocate(OrderLine("order2", "WIDE-SHELF", 10))
+
+    product.change_batch_quantity("in-stock-batch", 20)
+
+    assert product.allocate(OrderLine("order3", "WIDE-SHELF", 10)) == "in-stock-batch"
+
+
+def product_with_lines(sku, *quantities):
+    batch = Batch(f"{sku}-batch", sku, sum(quantities), eta=None)
+    for i, qty in enumerate(quantities):
+        batch.allocate(OrderLine(f"order{i}", sku, qty))
+    return Product(sku=sku, batches=[batch]), batch
+
+
+def deallocated(product):
+    return [e.orderid for e in product.events if isinstance(e, events.Deallocated)]
+
+
+def test_shrinking_a_batch_evicts_the_fewest_lines_by_default():
+    product, batch = product_with_lines("SMALL-TABLE", 1, 1, 1, 10, 2, 20)
+
+    product.change_batch_quantity("SMALL-TABLE-batch", batch._purchased_quantity - 9)
+
+    assert deallocated(product) == ["order3"]
+    assert len(product.events) == 3
+    assert batch.available_quantity == 1
+
+
+def test_evicts_the_largest_lines_first_when_one_line_is_not_enough():
+    product, _ = product_with_lines("ROUND-TABLE", 5, 4, 3, 8)
+
+    product.change_batch_quantity("ROUND-TABLE-batch", 20 - 10)
+
+    # 8 alone is not enough, and 3 is the smallest that covers the rest
+    assert deallocated(product) == ["order3", "order2"]
+
+
+def test_deallocation_policy_can_be_chosen():
+    product, _ = product_with_lines("LONG-TABLE", 5, 4, 3, 8)
+    product.change_batch_quantity("LONG-TABLE-batch", 20 - 10, model.largest_first)
+    assert deallocated(product) == ["order3", "order0"]
+
+    product, _ = product_with_lines("SHORT-TABLE", 5, 4, 3, 8)
+    product.change_batch_quantity(
+        "SHORT-TABLE-batch", 20 - 10, model.last_allocated_first
+    )
+    assert deallocated(product) == ["order3", "order2"]
@@ -0,0 +1,51 @@
+from allocation.adapters.repository import ProductCache
+from allocation.domain.model import Batch, OrderLine, Product
+
+
+def make_product(sku, n_lines=0):
+    batch = Batch(f"{sku}-batch", sku, 100, eta=None)
+    for i in range(n_lines):
+        batch.allocate(OrderLine(f"order-{i}", sku, 1))
+    return Product(sku, [batch])
+
+
+def test_returns_cached_product_only_for_the_same_version():
+    cache = ProductCache()
+    product = make_product("LAMP")
+    cache.put(product)
+
+    assert cache.get("LAMP", product.version_number) is product
+    assert cache.get("LAMP", product.version_number + 1) is None
+    assert cache.get("RUG", 0) is None
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 2
+
+
+def test_evicts_least_recently_used_products():
+    cache = ProductCache(max_products=2)
+    lamp, rug, sofa = make_product("LAMP"), make_product("RUG"), make_product("SOFA")
+    cache.put(lamp)
+    cache.put(rug)
+    cache.get("LAMP", lamp.version_number)
+    cache.put(sofa)
+
+    assert cache.get("RUG", rug.version_number) is None
+    assert cache.get("LAMP", lamp.version_number) is lamp
+    assert cache.stats()["evictions"] == 1
+
+
+def test_evicts_products_to_stay_within_max_lines():
+    cache = ProductCache(max_lines=12)
+    cache.put(make_product("LAMP", n_lines=9))
+    cache.put(make_product("RUG", n_lines=4))
+
+    assert cache.stats()["size"] == 1
+    assert cache.stats()["lines"] == 5
+
+
+def test_replacing_a_product_does_not_count_its_lines_twice():
+    cache = ProductCache()
+    cache.put(make_product("LAMP", n_lines=9))
+    cache.put(make_product("LAMP", n_lines=9))
+
+    assert cache.stats()["lines"] == 10
@@ -0,0 +1,179 @@
+import asyncio
+import threading
+import time
+import warnings
+
+import pytest
+from sqlalchemy.util import greenlet_spawn
+
+from allocation.domain import commands, events
+from allocation.service_layer import handlers, retries, unit_of_work
+from allocation.service_layer.messagebus import MessageBus
+from tests.unit.mocks import FakeUnitOfWork
+
+
+class FlakyBus(MessageBus):
+    def __init__(self, uow, failures, retry_queue=None):
+        super().__init__(uow, retry_queue=retry_queue)
+        self.EVENT_HANDLERS = {
+            events.OutOfStock: [self.flaky_handler],
+            events.BatchCreated: [],
+        }
+        self.RETRY_POLICIES = {
+            self.flaky_handler: retries.RetryPolicy(max_attempts=3, base_delay=0.01)
+        }
+        self.failures = failures
+        self.calls = []
+        self.handled = threading.Event()
+
+    def flaky_handler(self, event, uow):
+        self.calls.append(threading.current_thread().name)
+        if self.failures:
+            raise self.failures.pop(0)
+        self.handled.set()
+
+
+def run_out_of_stock(bus):
+    bus.handle(commands.CreateBatch("b1", "FLAKY-SKU", 1, None))
+    bus.handle(commands.Allocate("o1", "FLAKY-SKU", 10))
+
+
+def test_transient_errors_are_retried():
+    bus = FlakyBus(FakeUnitOfWork(), [ConnectionError()] * 2)
+    before = retries.metrics.snapshot()["retries"].get("flaky_handler", 0)
+
+    run_out_of_stock(bus)
+
+    assert len(bus.calls) == 3
+    assert bus.handled.is_set()
+    assert retries.metrics.snapshot()["retries"]["flaky_handler"] == before + 2
+
+
+def test_permanent_errors_are_not_retried():
+    bus = FlakyBus(FakeUnitOfWork(), [handlers.InvalidSku("FLAKY-SKU")])
+
+    run_out_of_stock(bus)
+
+    assert len(bus.calls) == 1
+    assert retries.metrics.snapshot()["permanent_failures"]["flaky_handler"] >= 1
+
+
+def test_conflicts_are_left_to_the_handlers():
+    bus = FlakyBus(FakeUnitOfWork(), [unit_of_work.ConcurrentModification()])
+
+    run_out_of_stock(bus)
+
+    assert len(bus.calls) == 1
+
+
+def test_attempts_run_the_block_until_it_succeeds():
+    policy = retries.RetryPolicy(max_attempts=3, base_delay=0)
+    failures = [ConnectionError(), ConnectionError()]
+    runs = 0
+
+    for attempt in policy.attempts():
+        with attempt:
+            runs += 1
+            if failures:
+                raise failures.pop()
+
+    assert runs == 3
+
+
+def test_attempts_reraise_once_exhausted_or_permanent():
+    policy = retries.RetryPolicy(max_attempts=2, base_delay=0)
+    runs = []
+
+    with pytest.raises(TimeoutError):
+        for attempt in policy.attempts():
+            with attempt:
+                runs.append("timeout")
+                raise TimeoutError()
+    with pytest.raises(handlers.InvalidSku):
+        for attempt in policy.attempts():
+            with attempt:
+                runs.append("invalid")
+                raise handlers.InvalidSku()
+
+    assert runs == ["timeout", "timeout", "invalid"]
+
+
+def test_gives_up_after_max_attempts():
+    bus = FlakyBus(FakeUnitOfWork(), [TimeoutError()] * 5)
+
+    run_out_of_stock(bus)
+
+    assert len(bus.calls) == 3
+    assert retries.metrics.snapshot()["gave_up"]["flaky_handler"] >= 1
+
+
+def test_retries_wait_in_the_delay_queue_not_the_caller():
+    retry_queue = retries.DelayQueue(lambda: bus)
+    bus = FlakyBus(FakeUnitOfWork(), [ConnectionError()], retry_queue)
+
+    run_out_of_stock(bus)
+    assert not bus.handled.is_set()
+
+    assert bus.handled.wait(timeout=5)
+    retry_queue.shutdown()
+    assert bus.calls[-1].startswith("retry-worker")
+
+
+def test_a_slow_retry_does_not_hold_up_the_others_that_are_due():
+    class Bus:
+        def run_handler(self, handler, event, attempt):
+            handler(event)
+
+    finished = {}
+
+    def handler(event):
+        if event == "slow":
+            time.sleep(0.5)
+        finished[event] = time.monotonic()
+
+    retry_queue = retries.DelayQueue(Bus)
+    retry_queue.schedule(0, handler, "slow", 2)
+    retry_queue.schedule(0.01, handler, "quick", 2)
+    time.sleep(0.1)  # both are due by now
+    retry_queue.shutdown()
+
+    assert finished["quick"] < finished["slow"]
+
+
+def test_delays_grow_and_are_capped():
+    policy = retries.RetryPolicy(base_delay=1, max_delay=3)
+
+    assert all(0 <= policy.delay(1) <= 2 for _ in range(100))
+    assert all(0 <= policy.delay(10) <= 3 for _ in range(100))
+
+
+def test_pause_gives_way_to_other_greenlets_on_the_event_loop():
+    order = []
+
+    def handler(name):
+        order.append(f"{name} started")
+        retries.pause(0.01)
+        order.append(f"{name} finished")
+
+    async def run_both():
+        await asyncio.gather(
+            greenlet_spawn(handler, "a"), greenlet_spawn(handler, "b")
+        )
+
+    asyncio.run(run_both())
+
+    assert order == ["a started", "b started", "a finished", "b finished"]
+
+
+def test_pause_sleeps_the_thread_everywhere_else():
+    async def in_a_coroutine():
+        retries.pause(0.01)
+
+    with warnings.catch_warnings():
+        # an unawaited asyncio.sleep would warn
+        warnings.simplefilter("error")
+        started = time.perf_counter()
+        retries.pause(0.01)
+        asyncio.run(in_a_coroutine())
+
+    assert time.perf_counter() - started >= 0.02
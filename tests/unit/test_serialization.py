@@ -0,0 +1,25 @@
+from datetime import date
+
+import pytest
+
+from allocation.adapters import serialization
+from allocation.domain import events
+
+
+@pytest.mark.parametrize(
+    "event",
+    [
+        events.Allocated("o1", "LAMP", 10, "b1"),
+        events.BatchCreated("b1", "LAMP", 100, date(2011, 1, 2)),
+        events.BatchCreated("b2", "LAMP", 100, None),
+        events.OutOfStock("LAMP"),
+    ],
+)
+def test_events_survive_a_round_trip(event):
+    payload = serialization.dumps(event)
+
+    assert serialization.loads(type(event), payload) == event
+
+
+def test_channels_are_named_after_the_message_type():
+    assert serialization.channel_name(events.OutOfStock) == "out_of_stock"
@@ -0,0 +1,107 @@
+import os
+
+import pytest
+
+from allocation.domain import commands
+from allocation.service_layer import handlers
+from allocation.service_layer.messagebus import MessageBus
+from allocation.service_layer.sharding import ShardDied, ShardedMessageBus, shard_for
+from tests.unit.mocks import FakeUnitOfWork
+
+SKUS = [f"SKU-{i}" for i in range(8)]
+
+
+def fake_bus():
+    # each worker process gets its own in-memory products
+    return MessageBus(FakeUnitOfWork())
+
+
+def dying_bus():
+    bus = fake_bus()
+    handle = bus.handle
+
+    def handle_or_die(command):
+        if getattr(command, "orderid", None) == "die":
+            os._exit(1)
+        return handle(command)
+
+    bus.handle = handle_or_die
+    return bus
+
+
+@pytest.fixture(scope="module")
+def bus():
+    bus = ShardedMessageBus(3, fake_bus, sku_for_batchref=lambda ref: None)
+    yield bus
+    bus.close()
+
+
+def test_shards_are_stable_and_spread():
+    assert [shard_for(sku, 3) for sku in SKUS] == [shard_for(sku, 3) for sku in SKUS]
+    assert len({shard_for(sku, 3) for sku in SKUS}) == 3
+
+
+def test_commands_for_a_sku_reach_the_worker_that_owns_it(bus):
+    for sku in SKUS:
+        bus.handle(commands.CreateBatch(f"{sku}-batch", sku, 10))
+
+    for sku in SKUS:
+        assert bus.handle(commands.Allocate("o1", sku, 4)) == [f"{sku}-batch"]
+        bus.handle(commands.ChangeBatchQuantity(f"{sku}-batch", 5))
+        assert bus.handle(commands.Allocate("o2", sku, 4)) == [None]
+
+
+def test_allocate_many_is_split_across_shards(bus):
+    bus.handle(
+        commands.ImportBatches(
+            [commands.CreateBatch(f"{sku}-many", f"{sku}-MANY", 10) for sku in SKUS]
+        )
+    )
+    lines = [commands.Allocate("o1", f"{sku}-MANY", 1) for sku in reversed(SKUS)]
+
+    [batchrefs] = bus.handle(commands.AllocateMany(lines))
+
+    assert batchrefs == [f"{sku}-many" for sku in reversed(SKUS)]
+
+
+def test_errors_are_raised_to_the_caller(bus):
+    with pytest.raises(handlers.InvalidSku):
+        bus.handle(commands.Allocate("o1", "NONEXISTENT", 1))
+
+
+def test_batch_skus_are_cached_but_misses_are_not():
+    skus, looked_up = {}, []
+
+    def sku_for_batchref(ref):
+        looked_up.append(ref)
+        return skus.get(ref)
+
+    bus = ShardedMessageBus(1, fake_bus, sku_for_batchref, max_cached_batches=1)
+    try:
+        bus._shard_of(commands.ChangeBatchQuantity("b1", 5))
+        bus._shard_of(commands.ChangeBatchQuantity("b1", 5))
+        assert looked_up == ["b1", "b1"]
+
+        skus["b1"] = "SKU-0"
+        bus._shard_of(commands.ChangeBatchQuantity("b1", 5))
+        bus._shard_of(commands.ChangeBatchQuantity("b1", 5))
+        assert looked_up == ["b1", "b1", "b1"]
+
+        # pushes b1 out
+        bus._shard_of(commands.CreateBatch("b2", "SKU-1", 10))
+        bus._shard_of(commands.ChangeBatchQuantity("b1", 5))
+        assert looked_up == ["b1", "b1", "b1", "b1"]
+    finally:
+        bus.close()
+
+
+def test_a_dead_worker_fails_its_requests_and_is_replaced():
+    bus = ShardedMessageBus(1, dying_bus, liveness_interval=0.05)
+    try:
+        with pytest.raises(ShardDied):
+            bus.handle(commands.Allocate("die", "SKU-0", 1))
+
+        bus.handle(commands.CreateBatch("b1", "SKU-0", 10))
+        assert bus.handle(commands.Allocate("o1", "SKU-0", 1)) == ["b1"]
+    finally:
+        bus.close()
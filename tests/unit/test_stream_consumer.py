@@ -0,0 +1,148 @@
+from allocation.adapters import serialization
+from allocation.domain import commands, events
+from allocation.entrypoints.stream_consumer import StreamConsumer
+from allocation.service_layer.messagebus import MessageBus
+from tests.unit.mocks import FakeBroker, FakeUnitOfWork
+
+
+def send(broker, *messages):
+    for message in messages:
+        broker.publish(
+            serialization.channel_name(type(message)),
+            [dict(data=serialization.dumps(message))],
+        )
+
+
+def published(broker, stream):
+    return [
+        serialization.loads(events.Allocated, fields["data"])
+        for _, fields in broker.streams[stream]
+    ]
+
+
+def test_handles_commands_from_streams_and_publishes_events():
+    broker, uow = FakeBroker(), FakeUnitOfWork()
+    consumer = StreamConsumer(broker, lambda: MessageBus(uow, broker=broker))
+    send(
+        broker,
+        commands.Allocate("o1", "FANCY-LAMP", 10),
+        commands.CreateBatch("b1", "FANCY-LAMP", 100),
+        commands.Allocate("o2", "FANCY-LAMP", 10),
+        commands.ChangeBatchQuantity("b1", 50),
+    )
+
+    assert consumer.consume() == 4
+
+    [batch] = uow.products.get("FANCY-LAMP").batches
+    assert batch.available_quantity == 30
+    assert published(broker, "allocated") == [
+        events.Allocated("o1", "FANCY-LAMP", 10, "b1"),
+        events.Allocated("o2", "FANCY-LAMP", 10, "b1"),
+    ]
+    assert all(not pending for _, pending in broker.groups.values())
+
+
+def test_allocations_read_together_are_committed_and_published_together():
+    broker, uow = FakeBroker(), FakeUnitOfWork()
+    bus = MessageBus(uow, broker=broker)
+    bus.handle(commands.CreateBatch("b1", "FANCY-LAMP", 100))
+    consumer = StreamConsumer(broker, lambda: bus)
+    send(broker, *[commands.Allocate(f"o{i}", "FANCY-LAMP", 1) for i in range(10)])
+    commits, round_trips = uow.commits, broker.round_trips
+
+    consumer.consume()
+
+    # the allocations, then the read model
+    assert uow.commits - commits == 2
+    assert broker.round_trips - round_trips == 1
+    assert len(published(broker, "allocated")) == 10
+
+
+def test_consumers_in_a_group_share_the_messages():
+    broker, uow = FakeBroker(), FakeUnitOfWork()
+    MessageBus(uow).handle(commands.CreateBatch("b1", "FANCY-LAMP", 100))
+    first, second = (
+        StreamConsumer(broker, lambda: MessageBus(uow), consumer=name, batch_size=2)
+        for name in ("first", "second")
+    )
+    send(broker, *[commands.Allocate(f"o{i}", "FANCY-LAMP", 1) for i in range(3)])
+
+    assert first.consume() == 2
+    assert second.consume() == 1
+    assert second.consume() == 0
+
+
+def test_a_bad_command_does_not_block_the_stream():
+    broker, uow = FakeBroker(), FakeUnitOfWork()
+    consumer = StreamConsumer(broker, lambda: MessageBus(uow))
+    send(broker, commands.Allocate("o1", "NONEXISTENT", 10))
+
+    assert consumer.consume() == 1
+    assert consumer.consume() == 0
+
+
+class FlakyBus:
+    def __init__(self, bus, failures):
+        self.bus = bus
+        self.failures = failures
+
+    def handle(self, command):
+        if self.failures:
+            raise self.failures.pop(0)
+        return self.bus.handle(command)
+
+
+def pending(broker):
+    return [id for _, ids in broker.groups.values() for id in ids]
+
+
+def test_a_bad_command_is_acked_and_logged(caplog):
+    broker = FakeBroker()
+    consumer = StreamConsumer(broker, lambda: MessageBus(FakeUnitOfWork()))
+    send(broker, commands.Allocate("o1", "NONEXISTENT", 10))
+
+    consumer.consume()
+
+    assert pending(broker) == []
+    assert "failed for good" in caplog.text
+
+
+def test_a_transient_failure_is_left_pending_and_retried(caplog):
+    broker, uow = FakeBroker(), FakeUnitOfWork()
+    bus = FlakyBus(MessageBus(uow), [ConnectionError("postgres went away")])
+    bus.bus.handle(commands.CreateBatch("b1", "FANCY-LAMP", 100))
+    consumer = StreamConsumer(broker, lambda: bus, reclaim_idle_ms=0)
+    send(broker, commands.Allocate("o1", "FANCY-LAMP", 10))
+
+    assert consumer.consume() == 1
+    assert len(pending(broker)) == 1
+    assert "left pending to retry" in caplog.text
+
+    assert consumer.consume() == 1
+    assert pending(broker) == []
+    [batch] = uow.products.get("FANCY-LAMP").batches
+    assert batch.available_quantity == 90
+
+
+def test_gives_up_on_a_message_after_max_deliveries(caplog):
+    broker, uow = FakeBroker(), FakeUnitOfWork()
+    bus = FlakyBus(MessageBus(uow), [TimeoutError()] * 10)
+    consumer = StreamConsumer(
+        broker, lambda: bus, reclaim_idle_ms=0, max_deliveries=2
+    )
+    send(broker, commands.CreateBatch("b1", "FANCY-LAMP", 100))
+
+    assert [consumer.consume() for _ in range(3)] == [1, 1, 0]
+    assert pending(broker) == []
+    assert "after 2 deliveries" in caplog.text
+
+
+def test_stale_messages_are_only_reclaimed_once_idle():
+    broker = FakeBroker()
+    bus = FlakyBus(MessageBus(FakeUnitOfWork()), [TimeoutError()])
+    consumer = StreamConsumer(broker, lambda: bus, reclaim_idle_ms=60_000)
+    send(broker, commands.CreateBatch("b1", "FANCY-LAMP", 100))
+
+    assert consumer.consume() == 1
+    assert consumer.consume() == 0
+    assert len(pending(broker)) == 1